@@ -3,22 +3,50 @@ FastAPI web server for 3D generation pipeline.
 Exposes endpoints that Convex actions call to generate 3D models.
 """
 
-from fastapi import FastAPI, HTTPException, BackgroundTasks, UploadFile, File, Form
-from fastapi.responses import FileResponse
+from fastapi import FastAPI, HTTPException, BackgroundTasks, UploadFile, File, Form, Request
+from fastapi.responses import JSONResponse, PlainTextResponse, StreamingResponse
 from fastapi.middleware.cors import CORSMiddleware
-from pydantic import BaseModel
-from typing import Optional
+from pydantic import BaseModel, Field
+from typing import Dict, List, Literal, Optional
 from pathlib import Path
+from contextlib import asynccontextmanager
 import os
+import asyncio
+import json
 import logging
 import traceback
-from gen_pipeline import run_pipeline, generate_image, generate_3d
+from gen_pipeline import STATE_DIR, run_pipeline_async, generate_image, generate_3d_async, warm_up_models, result_cache, output_storage, provider_guards, three_d_router, UPLOAD_ARTIFACTS, MESH_PREVIEWS, InvalidMeshError, prompt_index, find_similar
+from jobs import JobManager, make_job_store
+from executor import QueueFullError, UserQueueFullError, pipeline_executor
+from metrics import REGISTRY, collect_timings
+from file_serving import serve_output
+from predictions import prediction_tracker, verify_webhook
+from coalescing import request_coalescer
+from resilience import CircuitOpenError, DeadlineExceeded, deadline
+from scheduling import client_context
+from uploads import UploadError
 
 # Set up logging
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
-app = FastAPI(title="3D Generation Pipeline API")
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    """
+    On startup: give jobs orphaned by a previous worker a terminal status, index outputs from
+    earlier runs and start TTL/quota eviction, and import the provider SDKs and create their
+    clients in the background, so the worker answers /health right away (a generation arriving
+    meanwhile waits for the import it needs; in a preloaded gunicorn master this already happened
+    before fork and is a no-op). On shutdown: stop eviction.
+    """
+    job_manager.recover()
+    output_storage.start_background_eviction()
+    app.state.warm_up = asyncio.create_task(asyncio.to_thread(warm_up_models))
+    yield
+    output_storage.stop()
+
+
+app = FastAPI(title="3D Generation Pipeline API", lifespan=lifespan)
 
 # CORS middleware to allow requests from Convex
 app.add_middleware(
@@ -32,33 +60,355 @@ app.add_middleware(
 OUTPUT_DIR = Path("outputs")
 OUTPUT_DIR.mkdir(exist_ok=True)
 
+# How often long-running requests check whether their client is still connected
+DISCONNECT_POLL_INTERVAL = 1.0
+# Seconds a generation may take end to end, retries included; provider calls are not retried past it
+REQUEST_BUDGET = float(os.getenv("REQUEST_BUDGET", 900))
+
+if os.getenv("FAKE_PROVIDERS") == "1":
+    # Offline stand-in providers for load tests; see fake_providers.py
+    from fake_providers import register_fake_providers
+    register_fake_providers()
+
+
+async def run_job_pipeline(**params):
+    """Job runner: the full pipeline under the request budget, counted from when the job starts."""
+    with deadline(REQUEST_BUDGET):
+        return await run_pipeline_async(**params)
+
+
+job_manager = JobManager(make_job_store(STATE_DIR), run_job_pipeline, pipeline_executor)
+
+
+def _queue_stats():
+    """Executor admission plus every fair-queued stage, Replicate prediction slots included."""
+    queue = pipeline_executor.stats()
+    queue["stages"]["predictions"] = prediction_tracker.stats()["slots"]
+    return queue
+
+
+def _service_metrics():
+    """Expose executor queue depth, provider guard, prediction, result cache and output storage counters alongside the stage metrics."""
+    queue = _queue_stats()
+    providers = {name: guard.stats() for name, guard in provider_guards().items()}
+    routing = three_d_router.stats()
+    cache = result_cache.stats()
+    storage = output_storage.stats()
+    predictions = prediction_tracker.stats()
+    coalescing = request_coalescer.stats()
+    similar = prompt_index.stats()
+    return [
+        ("pipeline_queue_pending", "gauge", "Pipeline calls running or waiting.", [({}, queue["pending"])]),
+        ("pipeline_queue_max_pending", "gauge", "Pending calls allowed before returning 503.", [({}, queue["max_pending"])]),
+        (
+            "pipeline_queue_pending_by_lane", "gauge", "Pipeline calls running or waiting per priority lane.",
+            [({"lane": lane}, pending) for lane, pending in queue["pending_by_lane"].items()],
+        ),
+        ("pipeline_queue_users", "gauge", "Users with pipeline calls running or waiting.", [({}, len(queue["pending_by_user"]))]),
+        (
+            "pipeline_stage_slots_active", "gauge", "Provider concurrency slots in use per stage.",
+            [({"stage": name}, stage["active"]) for name, stage in queue["stages"].items()],
+        ),
+        (
+            "pipeline_stage_waiting", "gauge", "Calls queued for a stage slot, per priority lane.",
+            [({"stage": name, "lane": lane}, waiting) for name, stage in queue["stages"].items() for lane, waiting in stage["waiting"].items()],
+        ),
+        (
+            "pipeline_stage_wait_seconds_total", "counter", "Time calls spent queued for a stage slot, per priority lane.",
+            [({"stage": name, "lane": lane}, l["wait_seconds"]) for name, stage in queue["stages"].items() for lane, l in stage["lanes"].items()],
+        ),
+        (
+            "pipeline_stage_granted_total", "counter", "Stage slots handed out, per priority lane.",
+            [({"stage": name, "lane": lane}, l["granted"]) for name, stage in queue["stages"].items() for lane, l in stage["lanes"].items()],
+        ),
+        (
+            "coalesced_requests_total", "counter", "Generation calls by stage: provider calls made, and calls saved by joining one in flight.",
+            [
+                ({"stage": stage, "outcome": outcome}, counts[outcome])
+                for stage, counts in coalescing["stages"].items()
+                for outcome in ("calls", "coalesced")
+            ],
+        ),
+        (
+            "provider_circuit_open", "gauge", "1 while a provider's circuit breaker is failing calls fast (0.5 when half open).",
+            [({"provider": name}, {"closed": 0, "half_open": 0.5, "open": 1}[p["breaker"]["state"]]) for name, p in providers.items()],
+        ),
+        (
+            "provider_rate_limit_saturation", "gauge", "Share of a provider's token bucket in use; 1 means callers are being throttled.",
+            [({"provider": name}, p["limiter"]["saturation"]) for name, p in providers.items()],
+        ),
+        (
+            "provider_rate_limited_total", "counter", "Provider calls delayed by the rate limiter.",
+            [({"provider": name}, p["limiter"]["throttled"]) for name, p in providers.items()],
+        ),
+        (
+            "provider_retries_total", "counter", "Provider calls retried after a transient failure.",
+            [({"provider": name}, p["retries"]) for name, p in providers.items()],
+        ),
+        (
+            "provider_circuit_rejections_total", "counter", "Provider calls failed fast by an open circuit breaker.",
+            [({"provider": name}, p["breaker"]["rejected"]) for name, p in providers.items()],
+        ),
+        (
+            "three_d_backend_latency_seconds", "gauge", "Moving-average completion time per 3D backend, as used by three_d_model=auto.",
+            [({"backend": name}, b["latency_seconds"]) for name, b in routing["backends"].items()],
+        ),
+        (
+            "three_d_backend_error_rate", "gauge", "Moving-average failure rate per 3D backend, decaying while the backend is idle.",
+            [({"backend": name}, b["error_rate"]) for name, b in routing["backends"].items()],
+        ),
+        (
+            "three_d_routing_total", "counter", "three_d_model=auto requests, hedges started, hedges that won and fallbacks after a failure.",
+            [({"event": event}, routing[event]) for event in ("routed", "hedged", "hedge_wins", "fallbacks")],
+        ),
+        ("replicate_predictions_outstanding", "gauge", "Replicate predictions being tracked.", [({}, predictions["outstanding"])]),
+        (
+            "replicate_predictions_total", "counter", "Replicate predictions by outcome.",
+            [({"outcome": outcome}, predictions[outcome]) for outcome in ("created", "succeeded", "failed", "canceled", "timed_out")],
+        ),
+        ("result_cache_bytes", "gauge", "Bytes held by the result cache.", [({}, cache["bytes"])]),
+        (
+            "result_cache_requests_total", "counter", "Result cache lookups by stage and outcome.",
+            [
+                ({"stage": stage, "outcome": outcome}, counts[outcome])
+                for stage, counts in cache["stages"].items()
+                for outcome in ("hits", "misses")
+            ],
+        ),
+        (
+            "similar_prompt_lookups_total", "counter", "Similar-prompt index lookups by whether any prompt matched.",
+            [({"outcome": "match"}, similar["matches"]), ({"outcome": "miss"}, similar["lookups"] - similar["matches"])],
+        ),
+        ("similar_prompt_inserts_total", "counter", "Prompts added to the similar-prompt index.", [({}, similar["inserts"])]),
+        ("output_storage_bytes", "gauge", "Bytes held in OUTPUT_DIR by indexed outputs.", [({}, storage["bytes"])]),
+        ("output_storage_quota_bytes", "gauge", "Output storage quota before eviction.", [({}, storage["quota_bytes"])]),
+        ("output_storage_evictions_total", "counter", "Output files removed by TTL or quota eviction.", [({}, storage["evictions"])]),
+    ]
+
+
+REGISTRY.add_collector(_service_metrics)
+
+
+async def cancel_on_disconnect(request: Request, coro):
+    """
+    Await `coro`, cancelling it if the client disconnects first. Cancellation reaches any
+    Replicate prediction the pipeline is waiting on, which is then cancelled remotely.
+    """
+    task = asyncio.ensure_future(coro)
+    try:
+        while True:
+            done, _ = await asyncio.wait({task}, timeout=DISCONNECT_POLL_INTERVAL)
+            if done:
+                return task.result()
+            if await request.is_disconnected():
+                logger.info("Client disconnected, cancelling pipeline")
+                task.cancel()
+                raise HTTPException(status_code=499, detail="Client closed request")
+    finally:
+        task.cancel()
+
 
 class GenerateRequest(BaseModel):
     prompt: str
     image_model: str = "nanobanana"
+    # A backend name, or "auto" to route to the fastest healthy backend
+    three_d_model: str = "trellis"
+    # Skip cached results, e.g. when the user explicitly asks for a new variation
+    bypass_cache: bool = False
+    # Add a per-stage {"stage": seconds} breakdown to the response
+    include_timings: bool = False
+    # Also write decimated/quantized LOD variants and list them under "lods"
+    lods: bool = False
+    # Pre-signed storage upload URL (e.g. Convex generateUploadUrl) for the mesh; returned as "storage_id"
+    upload_url: Optional[str] = None
+    # Upload URLs per artifact: "image", "model", "thumbnail", "turntable"
+    upload_urls: Optional[Dict[str, str]] = None
+    # Who the work is for, so capacity is shared fairly between users; unset requests share one queue
+    user_id: Optional[str] = None
+    # "interactive" for someone waiting on the result, "batch" for background variations
+    priority: Literal["interactive", "batch"] = "interactive"
+    # Return the model of an earlier, near-identical prompt instead of generating (ignored with bypass_cache)
+    reuse_similar: bool = False
+    # Prompt similarity (0-1) needed for reuse_similar; defaults to SIMILAR_REUSE_THRESHOLD
+    similarity_threshold: Optional[float] = Field(None, ge=0, le=1)
+
+
+class BatchGenerateRequest(BaseModel):
+    prompt: str
+    # One variation per hint; each hint is appended to the prompt
+    variation_hints: List[str] = [""]
+    image_model: str = "nanobanana"
     three_d_model: str = "trellis"
+    bypass_cache: bool = False
+    lods: bool = False
+    user_id: Optional[str] = None
+    priority: Literal["interactive", "batch"] = "batch"
 
 
 class Generate3DRequest(BaseModel):
     image_path: str
     three_d_model: str = "trellis"
+    bypass_cache: bool = False
+    lods: bool = False
+    # As for GenerateRequest, without "image"
+    upload_url: Optional[str] = None
+    upload_urls: Optional[Dict[str, str]] = None
+    user_id: Optional[str] = None
+    priority: Literal["interactive", "batch"] = "interactive"
+
+
+def _upload_targets(upload_url: Optional[str], upload_urls: Optional[Dict[str, str]], artifacts=UPLOAD_ARTIFACTS):
+    """Merge upload_url (the mesh) into upload_urls, rejecting artifacts the endpoint doesn't produce."""
+    uploads = dict(upload_urls or {})
+    if upload_url:
+        uploads["model"] = upload_url
+    unknown = sorted(set(uploads) - set(artifacts))
+    if unknown:
+        raise HTTPException(status_code=422, detail=f"Cannot upload {', '.join(unknown)}; expected any of {', '.join(artifacts)}")
+    return uploads
+
+
+@app.exception_handler(QueueFullError)
+async def queue_full_handler(request, exc: QueueFullError):
+    """Shed load with a retryable 503 instead of queueing without bound."""
+    return JSONResponse(
+        status_code=503,
+        content={"detail": str(exc)},
+        headers={"Retry-After": str(exc.retry_after)},
+    )
+
+
+@app.exception_handler(UserQueueFullError)
+async def user_queue_full_handler(request, exc: UserQueueFullError):
+    """One user is over their share of the queue; others are still being admitted."""
+    return JSONResponse(
+        status_code=429,
+        content={"detail": str(exc)},
+        headers={"Retry-After": str(exc.retry_after)},
+    )
+
+
+@app.exception_handler(CircuitOpenError)
+async def circuit_open_handler(request, exc: CircuitOpenError):
+    """A provider is failing; tell the client when the breaker will let a trial call through."""
+    return JSONResponse(
+        status_code=503,
+        content={"detail": str(exc), "provider": exc.provider},
+        headers={"Retry-After": str(exc.retry_after)},
+    )
+
+
+@app.exception_handler(DeadlineExceeded)
+async def deadline_exceeded_handler(request, exc: DeadlineExceeded):
+    return JSONResponse(status_code=504, content={"detail": str(exc)})
+
+
+@app.exception_handler(UploadError)
+async def upload_error_handler(request, exc: UploadError):
+    """The caller's storage endpoint failed; the outputs are still available under /files."""
+    return JSONResponse(status_code=502, content={"detail": str(exc)})
+
+
+@app.exception_handler(InvalidMeshError)
+async def invalid_mesh_handler(request, exc: InvalidMeshError):
+    """The 3D provider returned an empty, truncated or degenerate model; nothing was cached or uploaded."""
+    return JSONResponse(status_code=502, content={"detail": str(exc)})
 
 
 @app.get("/health")
 async def health_check():
-    """Health check endpoint for Render."""
-    return {"status": "ok"}
+    """Health check endpoint for Render; also tells callers whether 3D results come with previews."""
+    return {"status": "ok", "previews": MESH_PREVIEWS}
+
+
+@app.get("/health/queue")
+async def queue_stats():
+    """
+    Pending pipeline calls per lane and user, per-stage slot usage and fair-queue depth,
+    and coalesced duplicate requests.
+    """
+    return {**_queue_stats(), "coalescing": request_coalescer.stats()}
+
+
+@app.get("/health/storage")
+async def storage_stats():
+    """Output storage usage against its quota, and eviction counts."""
+    return await asyncio.to_thread(output_storage.stats)
+
+
+@app.get("/health/predictions")
+async def prediction_stats():
+    """Outstanding Replicate predictions and their outcomes."""
+    return prediction_tracker.stats()
+
+
+@app.get("/health/providers")
+async def provider_stats():
+    """Per provider: circuit breaker state, rate limiter saturation and retry counts."""
+    return {name: guard.stats() for name, guard in provider_guards().items()}
+
+
+@app.get("/health/routing")
+async def routing_stats():
+    """Latency and error model of each 3D backend behind three_d_model="auto", and routing counts."""
+    return three_d_router.stats()
+
+
+@app.get("/cache/stats")
+async def cache_stats():
+    """Result cache size and per-stage hit/miss counts, and the similar-prompt index's size and lookups."""
+    similar = {**prompt_index.stats(), "prompts": await asyncio.to_thread(prompt_index.size)}
+    return {**result_cache.stats(), "similar_prompts": similar}
+
+
+@app.get("/similar")
+async def similar_prompts(
+    prompt: str,
+    image_model: Optional[str] = None,
+    three_d_model: Optional[str] = None,
+    limit: int = 5,
+    min_similarity: float = 0.3,
+):
+    """
+    Earlier generations for prompts similar to this one, most similar first, for instant suggestions.
+    With three_d_model, only prompts that have a model from that backend ("auto": any) are listed.
+    """
+    if not 1 <= limit <= 50 or not 0 <= min_similarity <= 1:
+        raise HTTPException(status_code=422, detail="limit must be 1-50 and min_similarity 0-1")
+    matches = await asyncio.to_thread(find_similar, prompt, image_model, three_d_model, limit, min_similarity)
+    suggestions = [
+        {
+            "prompt": match["prompt"],
+            "similarity": match["similarity"],
+            "image_model": match["image_model"],
+            "image": match["image"],
+            "models": match["models"],
+        }
+        for match in matches
+    ]
+    return {"prompt": prompt, "suggestions": suggestions}
+
+
+@app.get("/metrics")
+async def metrics():
+    """Stage latency histograms, in-flight gauges and error counters in Prometheus text format."""
+    return PlainTextResponse(REGISTRY.render(), media_type="text/plain; version=0.0.4")
 
 
 @app.post("/generate/image")
 async def generate_image_endpoint(
     prompt: str = Form(...),
     image_model: str = Form("nanobanana"),
-    ref_image: Optional[UploadFile] = File(None)
+    ref_image: Optional[UploadFile] = File(None),
+    bypass_cache: bool = Form(False),
+    upload_url: Optional[str] = Form(None),
+    user_id: Optional[str] = Form(None),
+    priority: Literal["interactive", "batch"] = Form("interactive"),
 ):
     """
     Generate an image design for a keycap.
     Accepts a prompt and optional reference image.
+    With upload_url, the image is also uploaded there and "storage_id" is returned.
     """
     logger.info(f"Received image generation request: prompt='{prompt[:50]}...', model={image_model}, has_ref={ref_image is not None}")
     
@@ -67,13 +417,19 @@ async def generate_image_endpoint(
         if ref_image:
             ref_image_data = await ref_image.read()
 
-        result = generate_image(
-            prompt=prompt,
-            image_model_name=image_model,
-            ref_image_data=ref_image_data
-        )
+        with deadline(REQUEST_BUDGET), client_context(user_id, priority):
+            result = await pipeline_executor.run(
+                generate_image,
+                prompt=prompt,
+                image_model_name=image_model,
+                ref_image_data=ref_image_data,
+                use_cache=not bypass_cache,
+                upload_url=upload_url,
+            )
         logger.info(f"Image generation completed: {result}")
         return result
+    except (QueueFullError, CircuitOpenError, DeadlineExceeded, UploadError):
+        raise
     except Exception as e:
         error_msg = str(e)
         logger.error(f"Image generation failed: {error_msg}")
@@ -81,19 +437,27 @@ async def generate_image_endpoint(
 
 
 @app.post("/generate/3d")
-async def generate_3d_endpoint(request: Generate3DRequest):
+async def generate_3d_endpoint(request: Generate3DRequest, http_request: Request):
     """
     Generate a 3D model from a previously generated image.
     """
     logger.info(f"Received 3D generation request: image_path={request.image_path}, model={request.three_d_model}")
-    
+    uploads = _upload_targets(request.upload_url, request.upload_urls, [a for a in UPLOAD_ARTIFACTS if a != "image"])
+
     try:
-        result = generate_3d(
-            image_path_str=request.image_path,
-            three_d_model_name=request.three_d_model
-        )
+        with deadline(REQUEST_BUDGET), client_context(request.user_id, request.priority):
+            result = await cancel_on_disconnect(http_request, pipeline_executor.run_async(
+                generate_3d_async,
+                image_path_str=request.image_path,
+                three_d_model_name=request.three_d_model,
+                use_cache=not request.bypass_cache,
+                lods=request.lods,
+                uploads=uploads,
+            ))
         logger.info(f"3D generation completed: {result}")
         return result
+    except (QueueFullError, CircuitOpenError, DeadlineExceeded, UploadError, InvalidMeshError, HTTPException):
+        raise
     except Exception as e:
         error_msg = str(e)
         logger.error(f"3D generation failed: {error_msg}")
@@ -101,7 +465,7 @@ async def generate_3d_endpoint(request: Generate3DRequest):
 
 
 @app.post("/generate")
-async def generate(request: GenerateRequest):
+async def generate(request: GenerateRequest, http_request: Request):
     """
     Generate a 3D model from a text prompt.
     Called by Convex actions to start the generation process.
@@ -111,16 +475,28 @@ async def generate(request: GenerateRequest):
     Consider upgrading to a paid plan or using background tasks.
     """
     logger.info(f"Received generation request: prompt='{request.prompt[:50]}...', model={request.image_model}, 3d_model={request.three_d_model}")
-    
+    uploads = _upload_targets(request.upload_url, request.upload_urls)
+
     try:
         logger.info("Starting pipeline execution...")
-        result = run_pipeline(
-            prompt=request.prompt,
-            image_model_name=request.image_model,
-            three_d_model_name=request.three_d_model,
-        )
+        with deadline(REQUEST_BUDGET), client_context(request.user_id, request.priority), collect_timings() as timings:
+            result = await cancel_on_disconnect(http_request, pipeline_executor.run_async(
+                run_pipeline_async,
+                prompt=request.prompt,
+                image_model_name=request.image_model,
+                three_d_model_name=request.three_d_model,
+                use_cache=not request.bypass_cache,
+                lods=request.lods,
+                uploads=uploads,
+                reuse_similar=request.reuse_similar,
+                similarity_threshold=request.similarity_threshold,
+            ))
+        if request.include_timings:
+            result["timings"] = timings
         logger.info(f"Pipeline completed successfully: {result}")
         return result
+    except (QueueFullError, CircuitOpenError, DeadlineExceeded, UploadError, InvalidMeshError, HTTPException):
+        raise
     except Exception as e:
         error_msg = str(e)
         error_trace = traceback.format_exc()
@@ -132,28 +508,130 @@ async def generate(request: GenerateRequest):
         )
 
 
-@app.get("/files/{file_path:path}")
-async def get_file(file_path: str):
+@app.post("/generate/batch")
+async def generate_batch(request: BatchGenerateRequest):
     """
-    Serve generated PLY files.
-    Called by Convex actions to download the generated model.
+    Generate one 3D model per variation hint, all variations in parallel.
+    Each variation's 3D stage starts as soon as its own image is ready, and
+    results are streamed back as newline-delimited JSON in completion order.
     """
-    file_path_obj = OUTPUT_DIR / file_path
-    
-    if not file_path_obj.exists():
-        raise HTTPException(status_code=404, detail="File not found")
-    
-    # Security check: ensure file is within OUTPUT_DIR
+    prompts = [request.prompt + hint for hint in request.variation_hints]
+    if not prompts:
+        raise HTTPException(status_code=422, detail="variation_hints must not be empty")
+    logger.info(f"Received batch request: prompt='{request.prompt[:50]}...', variations={len(prompts)}")
+
+    # All-or-nothing admission so a batch is never half queued
+    with client_context(request.user_id, request.priority):
+        pipeline_executor.check_capacity(len(prompts))
+
+    async def run_variation(index: int, prompt: str):
+        try:
+            with deadline(REQUEST_BUDGET), client_context(request.user_id, request.priority):
+                result = await pipeline_executor.run_async(
+                    run_pipeline_async,
+                    prompt=prompt,
+                    image_model_name=request.image_model,
+                    three_d_model_name=request.three_d_model,
+                    use_cache=not request.bypass_cache,
+                    lods=request.lods,
+                )
+            return {"index": index, "prompt": prompt, "status": "succeeded", "result": result}
+        except Exception as e:
+            logger.error(f"Batch variation {index} failed: {e}")
+            return {"index": index, "prompt": prompt, "status": "failed", "error": str(e)}
+
+    tasks = [asyncio.create_task(run_variation(i, prompt)) for i, prompt in enumerate(prompts)]
+
+    async def stream_results():
+        try:
+            for next_done in asyncio.as_completed(tasks):
+                yield json.dumps(await next_done) + "\n"
+        finally:
+            # The client went away mid-stream: stop unfinished variations and their predictions
+            for task in tasks:
+                task.cancel()
+
+    return StreamingResponse(stream_results(), media_type="application/x-ndjson")
+
+
+@app.post("/jobs", status_code=202)
+async def submit_job(request: GenerateRequest):
+    """
+    Queue a full pipeline run and return immediately.
+    Poll GET /jobs/{id} or stream GET /jobs/{id}/events for progress.
+    """
+    logger.info(f"Received job request: prompt='{request.prompt[:50]}...', model={request.image_model}, 3d_model={request.three_d_model}")
+    uploads = _upload_targets(request.upload_url, request.upload_urls)
+    # The job's task inherits the client, so it is queued fairly when it starts
+    with client_context(request.user_id, request.priority):
+        job = job_manager.submit({
+            "prompt": request.prompt,
+            "image_model_name": request.image_model,
+            "three_d_model_name": request.three_d_model,
+            "use_cache": not request.bypass_cache,
+            "lods": request.lods,
+            "uploads": uploads,
+            "reuse_similar": request.reuse_similar,
+            "similarity_threshold": request.similarity_threshold,
+        })
+    return {"id": job["id"], "status": job["status"]}
+
+
+@app.get("/jobs/{job_id}")
+async def get_job(job_id: str):
+    """Return the current status, stage events and (when finished) result of a job."""
+    job = job_manager.get(job_id)
+    if job is None:
+        raise HTTPException(status_code=404, detail="Job not found")
+    return job
+
+
+@app.get("/jobs/{job_id}/events")
+async def stream_job_events(job_id: str):
+    """Server-Sent Events stream of a job's stage transitions, closed once the job finishes."""
+    if job_manager.get(job_id) is None:
+        raise HTTPException(status_code=404, detail="Job not found")
+    return StreamingResponse(
+        job_manager.stream_events(job_id),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+    )
+
+
+@app.post("/webhooks/replicate")
+async def replicate_webhook(request: Request):
+    """
+    Completion callback for Replicate predictions (set REPLICATE_WEBHOOK_URL to this route's
+    public URL). It only wakes the waiting pipeline, which then fetches the prediction itself.
+    """
+    body = await request.body()
+    if prediction_tracker.webhook_secret and not verify_webhook(prediction_tracker.webhook_secret, request.headers, body):
+        raise HTTPException(status_code=401, detail="Invalid webhook signature")
     try:
-        file_path_obj.resolve().relative_to(OUTPUT_DIR.resolve())
+        payload = json.loads(body)
     except ValueError:
+        raise HTTPException(status_code=400, detail="Invalid JSON body")
+    return {"tracked": prediction_tracker.handle_webhook(payload)}
+
+
+@app.get("/files/{file_path:path}")
+async def get_file(file_path: str, request: Request):
+    """
+    Serve generated model and image files.
+    Called by Convex actions to download the generated model. Supports Range requests,
+    content-hash ETags with 304s and precompressed variants; outputs are immutable.
+    """
+    # Security check: storage resolves first, then ensures the file is within OUTPUT_DIR.
+    # Resolving also records the access for LRU eviction.
+    try:
+        file_path_obj = output_storage.resolve(file_path)
+    except PermissionError:
         raise HTTPException(status_code=403, detail="Access denied")
-    
-    return FileResponse(
-        file_path_obj,
-        media_type="application/octet-stream",
-        filename=file_path_obj.name,
-    )
+
+    if file_path_obj is None:
+        raise HTTPException(status_code=404, detail="File not found")
+
+    return await serve_output(file_path_obj, request)
 
 
 if __name__ == "__main__":
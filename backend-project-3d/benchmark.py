@@ -0,0 +1,352 @@
+"""
+Offline load test for the API.
+
+Starts the app under uvicorn with the fake providers (fake_providers.py) in a
+scratch directory, drives an endpoint at each requested concurrency and
+reports throughput, latency percentiles, status codes and the server's peak
+RSS. Results can be stored as a baseline and later runs compared against it:
+
+    python benchmark.py --concurrency 10 50 200
+    python benchmark.py --concurrency 10 50 --save-baseline
+    python benchmark.py --concurrency 10 50 --check      # exit 1 on regression
+    python benchmark.py --concurrency 10 --upload        # also stream outputs to fake_storage.py
+    python benchmark.py --startup                        # cold start under uvicorn and gunicorn
+
+A fresh server is started for every concurrency level so peak RSS is per level.
+Pass --url to drive an already-running server instead (RSS is then not reported).
+
+--startup measures cold starts instead: the time to import the app, from
+spawning the server until /health answers, and the first and second
+/generate after that, under plain uvicorn and under gunicorn with
+gunicorn.conf.py.
+"""
+
+import argparse
+import json
+import os
+import socket
+import statistics
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+
+import requests
+
+from fake_storage import FakeStorageServer
+
+BACKEND_DIR = Path(__file__).resolve().parent
+DEFAULT_BASELINE = BACKEND_DIR / "benchmark_baseline.json"
+
+# Provider behaviour for benchmark runs; override with --env KEY=VALUE
+DEFAULT_SERVER_ENV = {
+    "FAKE_PROVIDERS": "1",
+    "FAKE_IMAGE_LATENCY": "0.5",
+    "FAKE_3D_LATENCY": "2.0",
+    "FAKE_JITTER": "0.2",
+    "FAKE_FAILURE_RATE": "0.0",
+    "FAKE_MESH_FACES": "50000",
+    "FAKE_TEXTURE_SIZE": "512",
+    "FAKE_IMAGE_SIZE": "512",
+    "STORAGE_EVICT_INTERVAL": "3600",
+    # Admit every request of the default levels (up to c200), so they measure
+    # throughput and latency under load rather than how fast the queue limit answers 503
+    "PIPELINE_MAX_QUEUE": "512",
+    "USER_MAX_QUEUE": "512",
+}
+
+ENDPOINTS = {
+    "generate": ("/generate", lambda i: {
+        "prompt": f"benchmark keycap {i}", "image_model": "fake", "three_d_model": "fake", "bypass_cache": True,
+    }),
+    "jobs": ("/jobs", lambda i: {
+        "prompt": f"benchmark keycap {i}", "image_model": "fake", "three_d_model": "fake", "bypass_cache": True,
+    }),
+}
+
+# Relative change allowed before a metric counts as a regression
+REGRESSION_CHECKS = (
+    ("throughput_rps", "lower"),
+    ("p95_seconds", "higher"),
+    ("peak_rss_bytes", "higher"),
+    ("import_seconds", "higher"),
+    ("ready_seconds", "higher"),
+    ("first_request_seconds", "higher"),
+)
+STARTUP_SERVERS = ("uvicorn", "gunicorn")
+# No simulated provider latency, so first-request time is the server's own cold path
+STARTUP_SERVER_ENV = {"FAKE_IMAGE_LATENCY": "0", "FAKE_3D_LATENCY": "0", "FAKE_JITTER": "0"}
+
+
+def _free_port():
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def peak_rss(pid: int):
+    """High-water resident set size of a live process, from /proc (Linux only)."""
+    try:
+        with open(f"/proc/{pid}/status") as f:
+            for line in f:
+                if line.startswith("VmHWM:"):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    return None
+
+
+class BenchmarkServer:
+    """The app under uvicorn (or gunicorn with gunicorn.conf.py), with its outputs in a throwaway directory."""
+
+    def __init__(self, env: dict, verbose: bool = False, server: str = "uvicorn") -> None:
+        self.verbose = verbose
+        self.server = server
+        self.port = _free_port()
+        self.url = f"http://127.0.0.1:{self.port}"
+        self._workdir = tempfile.TemporaryDirectory(prefix="bench-")
+        self._env = {**os.environ, **env}
+        self.process = None
+        # Seconds from spawning the server until /health answered
+        self.ready_seconds = None
+
+    def _command(self):
+        if self.server == "gunicorn":
+            return [sys.executable, "-m", "gunicorn", "app:app", "-c", str(BACKEND_DIR / "gunicorn.conf.py"),
+                    "--pythonpath", str(BACKEND_DIR), "--bind", f"127.0.0.1:{self.port}",
+                    "--log-level", "warning"]
+        return [sys.executable, "-m", "uvicorn", "app:app", "--app-dir", str(BACKEND_DIR),
+                "--port", str(self.port), "--log-level", "warning", "--no-access-log"]
+
+    def __enter__(self):
+        started = time.perf_counter()
+        self.process = subprocess.Popen(
+            self._command(),
+            cwd=self._workdir.name, env=self._env,
+            stdout=None if self.verbose else subprocess.DEVNULL,
+            stderr=None if self.verbose else subprocess.DEVNULL,
+        )
+        deadline = time.monotonic() + 60
+        while time.monotonic() < deadline:
+            if self.process.poll() is not None:
+                raise RuntimeError(f"Server exited with code {self.process.returncode}")
+            try:
+                if requests.get(f"{self.url}/health", timeout=1).ok:
+                    self.ready_seconds = time.perf_counter() - started
+                    return self
+            except requests.ConnectionError:
+                pass
+            time.sleep(0.02)
+        raise RuntimeError("Server did not become healthy within 60s")
+
+    def __exit__(self, *exc):
+        self.process.terminate()
+        try:
+            self.process.wait(timeout=15)
+        except subprocess.TimeoutExpired:
+            self.process.kill()
+        self._workdir.cleanup()
+
+
+def _wait_for_job(session, url, job_id, timeout):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        job = session.get(f"{url}/jobs/{job_id}", timeout=timeout).json()
+        if job["status"] in ("succeeded", "failed"):
+            return 200 if job["status"] == "succeeded" else 500
+        time.sleep(0.25)
+    return "timeout"
+
+
+def drive(url: str, endpoint: str, concurrency: int, total: int, timeout: float, storage=None):
+    """
+    Send `total` requests with `concurrency` in flight. Returns (latencies of successes, status counts, wall time).
+    With a FakeStorageServer, every request also streams its image and mesh to it.
+    """
+    path, make_body = ENDPOINTS[endpoint]
+    local = threading.local()
+    latencies, statuses = [], {}
+    lock = threading.Lock()
+
+    def one(i):
+        session = getattr(local, "session", None)
+        if session is None:
+            session = local.session = requests.Session()
+        body = make_body(i)
+        if storage is not None:
+            body["upload_urls"] = {"image": storage.upload_url(), "model": storage.upload_url()}
+        start = time.perf_counter()
+        try:
+            response = session.post(f"{url}{path}", json=body, timeout=timeout)
+            status = response.status_code
+            if endpoint == "jobs" and status == 202:
+                status = _wait_for_job(session, url, response.json()["id"], timeout)
+        except requests.RequestException as e:
+            status = type(e).__name__
+        elapsed = time.perf_counter() - start
+        with lock:
+            statuses[str(status)] = statuses.get(str(status), 0) + 1
+            if status == 200:
+                latencies.append(elapsed)
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as pool:
+        list(pool.map(one, range(total)))
+    return latencies, statuses, time.perf_counter() - start
+
+
+def summarize(latencies, statuses, wall_seconds, total):
+    summary = {
+        "requests": total,
+        "succeeded": len(latencies),
+        "statuses": dict(sorted(statuses.items())),
+        "wall_seconds": round(wall_seconds, 3),
+        "throughput_rps": round(len(latencies) / wall_seconds, 3) if wall_seconds else 0.0,
+    }
+    if len(latencies) >= 2:
+        cuts = statistics.quantiles(latencies, n=100, method="inclusive")
+        summary.update(p50_seconds=round(cuts[49], 3), p95_seconds=round(cuts[94], 3), p99_seconds=round(cuts[98], 3))
+    elif latencies:
+        summary.update(p50_seconds=round(latencies[0], 3), p95_seconds=round(latencies[0], 3), p99_seconds=round(latencies[0], 3))
+    return summary
+
+
+def run_level(args, concurrency: int, server_env: dict, storage=None):
+    total = args.requests or concurrency * 2
+    if args.url:
+        latencies, statuses, wall = drive(args.url, args.endpoint, concurrency, total, args.timeout, storage)
+        return {**summarize(latencies, statuses, wall, total), "peak_rss_bytes": None}
+    with BenchmarkServer(server_env, verbose=args.verbose) as server:
+        latencies, statuses, wall = drive(server.url, args.endpoint, concurrency, total, args.timeout, storage)
+        rss = peak_rss(server.process.pid)
+    return {**summarize(latencies, statuses, wall, total), "peak_rss_bytes": rss}
+
+
+def measure_import(server_env: dict):
+    """Seconds a fresh interpreter takes to import the app."""
+    with tempfile.TemporaryDirectory(prefix="bench-") as workdir:
+        out = subprocess.run(
+            [sys.executable, "-c", "import time; start = time.perf_counter(); import app; print(time.perf_counter() - start)"],
+            cwd=workdir, env={**os.environ, **server_env, "PYTHONPATH": str(BACKEND_DIR)},
+            capture_output=True, text=True, check=True,
+        )
+    return float(out.stdout.strip().splitlines()[-1])
+
+
+def run_startup(args, server: str, server_env: dict):
+    """Median cold-start timings over --startup-runs fresh servers."""
+    path, make_body = ENDPOINTS["generate"]
+    runs = []
+    for i in range(args.startup_runs):
+        run = {"import_seconds": measure_import(server_env)}
+        with BenchmarkServer(server_env, verbose=args.verbose, server=server) as bench:
+            run["ready_seconds"] = bench.ready_seconds
+            for key in ("first_request_seconds", "warm_request_seconds"):
+                start = time.perf_counter()
+                requests.post(f"{bench.url}{path}", json=make_body(i), timeout=args.timeout).raise_for_status()
+                run[key] = time.perf_counter() - start
+            run["peak_rss_bytes"] = peak_rss(bench.process.pid) if server == "uvicorn" else None
+        runs.append(run)
+    summary = {key: round(statistics.median(run[key] for run in runs), 3) for key in runs[0] if key != "peak_rss_bytes"}
+    return {"runs": len(runs), **summary, "peak_rss_bytes": runs[-1]["peak_rss_bytes"]}
+
+
+def compare(results: dict, baseline: dict, tolerance: float):
+    """List human-readable regressions of `results` against `baseline`."""
+    regressions = []
+    for level, current in results.items():
+        previous = baseline.get(level)
+        if previous is None:
+            continue
+        for metric, bad_direction in REGRESSION_CHECKS:
+            old, new = previous.get(metric), current.get(metric)
+            if not old or new is None:
+                continue
+            change = (new - old) / old
+            if (bad_direction == "higher" and change > tolerance) or (bad_direction == "lower" and -change > tolerance):
+                regressions.append(f"{level} {metric}: {old} -> {new} ({change:+.0%})")
+    return regressions
+
+
+def _format_row(level, result):
+    rss = result.get("peak_rss_bytes")
+    return (
+        f"{level:>12} {result['succeeded']:>5}/{result['requests']:<5} {result['throughput_rps']:>8.2f} "
+        f"{result.get('p50_seconds', float('nan')):>7.2f} {result.get('p95_seconds', float('nan')):>7.2f} "
+        f"{result.get('p99_seconds', float('nan')):>7.2f} {rss / 2 ** 20 if rss else float('nan'):>8.1f}  {result['statuses']}"
+    )
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--concurrency", type=int, nargs="+", default=[10, 50, 200])
+    parser.add_argument("--requests", type=int, help="Requests per level (default: 2x concurrency)")
+    parser.add_argument("--endpoint", choices=sorted(ENDPOINTS), default="generate")
+    parser.add_argument("--timeout", type=float, default=300)
+    parser.add_argument("--url", help="Drive an already-running server instead of starting one")
+    parser.add_argument("--env", action="append", default=[], metavar="KEY=VALUE", help="Extra server environment")
+    parser.add_argument("--baseline", type=Path, default=DEFAULT_BASELINE)
+    parser.add_argument("--save-baseline", action="store_true", help="Store these results as the baseline")
+    parser.add_argument("--check", action="store_true", help="Exit 1 if a metric regressed past --tolerance")
+    parser.add_argument("--tolerance", type=float, default=0.2)
+    parser.add_argument("--verbose", action="store_true", help="Show the server's logs")
+    parser.add_argument("--output", type=Path, help="Also write the results as JSON here")
+    parser.add_argument("--upload", action="store_true", help="Stream outputs to a local stand-in for Convex storage")
+    parser.add_argument("--startup", action="store_true", help="Measure cold-start import and first-request latency instead")
+    parser.add_argument("--startup-runs", type=int, default=3)
+    args = parser.parse_args(argv)
+
+    server_env = dict(DEFAULT_SERVER_ENV)
+    if args.startup:
+        server_env.update(STARTUP_SERVER_ENV)
+    server_env.update(item.split("=", 1) for item in args.env)
+
+    results = {}
+    if args.startup:
+        print(f"{'level':>16} {'import':>7} {'ready':>7} {'first':>7} {'second':>7}")
+        for server in STARTUP_SERVERS:
+            level = f"startup@{server}"
+            results[level] = result = run_startup(args, server, server_env)
+            print(
+                f"{level:>16} {result['import_seconds']:>7.2f} {result['ready_seconds']:>7.2f} "
+                f"{result['first_request_seconds']:>7.2f} {result['warm_request_seconds']:>7.2f}",
+                flush=True,
+            )
+        return _finish(args, server_env, results)
+
+    print(f"{'level':>12} {'ok/total':>11} {'req/s':>8} {'p50':>7} {'p95':>7} {'p99':>7} {'RSS MiB':>8}  statuses")
+    storage = FakeStorageServer().start() if args.upload else None
+    try:
+        for concurrency in args.concurrency:
+            level = f"{args.endpoint}{'+upload' if storage else ''}@c{concurrency}"
+            results[level] = run_level(args, concurrency, server_env, storage)
+            print(_format_row(level, results[level]), flush=True)
+    finally:
+        if storage is not None:
+            storage.stop()
+
+    return _finish(args, server_env, results)
+
+
+def _finish(args, server_env: dict, results: dict):
+    """Write --output, compare against the baseline and optionally save it; returns the exit code."""
+    if args.output:
+        args.output.write_text(json.dumps(results, indent=2) + "\n")
+
+    baseline = json.loads(args.baseline.read_text()) if args.baseline.exists() else {}
+    regressions = compare(results, baseline.get("results", {}), args.tolerance)
+    for regression in regressions:
+        print(f"REGRESSION {regression}")
+
+    if args.save_baseline:
+        merged = {**baseline.get("results", {}), **results}
+        args.baseline.write_text(json.dumps({"server_env": server_env, "results": merged}, indent=2) + "\n")
+        print(f"Saved baseline to {args.baseline}")
+    return 1 if args.check and regressions else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
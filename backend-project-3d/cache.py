@@ -0,0 +1,184 @@
+"""
+Content-addressed cache for pipeline stage results.
+
+Entries map a hash of a stage's inputs to the JSON result that stage returned,
+plus the files it wrote under OUTPUT_DIR. The index is a SQLite database kept
+outside that served directory, shared by every worker process, and is evicted
+least-recently-used first once the cached files exceed a byte budget. Entries
+whose files are held by an in-flight pipeline call are never evicted, and a
+hit holds its files before checking they still exist.
+"""
+
+import hashlib
+import json
+import logging
+import os
+import sqlite3
+import threading
+import time
+from pathlib import Path
+
+logger = logging.getLogger(__name__)
+
+# Skip writes to the index for entries used more recently than this
+USE_RESOLUTION = 60
+
+
+def hash_bytes(data: bytes):
+    return hashlib.sha256(data).hexdigest() if data is not None else None
+
+
+def make_key(*parts):
+    """Stable hash of JSON-serialisable key parts."""
+    payload = json.dumps(parts, sort_keys=True, separators=(",", ":"), default=str)
+    return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+
+class ResultCache:
+    def __init__(self, root: Path, max_bytes: int, enabled: bool = True, remove_file=None, hold_file=None, is_pinned=None, index_path: Path = None) -> None:
+        self.root = Path(root)
+        # Called with a root-relative name to delete an evicted file; may refuse (return False) if it is in use
+        self.remove_file = remove_file or (lambda name: (self.root / name).unlink(missing_ok=True))
+        # Called with a root-relative name to keep a hit's file from being removed while it is used
+        self.hold_file = hold_file or (lambda name: None)
+        # Whether a root-relative name is held by work in flight, so its entry must not be evicted
+        self.is_pinned = is_pinned or (lambda name: False)
+        self.index_path = Path(index_path or self.root / "cache.sqlite3")
+        self.max_bytes = max_bytes
+        self.enabled = enabled
+        self._lock = threading.Lock()
+        self._stats = {}
+        self._conn = None
+        self._conn_pid = None
+        self.root.mkdir(parents=True, exist_ok=True)
+        self.index_path.parent.mkdir(parents=True, exist_ok=True)
+        self._connection().execute("PRAGMA journal_mode=WAL")
+        self._connection().execute(
+            """
+            CREATE TABLE IF NOT EXISTS entries (
+                key TEXT PRIMARY KEY,
+                stage TEXT NOT NULL,
+                result TEXT NOT NULL,
+                files TEXT NOT NULL,
+                size INTEGER NOT NULL,
+                created REAL NOT NULL,
+                last_used REAL NOT NULL
+            )
+            """
+        )
+        self._connection().execute("CREATE INDEX IF NOT EXISTS entries_last_used ON entries (last_used)")
+        self._import_json_index()
+
+    def _connection(self):
+        """This process's index connection; one opened before a fork (gunicorn preload_app) is never reused."""
+        if self._conn_pid != os.getpid():
+            self._conn = sqlite3.connect(str(self.index_path), check_same_thread=False, isolation_level=None, timeout=30)
+            self._conn_pid = os.getpid()
+        return self._conn
+
+    @classmethod
+    def from_env(cls, root: Path, state_dir: Path, remove_file=None, hold_file=None, is_pinned=None):
+        return cls(
+            root,
+            max_bytes=int(os.getenv("RESULT_CACHE_MAX_BYTES", 5 * 1024 ** 3)),
+            enabled=os.getenv("RESULT_CACHE_ENABLED", "1") != "0",
+            remove_file=remove_file,
+            hold_file=hold_file,
+            is_pinned=is_pinned,
+            index_path=Path(state_dir) / "cache.sqlite3",
+        )
+
+    def _import_json_index(self):
+        """Carry entries over from the cache_index.json written by older versions, then remove it."""
+        legacy = self.root / "cache_index.json"
+        try:
+            with open(legacy) as f:
+                entries = json.load(f)
+        except FileNotFoundError:
+            return
+        except (OSError, ValueError) as e:
+            logger.warning(f"[ResultCache] Ignoring unreadable index {legacy}: {e}")
+            entries = {}
+        with self._lock:
+            self._connection().executemany(
+                "INSERT OR IGNORE INTO entries (key, stage, result, files, size, created, last_used) VALUES (?, ?, ?, ?, ?, ?, ?)",
+                [
+                    (key, e["stage"], json.dumps(e["result"]), json.dumps(e["files"]), e["size"], e["created"], e["last_used"])
+                    for key, e in entries.items()
+                ],
+            )
+        legacy.unlink(missing_ok=True)
+        logger.info(f"[ResultCache] Imported {len(entries)} entries from {legacy}")
+
+    def _count(self, stage: str, outcome: str):
+        counts = self._stats.setdefault(stage, {"hits": 0, "misses": 0, "stores": 0, "evictions": 0})
+        counts[outcome] += 1
+
+    def get(self, stage: str, key: str):
+        """Return a copy of the cached result for `key`, or None on a miss."""
+        if not self.enabled:
+            return None
+        with self._lock:
+            row = self._connection().execute("SELECT result, files, last_used FROM entries WHERE key = ?", (key,)).fetchone()
+            if row is not None:
+                files = json.loads(row[1])
+                # Hold first, then check: storage eviction either saw the hold or already removed the file
+                for name in files:
+                    self.hold_file(name)
+                if not all((self.root / name).exists() for name in files):
+                    # Files were removed behind our back; treat as a miss
+                    self._connection().execute("DELETE FROM entries WHERE key = ?", (key,))
+                    row = None
+            if row is None:
+                self._count(stage, "misses")
+                return None
+            now = time.time()
+            if row[2] < now - USE_RESOLUTION:
+                self._connection().execute("UPDATE entries SET last_used = ? WHERE key = ?", (now, key))
+            self._count(stage, "hits")
+        return {**json.loads(row[0]), "cached": True}
+
+    def put(self, stage: str, key: str, result: dict, files):
+        """Record `result` for `key`. `files` are paths (relative to the cache root) the result owns."""
+        if not self.enabled:
+            return
+        names = [str(Path(name)) for name in files]
+        size = sum((self.root / name).stat().st_size for name in names)
+        with self._lock:
+            now = time.time()
+            self._connection().execute(
+                "INSERT OR REPLACE INTO entries (key, stage, result, files, size, created, last_used) VALUES (?, ?, ?, ?, ?, ?, ?)",
+                (key, stage, json.dumps(result), json.dumps(names), size, now, now),
+            )
+            self._count(stage, "stores")
+            self._evict()
+
+    def _evict(self):
+        conn = self._connection()
+        total = conn.execute("SELECT COALESCE(SUM(size), 0) FROM entries").fetchone()[0]
+        if total <= self.max_bytes:
+            return
+        for key, stage, files, size in conn.execute("SELECT key, stage, files, size FROM entries ORDER BY last_used").fetchall():
+            if total <= self.max_bytes:
+                break
+            files = json.loads(files)
+            if any(self.is_pinned(name) for name in files):
+                # In use by a pipeline call (possibly one that just got it as a hit); try again next time
+                continue
+            for name in files:
+                self.remove_file(name)
+            total -= size
+            conn.execute("DELETE FROM entries WHERE key = ?", (key,))
+            self._count(stage, "evictions")
+            logger.info(f"[ResultCache] Evicted {stage} entry {key[:12]} ({size} bytes)")
+
+    def stats(self):
+        with self._lock:
+            entries, total = self._connection().execute("SELECT COUNT(*), COALESCE(SUM(size), 0) FROM entries").fetchone()
+            return {
+                "enabled": self.enabled,
+                "entries": entries,
+                "bytes": total,
+                "max_bytes": self.max_bytes,
+                "stages": {stage: dict(counts) for stage, counts in self._stats.items()},
+            }
@@ -0,0 +1,102 @@
+"""
+Single-flight coalescing of identical in-flight generations.
+
+A retried batch or a double-submitted form can start the same generation twice
+before the first one reaches the result cache. Calls made through
+`SingleFlight` with the same (stage, key) while one is already running attach
+to it instead of calling the provider again, and all of them get its result or
+its exception. Blocking calls wait on a Future; coroutine calls share a task,
+which is cancelled only once every caller waiting on it has gone away.
+"""
+
+import asyncio
+import logging
+import threading
+from concurrent.futures import Future
+
+logger = logging.getLogger(__name__)
+
+
+class SingleFlight:
+    def __init__(self) -> None:
+        self._lock = threading.Lock()
+        self._calls = {}
+        self._tasks = {}
+        self._counts = {}
+
+    def _count(self, stage: str, outcome: str):
+        counts = self._counts.setdefault(stage, {"calls": 0, "coalesced": 0, "failed": 0})
+        counts[outcome] += 1
+
+    def do(self, stage: str, key: str, fn, *args, **kwargs):
+        """Run blocking `fn` for `key` unless an identical call is already running, then share its outcome."""
+        with self._lock:
+            future = self._calls.get((stage, key))
+            leader = future is None
+            if leader:
+                future = self._calls[(stage, key)] = Future()
+            self._count(stage, "calls" if leader else "coalesced")
+        if not leader:
+            logger.info(f"[SingleFlight] Joined in-flight {stage} call {key[:12]}")
+            return future.result()
+
+        try:
+            result = fn(*args, **kwargs)
+        except BaseException as e:
+            with self._lock:
+                self._count(stage, "failed")
+            future.set_exception(e)
+            raise
+        else:
+            future.set_result(result)
+            return result
+        finally:
+            with self._lock:
+                del self._calls[(stage, key)]
+
+    async def do_async(self, stage: str, key: str, coro_fn, *args, **kwargs):
+        """
+        Await `coro_fn(*args, **kwargs)` for `key`, sharing one task between concurrent callers.
+        A caller that is cancelled stops waiting; the task itself is cancelled when no caller is left.
+        """
+        with self._lock:
+            entry = self._tasks.get((stage, key))
+            if entry is None:
+                task = asyncio.ensure_future(coro_fn(*args, **kwargs))
+                entry = self._tasks[(stage, key)] = {"task": task, "waiters": 0}
+                task.add_done_callback(lambda done: self._forget(stage, key, done))
+                self._count(stage, "calls")
+            else:
+                logger.info(f"[SingleFlight] Joined in-flight {stage} task {key[:12]}")
+                self._count(stage, "coalesced")
+            entry["waiters"] += 1
+
+        task = entry["task"]
+        try:
+            return await asyncio.shield(task)
+        finally:
+            with self._lock:
+                entry["waiters"] -= 1
+                abandoned = entry["waiters"] == 0 and not task.done()
+            if abandoned:
+                logger.info(f"[SingleFlight] Every caller left, cancelling {stage} task {key[:12]}")
+                task.cancel()
+
+    def _forget(self, stage: str, key: str, task):
+        with self._lock:
+            entry = self._tasks.get((stage, key))
+            if entry is not None and entry["task"] is task:
+                del self._tasks[(stage, key)]
+            if not task.cancelled() and task.exception() is not None:
+                self._count(stage, "failed")
+
+    def stats(self):
+        """Per stage: provider calls made, calls saved by joining one in flight, and failures."""
+        with self._lock:
+            return {
+                "in_flight": len(self._calls) + len(self._tasks),
+                "stages": {stage: dict(counts) for stage, counts in self._counts.items()},
+            }
+
+
+request_coalescer = SingleFlight()
@@ -0,0 +1,163 @@
+"""
+Bounded executor for blocking pipeline work.
+
+The provider SDKs (google-genai, replicate) are synchronous, so async endpoints
+hand every pipeline call to a fixed-size thread pool instead of running it on
+the event loop. Admission is capped so a burst gets a 503 instead of an
+unbounded backlog, and each provider stage has its own concurrency limit.
+Admission is also capped per identified user, and a stage's slots are shared between
+users and priority lanes by fair queuing (see scheduling.py).
+"""
+
+import asyncio
+import contextvars
+import functools
+import logging
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import asynccontextmanager, contextmanager
+from contextvars import ContextVar
+
+from scheduling import ANONYMOUS, FairSlots, current_client
+
+logger = logging.getLogger(__name__)
+
+# Set while an admitted run_async() call is in progress; its nested run() calls aren't counted again
+_admitted = ContextVar("pipeline_admitted", default=False)
+
+
+class QueueFullError(RuntimeError):
+    """Raised when the executor already holds its maximum number of pending calls."""
+
+    def __init__(self, retry_after: int) -> None:
+        super().__init__("Generation queue is full, please retry later")
+        self.retry_after = retry_after
+
+
+class UserQueueFullError(QueueFullError):
+    """Raised when one user already holds their maximum number of pending calls."""
+
+    def __init__(self, user: str, retry_after: int) -> None:
+        RuntimeError.__init__(self, "Too many generations in progress for this user, please retry later")
+        self.user = user
+        self.retry_after = retry_after
+
+
+class PipelineExecutor:
+    def __init__(self, max_workers: int, max_pending: int, stage_limits: dict, retry_after: int = 30, max_pending_per_user: int = None) -> None:
+        self.max_workers = max_workers
+        self.max_pending = max_pending
+        self.max_pending_per_user = max_pending_per_user or max_pending
+        self.retry_after = retry_after
+        self.stage_limits = dict(stage_limits)
+        self._pool = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="pipeline")
+        self._stages = {name: FairSlots.from_env(name, limit) for name, limit in stage_limits.items()}
+        self._pending = 0
+        self._pending_by_user = {}
+        self._pending_by_lane = {}
+        self._lock = threading.Lock()
+
+    @classmethod
+    def from_env(cls):
+        return cls(
+            max_workers=int(os.getenv("PIPELINE_MAX_WORKERS", 8)),
+            max_pending=int(os.getenv("PIPELINE_MAX_QUEUE", 32)),
+            stage_limits={
+                "image": int(os.getenv("IMAGE_CONCURRENCY", 4)),
+                "three_d": int(os.getenv("THREE_D_CONCURRENCY", 4)),
+            },
+            retry_after=int(os.getenv("QUEUE_RETRY_AFTER", 30)),
+            max_pending_per_user=int(os.getenv("USER_MAX_QUEUE", 16)),
+        )
+
+    def _check_locked(self, user: str, calls: int):
+        if self._pending + calls > self.max_pending:
+            logger.warning(f"[PipelineExecutor] Rejecting call, {self._pending} pending")
+            raise QueueFullError(self.retry_after)
+        # Callers without a user id are many clients in one flow; only the global cap applies to them
+        if user != ANONYMOUS and self._pending_by_user.get(user, 0) + calls > self.max_pending_per_user:
+            logger.warning(f"[PipelineExecutor] Rejecting call for {user}, {self._pending_by_user.get(user, 0)} pending")
+            raise UserQueueFullError(user, self.retry_after)
+
+    def check_capacity(self, calls: int = 1):
+        """Raise QueueFullError (or UserQueueFullError) if `calls` new calls would be rejected right now."""
+        with self._lock:
+            self._check_locked(current_client().user, calls)
+
+    @contextmanager
+    def _admit(self):
+        if _admitted.get():
+            yield
+            return
+        user, lane = current_client()
+        with self._lock:
+            self._check_locked(user, 1)
+            self._pending += 1
+            self._pending_by_user[user] = self._pending_by_user.get(user, 0) + 1
+            self._pending_by_lane[lane] = self._pending_by_lane.get(lane, 0) + 1
+        token = _admitted.set(True)
+        try:
+            yield
+        finally:
+            _admitted.reset(token)
+            with self._lock:
+                self._pending -= 1
+                self._pending_by_lane[lane] -= 1
+                self._pending_by_user[user] -= 1
+                if not self._pending_by_user[user]:
+                    del self._pending_by_user[user]
+
+    async def run(self, fn, *args, **kwargs):
+        """Run a blocking callable in the pool, or raise QueueFullError if the queue is full."""
+        with self._admit():
+            # Carry contextvars into the worker thread, like asyncio.to_thread does
+            ctx = contextvars.copy_context()
+            call = functools.partial(ctx.run, fn, *args, **kwargs)
+            return await asyncio.get_running_loop().run_in_executor(self._pool, call)
+
+    async def run_async(self, coro_fn, *args, **kwargs):
+        """
+        Admit a coroutine pipeline as one pending call. Its blocking steps go through run() and
+        share this admission; time spent awaiting remote work holds no pool thread.
+        """
+        with self._admit():
+            return await coro_fn(*args, **kwargs)
+
+    @contextmanager
+    def stage(self, name: str):
+        """Hold one of the stage's concurrency slots (blocking, fair-queued) for the duration of the block."""
+        slots = self._stages.get(name)
+        if slots is None:
+            yield
+            return
+        with slots.slot():
+            yield
+
+    @asynccontextmanager
+    async def stage_async(self, name: str):
+        """stage() for coroutines; waiting for a slot holds no thread."""
+        slots = self._stages.get(name)
+        if slots is None:
+            yield
+            return
+        async with slots.slot_async():
+            yield
+
+    def stats(self):
+        with self._lock:
+            queue = {
+                "pending": self._pending,
+                "max_pending": self.max_pending,
+                "max_pending_per_user": self.max_pending_per_user,
+                "max_workers": self.max_workers,
+                "pending_by_lane": dict(self._pending_by_lane),
+                "pending_by_user": dict(self._pending_by_user),
+            }
+        return {**queue, "stages": {name: slots.stats() for name, slots in self._stages.items()}}
+
+    def shutdown(self):
+        self._pool.shutdown(wait=False, cancel_futures=True)
+
+
+pipeline_executor = PipelineExecutor.from_env()
@@ -0,0 +1,178 @@
+"""
+Offline stand-ins for the Gemini and Replicate providers.
+
+`FakeImageModel` and `FakeThreeDModel` behave like the real models from the
+pipeline's point of view: they block for a configurable latency (with jitter),
+fail at a configurable rate, and return a PIL image or a Replicate-style dict
+of `FileOutput`-like objects holding a real textured GLB or Gaussian-splat PLY
+of configurable size. They are registered as "fake" in IMAGE_MODELS and
+THREE_D_MODELS when the app runs with FAKE_PROVIDERS=1, which is what
+benchmark.py does, so load tests never spend API credit.
+
+Settings (environment variables):
+    FAKE_IMAGE_LATENCY   seconds per image call (2.0)
+    FAKE_3D_LATENCY      seconds per 3D call (20.0)
+    FAKE_JITTER          latency varies uniformly by +/- this fraction (0.2)
+    FAKE_FAILURE_RATE    probability that a call raises FakeProviderError (0.0);
+                         these count as transient, so they are retried
+    FAKE_IMAGE_SIZE      edge of the generated PNG in pixels (1024)
+    FAKE_3D_FORMAT       "glb" (textured mesh) or "ply" (Gaussian splats) (glb)
+    FAKE_MESH_FACES      triangles in the GLB, or splats in the PLY (200000)
+    FAKE_TEXTURE_SIZE    edge of the GLB's texture in pixels (1024)
+
+Calls go through the "fake" provider guard, which retries and circuit-breaks
+like the real ones; it is not rate limited unless FAKE_RATE_LIMIT is set.
+"""
+
+import asyncio
+import io
+import os
+import random
+import threading
+import time
+
+import numpy as np
+from PIL import Image
+
+from gen_pipeline import IMAGE_MODELS, PROVIDER_GUARDS, THREE_D_MODELS, ImageModel, ThreeDModel, is_retryable_provider_error
+from mesh_files import write_glb_mesh, write_ply_vertices
+from predictions import prediction_tracker
+from resilience import ProviderGuard
+
+FILE_OUTPUT_CHUNK_SIZE = 64 * 1024
+
+
+class FakeProviderError(RuntimeError):
+    """Injected provider failure."""
+
+    retryable = True
+
+
+def _env_float(name, default):
+    return float(os.getenv(name, default))
+
+
+def _delay(latency: float):
+    jitter = _env_float("FAKE_JITTER", 0.2)
+    return max(0.0, latency * random.uniform(1 - jitter, 1 + jitter))
+
+
+def _maybe_fail():
+    if random.random() < _env_float("FAKE_FAILURE_RATE", 0.0):
+        raise FakeProviderError("Injected fake provider failure")
+
+
+def _simulate_call(latency: float):
+    time.sleep(_delay(latency))
+    _maybe_fail()
+
+
+class FakeFileOutput:
+    """Mimics replicate.helpers.FileOutput: a URL plus a body readable whole or by iteration."""
+
+    def __init__(self, data: bytes, url: str) -> None:
+        self._data = data
+        self.url = url
+
+    def read(self):
+        return self._data
+
+    def __iter__(self):
+        for start in range(0, len(self._data), FILE_OUTPUT_CHUNK_SIZE):
+            yield self._data[start:start + FILE_OUTPUT_CHUNK_SIZE]
+
+    def __repr__(self):
+        return f"FakeFileOutput({self.url!r}, {len(self._data)} bytes)"
+
+
+def make_fake_image(size: int):
+    """Noisy RGB image, so the PNG encodes to a realistic size rather than a few hundred bytes."""
+    noise = Image.effect_noise((size, size), 48).convert("L")
+    return Image.merge("RGB", (noise, noise.rotate(90), noise.transpose(Image.FLIP_LEFT_RIGHT)))
+
+
+def make_fake_glb(faces: int, texture_size: int):
+    """UV sphere with about `faces` triangles and a noise texture."""
+    rings = max(2, int(np.sqrt(faces / 4)))
+    segments = max(3, faces // (2 * rings))
+    theta = np.linspace(0, np.pi, rings + 1)
+    phi = np.linspace(0, 2 * np.pi, segments + 1)
+    t, p = np.meshgrid(theta, phi, indexing="ij")
+    positions = np.stack([np.sin(t) * np.cos(p), np.cos(t), np.sin(t) * np.sin(p)], axis=-1).reshape(-1, 3)
+    uvs = np.stack([p / (2 * np.pi), t / np.pi], axis=-1).reshape(-1, 2)
+
+    row = segments + 1
+    i, j = np.meshgrid(np.arange(rings), np.arange(segments), indexing="ij")
+    a = (i * row + j).reshape(-1)
+    b, c, d = a + 1, a + row, a + row + 1
+    triangles = np.concatenate([np.stack([a, c, b], axis=1), np.stack([b, c, d], axis=1)])
+
+    buffer = io.BytesIO()
+    make_fake_image(texture_size).save(buffer, format="PNG")
+    return write_glb_mesh(
+        positions.astype(np.float32), triangles.astype(np.uint32), uvs.astype(np.float32),
+        texture=(buffer.getvalue(), "image/png"),
+    )
+
+
+def make_fake_ply(splats: int):
+    """Gaussian-splat PLY with the property layout Trellis writes."""
+    rng = np.random.default_rng(0)
+    names = ["x", "y", "z", "nx", "ny", "nz", "f_dc_0", "f_dc_1", "f_dc_2", "opacity",
+             "scale_0", "scale_1", "scale_2", "rot_0", "rot_1", "rot_2", "rot_3"]
+    vertices = np.zeros(splats, dtype=[(name, "<f4") for name in names])
+    for name in names:
+        vertices[name] = rng.standard_normal(splats)
+    return write_ply_vertices(vertices)
+
+
+class FakeImageModel(ImageModel):
+    def gen(self, prompt: str, ref_image: Image.Image = None):
+        PROVIDER_GUARDS["fake"].call(_simulate_call, _env_float("FAKE_IMAGE_LATENCY", 2.0))
+        return make_fake_image(int(os.getenv("FAKE_IMAGE_SIZE", 1024)))
+
+
+class FakeThreeDModel(ThreeDModel):
+    params = {"fake": True}
+
+    def __init__(self) -> None:
+        # Payloads are built once per process; building them isn't what's being measured
+        self._payload = None
+        self._lock = threading.Lock()
+
+    def _build_payload(self):
+        faces = int(os.getenv("FAKE_MESH_FACES", 200000))
+        if os.getenv("FAKE_3D_FORMAT", "glb").lower() == "ply":
+            return "gaussian_ply", make_fake_ply(faces)
+        return "model_file", make_fake_glb(faces, int(os.getenv("FAKE_TEXTURE_SIZE", 1024)))
+
+    def _output(self):
+        with self._lock:
+            if self._payload is None:
+                self._payload = self._build_payload()
+        key, data = self._payload
+        suffix = "glb" if key == "model_file" else "ply"
+        return {key: FakeFileOutput(data, f"https://replicate.delivery/fake/output.{suffix}")}
+
+    def gen(self, image: Image.Image):
+        output = self._output()
+        PROVIDER_GUARDS["fake"].call(_simulate_call, _env_float("FAKE_3D_LATENCY", 20.0))
+        return output
+
+    async def _prediction(self):
+        # Queued fairly for a prediction slot like a real one
+        async with prediction_tracker.slot():
+            await asyncio.sleep(_delay(_env_float("FAKE_3D_LATENCY", 20.0)))
+        _maybe_fail()
+
+    async def gen_async(self, image_bytes: bytes):
+        # Like a tracked Replicate prediction, waiting holds no thread
+        output = await asyncio.to_thread(self._output)
+        await PROVIDER_GUARDS["fake"].call_async(self._prediction)
+        return output
+
+
+def register_fake_providers(name: str = "fake"):
+    PROVIDER_GUARDS.setdefault("fake", ProviderGuard.from_env("fake", is_retryable_provider_error, rate=0, burst=0))
+    IMAGE_MODELS[name] = FakeImageModel
+    THREE_D_MODELS[name] = FakeThreeDModel
@@ -0,0 +1,157 @@
+"""
+Local stand-in for a Convex storage upload endpoint.
+
+Convex's generateUploadUrl hands out URLs that take a file as the body of a
+POST and answer {"storageId": "..."}. `FakeStorageServer` does the same on
+localhost, so the upload_url/upload_urls options of the API can be exercised
+(and load tested with `benchmark.py --upload`) without a Convex deployment:
+
+    storage = FakeStorageServer(fail_rate=0.1).start()
+    requests.post("http://localhost:8000/generate", json={
+        "prompt": "...", "upload_urls": {"image": storage.upload_url(), "model": storage.upload_url()},
+    })
+    storage.uploads[storage_id]   # {"content_type", "bytes", "sha256", "path"}
+
+Any path is accepted; bodies may be sent with Content-Length or chunked. With
+a directory, bodies are kept as files named after their storage id. Run it on
+its own with `python fake_storage.py --port 8100 [--dir DIR]`.
+"""
+
+import argparse
+import hashlib
+import json
+import random
+import threading
+import uuid
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from pathlib import Path
+
+CHUNK_SIZE = 1024 * 1024
+
+
+class _UploadHandler(BaseHTTPRequestHandler):
+    server_version = "FakeStorage/1.0"
+
+    def log_message(self, format, *args):
+        pass
+
+    def _read_body(self):
+        """Yield the request body, from either a Content-Length or a chunked transfer."""
+        if self.headers.get("Transfer-Encoding", "").lower() == "chunked":
+            while True:
+                size = int(self.rfile.readline().split(b";")[0].strip(), 16)
+                if size == 0:
+                    self.rfile.readline()
+                    return
+                yield self.rfile.read(size)
+                self.rfile.readline()
+        remaining = int(self.headers.get("Content-Length", 0))
+        while remaining:
+            chunk = self.rfile.read(min(CHUNK_SIZE, remaining))
+            if not chunk:
+                return
+            remaining -= len(chunk)
+            yield chunk
+
+    def _reply(self, status: int, body: dict):
+        payload = json.dumps(body).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(payload)))
+        self.end_headers()
+        self.wfile.write(payload)
+
+    def do_POST(self):
+        storage = self.server.storage
+        storage_id = f"fake_{uuid.uuid4().hex}"
+        digest, size = hashlib.sha256(), 0
+        path = storage.directory / storage_id if storage.directory else None
+        out = open(path, "wb") if path else None
+        try:
+            for chunk in self._read_body():
+                digest.update(chunk)
+                size += len(chunk)
+                if out:
+                    out.write(chunk)
+        finally:
+            if out:
+                out.close()
+        if random.random() < storage.fail_rate:
+            if path:
+                path.unlink(missing_ok=True)
+            storage.record_failure()
+            self._reply(503, {"error": "Injected fake storage failure"})
+            return
+        storage.record(storage_id, {
+            "content_type": self.headers.get("Content-Type"),
+            "bytes": size,
+            "sha256": digest.hexdigest(),
+            "path": str(path) if path else None,
+        })
+        self._reply(200, {"storageId": storage_id})
+
+
+class FakeStorageServer:
+    def __init__(self, host: str = "127.0.0.1", port: int = 0, directory: Path = None, fail_rate: float = 0.0) -> None:
+        self.directory = Path(directory) if directory else None
+        if self.directory:
+            self.directory.mkdir(parents=True, exist_ok=True)
+        self.fail_rate = fail_rate
+        self.uploads = {}
+        self.failed = 0
+        self._lock = threading.Lock()
+        self._httpd = ThreadingHTTPServer((host, port), _UploadHandler)
+        self._httpd.daemon_threads = True
+        self._httpd.storage = self
+        self._thread = None
+
+    @property
+    def url(self):
+        host, port = self._httpd.server_address[:2]
+        return f"http://{host}:{port}"
+
+    def upload_url(self):
+        """A fresh upload URL, like one from Convex's generateUploadUrl."""
+        return f"{self.url}/api/storage/upload?token={uuid.uuid4().hex}"
+
+    def record(self, storage_id: str, upload: dict):
+        with self._lock:
+            self.uploads[storage_id] = upload
+
+    def record_failure(self):
+        with self._lock:
+            self.failed += 1
+
+    def start(self):
+        self._thread = threading.Thread(target=self._httpd.serve_forever, name="fake-storage", daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._httpd.shutdown()
+        self._httpd.server_close()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc):
+        self.stop()
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8100)
+    parser.add_argument("--dir", type=Path, help="Keep uploaded bodies here")
+    parser.add_argument("--fail-rate", type=float, default=0.0, help="Fraction of uploads answered with a 503")
+    args = parser.parse_args(argv)
+    storage = FakeStorageServer(args.host, args.port, args.dir, args.fail_rate)
+    print(f"Fake storage listening on {storage.url}; upload URL e.g. {storage.upload_url()}")
+    try:
+        storage._httpd.serve_forever()
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,193 @@
+"""
+HTTP semantics for serving generated outputs.
+
+Outputs are written once under a uuid name and never modified, so they are
+served with strong content-hash ETags and `Cache-Control: immutable`, answer
+conditional requests with 304, support single byte ranges for resumable
+downloads, and prefer precompressed `.br`/`.gz` siblings when the client
+accepts them.
+"""
+
+import asyncio
+import functools
+import gzip
+import hashlib
+import logging
+import shutil
+from pathlib import Path
+
+from fastapi import Request
+from fastapi.responses import FileResponse, Response, StreamingResponse
+
+try:
+    import brotli
+except ImportError:  # brotli is optional; gzip variants are always available
+    brotli = None
+
+logger = logging.getLogger(__name__)
+
+CACHE_CONTROL = "public, max-age=31536000, immutable"
+READ_CHUNK_SIZE = 256 * 1024
+MEDIA_TYPES = {
+    ".glb": "model/gltf-binary",
+    ".gltf": "model/gltf+json",
+    ".ply": "application/ply",
+    ".png": "image/png",
+    ".jpg": "image/jpeg",
+    ".jpeg": "image/jpeg",
+    ".webp": "image/webp",
+}
+# Only compress formats that aren't already compressed
+COMPRESSIBLE_SUFFIXES = {".glb", ".gltf", ".ply"}
+ENCODINGS = (("br", ".br"), ("gzip", ".gz"))
+
+# ETags remembered for this many (path, size, mtime) versions, least recently served dropped first
+ETAG_CACHE_SIZE = 4096
+
+
+def media_type_for(path: Path):
+    return MEDIA_TYPES.get(path.suffix.lower(), "application/octet-stream")
+
+
+def file_etag(path: Path):
+    """Strong ETag from the file's SHA-256, memoised per (path, size, mtime)."""
+    stat = path.stat()
+    return _hash_etag(str(path), stat.st_size, stat.st_mtime_ns)
+
+
+@functools.lru_cache(maxsize=ETAG_CACHE_SIZE)
+def _hash_etag(path: str, size: int, mtime_ns: int):
+    # size and mtime_ns only key the cache, so a rewritten file is hashed again
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(READ_CHUNK_SIZE), b""):
+            digest.update(chunk)
+    return f'"{digest.hexdigest()}"'
+
+
+def precompress(path: Path):
+    """
+    Write `.gz` (and `.br` when the brotli package is installed) siblings of a compressible output.
+    Returns the sibling names written.
+    """
+    path = Path(path)
+    if path.suffix.lower() not in COMPRESSIBLE_SUFFIXES:
+        return []
+    written = []
+    gz_path = path.with_name(path.name + ".gz")
+    with open(path, "rb") as src, gzip.open(gz_path, "wb", compresslevel=6) as dst:
+        shutil.copyfileobj(src, dst, READ_CHUNK_SIZE)
+    written.append(gz_path.name)
+    if brotli is not None:
+        br_path = path.with_name(path.name + ".br")
+        compressor = brotli.Compressor(quality=5)
+        with open(path, "rb") as src, open(br_path, "wb") as dst:
+            for chunk in iter(lambda: src.read(READ_CHUNK_SIZE), b""):
+                dst.write(compressor.process(chunk))
+            dst.write(compressor.finish())
+        written.append(br_path.name)
+    return written
+
+
+def _etag_matches(header: str, etag: str):
+    if header is None:
+        return False
+    candidates = [tag.strip() for tag in header.split(",")]
+    # Weak comparison, as RFC 9110 requires for If-None-Match
+    return "*" in candidates or any(tag.removeprefix("W/") == etag for tag in candidates)
+
+
+def _parse_range(header: str, size: int):
+    """
+    Parse a single "bytes=start-end" range. Returns (start, end) inclusive, None to ignore
+    the header (multiple or malformed ranges), or raises ValueError if it can't be satisfied.
+    """
+    if not header or not header.startswith("bytes=") or "," in header:
+        return None
+    start_text, _, end_text = header[len("bytes="):].strip().partition("-")
+    try:
+        if start_text == "":
+            # Suffix range: the last N bytes
+            length = int(end_text)
+            if length <= 0:
+                raise ValueError("Empty suffix range")
+            return max(size - length, 0), size - 1
+        start = int(start_text)
+        end = int(end_text) if end_text else size - 1
+    except ValueError:
+        return None
+    if start >= size or start > end:
+        raise ValueError("Range not satisfiable")
+    return start, min(end, size - 1)
+
+
+def _iter_range(path: Path, start: int, length: int):
+    with open(path, "rb") as f:
+        f.seek(start)
+        remaining = length
+        while remaining > 0:
+            chunk = f.read(min(READ_CHUNK_SIZE, remaining))
+            if not chunk:
+                break
+            remaining -= len(chunk)
+            yield chunk
+
+
+def _preferred_variant(path: Path, accept_encoding: str):
+    accepted = {part.split(";")[0].strip() for part in (accept_encoding or "").split(",")}
+    for encoding, suffix in ENCODINGS:
+        variant = path.with_name(path.name + suffix)
+        if encoding in accepted and variant.exists():
+            return encoding, variant
+    return None, None
+
+
+async def serve_output(path: Path, request: Request):
+    """Build the response for GET /files/{path}; `path` must already be resolved and access-checked."""
+    etag = await asyncio.to_thread(file_etag, path)
+    headers = {
+        "ETag": etag,
+        "Cache-Control": CACHE_CONTROL,
+        "Accept-Ranges": "bytes",
+    }
+    encoding, variant = None, None
+    if path.suffix.lower() in COMPRESSIBLE_SUFFIXES:
+        headers["Vary"] = "Accept-Encoding"
+        encoding, variant = _preferred_variant(path, request.headers.get("accept-encoding"))
+    # Each encoding is a distinct representation, so it needs its own validator
+    variant_etag = f'{etag[:-1]}-{encoding}"' if variant is not None else None
+
+    if_none_match = request.headers.get("if-none-match")
+    if _etag_matches(if_none_match, etag):
+        return Response(status_code=304, headers=headers)
+    if variant_etag and _etag_matches(if_none_match, variant_etag):
+        return Response(status_code=304, headers={**headers, "ETag": variant_etag})
+
+    media_type = media_type_for(path)
+    size = path.stat().st_size
+    range_header = request.headers.get("range")
+    if_range = request.headers.get("if-range")
+    if range_header and (if_range is None or if_range == etag):
+        try:
+            byte_range = _parse_range(range_header, size)
+        except ValueError:
+            return Response(status_code=416, headers={**headers, "Content-Range": f"bytes */{size}"})
+        if byte_range is not None:
+            # Ranges are always served from the identity encoding
+            start, end = byte_range
+            length = end - start + 1
+            return StreamingResponse(
+                _iter_range(path, start, length),
+                status_code=206,
+                media_type=media_type,
+                headers={**headers, "Content-Range": f"bytes {start}-{end}/{size}", "Content-Length": str(length)},
+            )
+
+    if variant is not None:
+        return FileResponse(
+            variant,
+            media_type=media_type,
+            filename=path.name,
+            headers={**headers, "Content-Encoding": encoding, "ETag": variant_etag},
+        )
+    return FileResponse(path, media_type=media_type, filename=path.name, headers=headers)
@@ -1,18 +1,41 @@
+from __future__ import annotations
+
 import io
 import os
-import uuid
+import sys
+import hashlib
+import importlib
+import time
 import logging
+import threading
+import asyncio
+import contextvars
+from concurrent.futures import Future, ThreadPoolExecutor
 from abc import ABC, abstractmethod
+from collections import OrderedDict
 from pathlib import Path
+from typing import TYPE_CHECKING
+from urllib.parse import urlsplit
 
 from dotenv import load_dotenv
-from PIL import Image
-# API's
-# Google - NanoBanana
-from google import genai
-from google.genai import types
-# Replicate - HunYuan3D
-import replicate
+# Provider SDKs (google-genai for NanoBanana, replicate for HunYuan3D/Trellis), requests, PIL and
+# the NumPy mesh code are imported on first use, so the app can answer /health without waiting
+# for them; prewarm_imports() loads them all up front, e.g. in a preloading gunicorn master.
+
+from cache import ResultCache, hash_bytes, make_key
+from coalescing import request_coalescer
+from executor import pipeline_executor
+from file_serving import media_type_for, precompress
+from metrics import observe_stage, timed_stage
+from predictions import prediction_tracker
+from resilience import RETRYABLE_STATUSES, DeadlineExceeded, ProviderGuard, status_of
+from routing import LatencyRouter
+from similarity import PromptIndex
+from storage import OutputStorage, move_legacy_database
+from uploads import UploadError, upload_bytes, upload_file
+
+if TYPE_CHECKING:
+  from PIL import Image
 
 # Set up logging
 logging.basicConfig(level=logging.INFO)
@@ -22,6 +45,41 @@ load_dotenv(".env.local")
 load_dotenv()
 
 OUTPUT_DIR = Path("outputs")
+# Databases (jobs, indexes) live here, outside OUTPUT_DIR, so /files can never serve them
+STATE_DIR = Path(os.getenv("STATE_DIR", "state"))
+
+# Provider client settings, shared by every request in the process
+PROVIDER_POOL_SIZE = int(os.getenv("PROVIDER_POOL_SIZE", 10))
+PROVIDER_TIMEOUT = float(os.getenv("PROVIDER_TIMEOUT", 120))
+DOWNLOAD_TIMEOUT = float(os.getenv("DOWNLOAD_TIMEOUT", 120))
+# Outputs are copied to disk in chunks of this size so memory use doesn't grow with the asset
+COPY_CHUNK_SIZE = 1024 * 1024
+# Write .gz/.br siblings of meshes so /files can serve them precompressed
+PRECOMPRESS_OUTPUTS = os.getenv("PRECOMPRESS_OUTPUTS", "0") == "1"
+# Check every provider output is a usable GLB/PLY before it is cached, post-processed or uploaded
+MESH_VALIDATION = os.getenv("MESH_VALIDATION", "1") == "1"
+# Render a thumbnail and turntable sprite of every mesh for gallery previews
+MESH_PREVIEWS = os.getenv("MESH_PREVIEWS", "0") == "1"
+PREVIEW_KEYS = ("thumbnail", "turntable")
+# Outputs a request can have streamed to its own upload URLs; see upload_output
+UPLOAD_ARTIFACTS = ("image", "model") + PREVIEW_KEYS
+# Upload guards are kept for this many storage hosts, least recently used dropped first
+UPLOAD_GUARD_HOSTS = int(os.getenv("UPLOAD_GUARD_HOSTS", 64))
+
+# Older versions kept these inside OUTPUT_DIR; carry them over once
+for _database in ("jobs.sqlite3", "storage.sqlite3", "prompts.sqlite3", "cache.sqlite3"):
+  move_legacy_database(OUTPUT_DIR / _database, STATE_DIR / _database)
+
+output_storage = OutputStorage.from_env(OUTPUT_DIR, STATE_DIR)
+# Writes generated images to disk while the next stage already uses the in-memory bytes
+_persist_pool = ThreadPoolExecutor(max_workers=int(os.getenv("PERSIST_WORKERS", 2)), thread_name_prefix="persist")
+result_cache = ResultCache.from_env(
+  OUTPUT_DIR, STATE_DIR, remove_file=output_storage.delete_unpinned, hold_file=output_storage.hold, is_pinned=output_storage.is_pinned
+)
+# Prompts of past text-to-image generations, for near-duplicate suggestions and reuse_similar
+prompt_index = PromptIndex.from_env(STATE_DIR)
+# Similarity at or above which reuse_similar serves an earlier prompt's model instead of generating
+SIMILAR_REUSE_THRESHOLD = float(os.getenv("SIMILAR_REUSE_THRESHOLD", 0.8))
 KEYCAP_SYSTEM_PROMPT = """
 You are a professional 3D asset designer specializing in mechanical keyboard keycaps.
 Your task is to design a single, high-quality keycap based on the user's description.
@@ -32,22 +90,123 @@ Do NOT generate multiple keycaps unless explicitly asked (but prefer single).
 Focus on the material, texture, and the specific design element requested.
 """
 
+
+def is_retryable_provider_error(exc: BaseException):
+  """
+  Transient provider failures worth retrying: throttling and 5xx responses, dropped
+  connections and transport timeouts. Model errors and bad requests are not retried.
+  """
+  if getattr(exc, "retryable", False):
+    return True
+  # A client library that hasn't been imported yet can't have raised
+  requests = sys.modules.get("requests")
+  if requests is not None and isinstance(exc, (requests.ConnectionError, requests.Timeout)):
+    return True
+  httpx = sys.modules.get("httpx")
+  if httpx is not None and isinstance(exc, httpx.TransportError):
+    return True
+  return status_of(exc) in RETRYABLE_STATUSES
+
+
+# Rate limits, retries and circuit breakers per provider; see resilience.py
+PROVIDER_GUARDS = {
+  "gemini": ProviderGuard.from_env("gemini", is_retryable_provider_error, rate=2.0, burst=10),
+  "replicate": ProviderGuard.from_env("replicate", is_retryable_provider_error, rate=5.0, burst=20),
+}
+# Caller-supplied storage upload URLs (Convex) get a guard per host, so one caller's failing
+# storage can't open the breaker on everyone else's uploads; see upload_guard
+_upload_guards = OrderedDict()
+_upload_guards_lock = threading.Lock()
+
+# Latency/error model behind three_d_model="auto"; see routing.py
+three_d_router = LatencyRouter.from_env()
+
+_http_session = None
+_replicate_client = None
+_client_lock = threading.Lock()
+
+
+def get_http_session():
+  """Process-wide requests.Session so result downloads reuse keep-alive connections."""
+  global _http_session
+  with _client_lock:
+    if _http_session is None:
+      import requests
+      from requests.adapters import HTTPAdapter
+      session = requests.Session()
+      adapter = HTTPAdapter(pool_connections=PROVIDER_POOL_SIZE, pool_maxsize=PROVIDER_POOL_SIZE)
+      session.mount("https://", adapter)
+      session.mount("http://", adapter)
+      _http_session = session
+    return _http_session
+
+
+def get_replicate_client():
+  """Process-wide Replicate client shared by all Replicate-backed models."""
+  global _replicate_client
+  with _client_lock:
+    if _replicate_client is None:
+      replicate_token = os.getenv("REPLICATE_API_KEY")
+      if not replicate_token:
+        raise RuntimeError("REPLICATE_API_KEY not set; place it in .env or your environment")
+      import replicate
+      _replicate_client = replicate.Client(api_token=replicate_token, timeout=PROVIDER_TIMEOUT)
+    return _replicate_client
+
+
+def _iter_chunks(source, chunk_size=COPY_CHUNK_SIZE):
+  """Yield the bytes of a streamed HTTP response, file-like object or Replicate FileOutput piece by piece."""
+  if hasattr(source, "iter_content"):
+    # requests.Response opened with stream=True
+    yield from source.iter_content(chunk_size=chunk_size)
+  elif isinstance(source, io.IOBase):
+    while True:
+      chunk = source.read(chunk_size)
+      if not chunk:
+        break
+      yield chunk
+  elif hasattr(source, "__iter__"):
+    # Replicate FileOutput streams its HTTP body when iterated
+    yield from source
+  else:
+    yield source.read()
+
+
 def _save_file_output(file_obj, suffix=".ply"):
-  """Persist a Replicate FileOutput (or any file-like with read()) and return (id, filename)."""
-  file_id = uuid.uuid4().hex
-  filename = f"{file_id}{suffix}"
-  path = OUTPUT_DIR / filename
-  with open(path, "wb") as f:
-    f.write(file_obj.read())
-  # Return just the filename, not the full path with OUTPUT_DIR
+  """
+  Stream a Replicate FileOutput, HTTP response or file-like object to disk.
+  Writes to a temp file and renames it into place, so readers never see a partial file.
+  Returns (id, path relative to OUTPUT_DIR, {"bytes": ..., "sha256": ...}).
+  """
+  file_id, relative, path = output_storage.new_file(suffix)
+  tmp_path = path.with_name(f".{path.name}.part")
+  digest = hashlib.sha256()
+  size = 0
+  write_seconds = 0.0
+  try:
+    # "download" covers the whole copy; "disk_write" only the time spent writing chunks
+    with timed_stage("download"), open(tmp_path, "wb") as f:
+      for chunk in _iter_chunks(file_obj):
+        write_start = time.perf_counter()
+        f.write(chunk)
+        write_seconds += time.perf_counter() - write_start
+        digest.update(chunk)
+        size += len(chunk)
+    os.replace(tmp_path, path)
+  except BaseException:
+    tmp_path.unlink(missing_ok=True)
+    raise
+  observe_stage("disk_write", write_seconds)
+  output_storage.register(relative)
+  # Return the path relative to OUTPUT_DIR, not the full path
   # This prevents double-path issues in the /files/ endpoint
-  return file_id, filename
+  return file_id, relative, {"bytes": size, "sha256": digest.hexdigest()}
 
 
 def materialize_model_output(model_output):
   """
   Convert a model_output dict from Replicate into a standardized payload:
-  { "format": "<ext>", "location": "file", "path": "<relative path>" }
+  { "format": "<ext>", "location": "file", "path": "<relative path>", "bytes": <size>, "sha256": "<hex>" }
   """
   logger.info(f"[materialize_model_output] Input type: {type(model_output)}")
   logger.info(f"[materialize_model_output] Input: {model_output}")
@@ -57,9 +216,9 @@ def materialize_model_output(model_output):
     for i, value in enumerate(model_output):
       logger.info(f"[materialize_model_output] List item {i}: type={type(value)}, hasattr('read')={hasattr(value, 'read')}")
       if hasattr(value, "read"):
-        file_id, path = _save_file_output(value, suffix=".ply")
+        file_id, path, file_stats = _save_file_output(value, suffix=".ply")
         logger.info(f"[materialize_model_output] Found file in list: {path}")
-        return {"id": file_id, "format": "ply", "location": "file", "path": str(path)}
+        return {"id": file_id, "format": "ply", "location": "file", "path": str(path), **file_stats}
     logger.error("[materialize_model_output] No file-like objects found in list")
     raise ValueError("No file-like objects found in list output")
 
@@ -86,22 +245,22 @@ def materialize_model_output(model_output):
       
       if hasattr(file_obj, "read"):
         # File-like object
-        file_id, path = _save_file_output(file_obj, suffix=suffix)
+        file_id, path, file_stats = _save_file_output(file_obj, suffix=suffix)
         logger.info(f"[materialize_model_output] Saved file from '{key}': {path}")
-        return {"id": file_id, "format": suffix.lstrip("."), "location": "file", "path": str(path)}
+        return {"id": file_id, "format": suffix.lstrip("."), "location": "file", "path": str(path), **file_stats}
       elif isinstance(file_obj, str) and file_obj.startswith("http"):
         # URL string - download it
         logger.info(f"[materialize_model_output] Key '{key}' is a URL: {file_obj}")
         # Only download if it's the right file type (check URL ends with expected extension)
         if file_obj.lower().endswith(suffix.lower()) or suffix in [".ply", ".glb"] and (suffix.lstrip(".") in file_obj.lower()):
           try:
-            import requests
             logger.info(f"[materialize_model_output] Downloading {suffix} file from URL: {file_obj}")
-            response = requests.get(file_obj, timeout=120)
-            response.raise_for_status()
-            file_id, path = _save_file_output(io.BytesIO(response.content), suffix=suffix)
+            response = get_http_session().get(file_obj, timeout=DOWNLOAD_TIMEOUT, stream=True)
+            with response:
+              response.raise_for_status()
+              file_id, path, file_stats = _save_file_output(response, suffix=suffix)
             logger.info(f"[materialize_model_output] Downloaded and saved: {path}")
-            return {"id": file_id, "format": suffix.lstrip("."), "location": "file", "path": str(path)}
+            return {"id": file_id, "format": suffix.lstrip("."), "location": "file", "path": str(path), **file_stats}
           except Exception as e:
             logger.error(f"[materialize_model_output] Failed to download from URL '{key}': {e}")
             # Continue to try other options
@@ -119,21 +278,21 @@ def materialize_model_output(model_output):
     
     if hasattr(value, "read"):
       # File-like object
-      file_id, path = _save_file_output(value, suffix=".ply")
+      file_id, path, file_stats = _save_file_output(value, suffix=".ply")
       logger.info(f"[materialize_model_output] Found file-like object in '{key}': {path}")
-      return {"id": file_id, "format": "ply", "location": "file", "path": str(path)}
+      return {"id": file_id, "format": "ply", "location": "file", "path": str(path), **file_stats}
     elif isinstance(value, str) and value.startswith("http"):
       # URL string - only download if it's a .ply file
       if ".ply" in value.lower():
         logger.info(f"[materialize_model_output] Found .ply URL in '{key}': {value}")
         try:
-          import requests
           logger.info(f"[materialize_model_output] Downloading .ply file from URL: {value}")
-          response = requests.get(value, timeout=120)
-          response.raise_for_status()
-          file_id, path = _save_file_output(io.BytesIO(response.content), suffix=".ply")
+          response = get_http_session().get(value, timeout=DOWNLOAD_TIMEOUT, stream=True)
+          with response:
+            response.raise_for_status()
+            file_id, path, file_stats = _save_file_output(response, suffix=".ply")
           logger.info(f"[materialize_model_output] Downloaded and saved: {path}")
-          return {"id": file_id, "format": "ply", "location": "file", "path": str(path)}
+          return {"id": file_id, "format": "ply", "location": "file", "path": str(path), **file_stats}
         except Exception as e:
           logger.error(f"[materialize_model_output] Failed to download from URL '{key}': {e}")
           # Continue to try other options
@@ -144,14 +303,73 @@ def materialize_model_output(model_output):
   raise ValueError(f"Could not find a file-like output in model_output. Keys: {list(model_output.keys()) if isinstance(model_output, dict) else 'N/A'}. Structure: {str(model_output)[:500]}")
 
 
+class InvalidMeshError(RuntimeError):
+  """The 3D provider returned a model file that is empty, truncated or degenerate."""
+
+
+def validate_model_output(result: dict, backend: str):
+  """
+  Inspect a materialized model (see mesh_inspect) and add its stats under "mesh". A format guessed
+  wrongly from the output's keys or URL is corrected from the file's magic bytes. An unusable
+  file is deleted and InvalidMeshError raised.
+  """
+  from mesh_files import MeshFormatError
+  from mesh_inspect import inspect_mesh
+
+  path = OUTPUT_DIR / result["path"]
+  try:
+    with timed_stage("inspect", backend):
+      stats = inspect_mesh(path)
+  except MeshFormatError as e:
+    logger.error(f"[validate_model_output] Rejecting {result['path']} from {backend}: {e}")
+    output_storage.delete(result["path"])
+    raise InvalidMeshError(f"3D backend '{backend}' returned an unusable model: {e}") from None
+
+  if stats["format"] != result["format"]:
+    logger.warning(f"[validate_model_output] {result['path']} is a {stats['format'].upper()}, not {result['format'].upper()}; renaming")
+    file_id, relative, new_path = output_storage.new_file(f".{stats['format']}")
+    os.replace(path, new_path)
+    output_storage.delete(result["path"])
+    output_storage.register(relative)
+    result = {**result, "id": file_id, "path": relative, "format": stats["format"]}
+  return {**result, "mesh": stats}
+
+
+class EncodedImage:
+  """
+  Image bytes exactly as the provider returned them. The pipeline writes and uploads these
+  bytes as-is; they are only decoded if something needs pixels.
+  """
+  SUFFIXES = {"image/png": ".png", "image/jpeg": ".jpg", "image/webp": ".webp"}
+
+  def __init__(self, data: bytes, mime_type: str = "image/png") -> None:
+    self.data = data
+    self.mime_type = mime_type if mime_type in self.SUFFIXES else "image/png"
+
+  @property
+  def suffix(self):
+    return self.SUFFIXES[self.mime_type]
+
+  @classmethod
+  def from_output(cls, output):
+    """Wrap an ImageModel.gen() result, encoding it to PNG once if the model returned a PIL image."""
+    if isinstance(output, cls):
+      return output
+    buffer = io.BytesIO()
+    output.save(buffer, format="PNG")
+    return cls(buffer.getvalue(), "image/png")
+
+
 class ImageModel(ABC):
   @abstractmethod
   def gen(self, prompt: str, ref_image: Image.Image = None):
+    """Return an EncodedImage (preferred, avoids re-encoding) or a PIL image."""
     pass
 
 
 class NanoBanana(ImageModel):
   def __init__(self) -> None:
+    from google import genai
     api_key = os.getenv("GOOGLE_API_KEY")
     if not api_key:
       raise RuntimeError("GOOGLE_API_KEY not set; place it in .env or your environment")
@@ -168,7 +386,8 @@ class NanoBanana(ImageModel):
       contents = [full_prompt]
       
     try:
-      response = self.client.models.generate_content(
+      response = PROVIDER_GUARDS["gemini"].call(
+          self.client.models.generate_content,
           model=self.model,
           contents=contents,
       )
@@ -182,7 +401,7 @@ class NanoBanana(ImageModel):
         logger.info(f"[NanoBanana] Using 'parts' attribute, count: {len(response.parts)}")
         for part in response.parts:
           if hasattr(part, 'inline_data') and part.inline_data is not None:
-            image = Image.open(io.BytesIO(part.inline_data.data))
+            image = EncodedImage(part.inline_data.data, part.inline_data.mime_type)
             logger.info("[NanoBanana] Found image in parts")
             break
       elif hasattr(response, 'candidates') and response.candidates:
@@ -192,7 +411,7 @@ class NanoBanana(ImageModel):
           if hasattr(candidate, 'content') and hasattr(candidate.content, 'parts'):
             for part in candidate.content.parts:
               if hasattr(part, 'inline_data') and part.inline_data is not None:
-                image = Image.open(io.BytesIO(part.inline_data.data))
+                image = EncodedImage(part.inline_data.data, part.inline_data.mime_type)
                 logger.info("[NanoBanana] Found image in candidates")
                 break
           if image is not None:
@@ -215,65 +434,205 @@ class GPTImage(ImageModel):
 
 
 class ThreeDModel(ABC):
+  # Provider inputs besides the image; part of the result cache key
+  params = {}
+
   @abstractmethod
   def gen(self, image: Image.Image):
     pass
 
-class HunYuan3d(ThreeDModel):
-  '''
-  Doesn't work rn.
-  '''
+  def gen_encoded(self, image_bytes: bytes):
+    """Generate from encoded image bytes. The default decodes them for gen()."""
+    from PIL import Image
+    with Image.open(io.BytesIO(image_bytes)) as img:
+      return self.gen(img)
+
+  async def gen_async(self, image_bytes: bytes):
+    """
+    Generate from encoded image bytes without holding a pipeline thread while the provider works.
+    The default runs gen_encoded() on the pipeline executor under the "three_d" concurrency limit.
+    """
+    return await pipeline_executor.run(self._gen_in_stage, image_bytes)
+
+  def _gen_in_stage(self, image_bytes: bytes):
+    with pipeline_executor.stage("three_d"):
+      return self.gen_encoded(image_bytes)
+
+
+class ReplicateThreeDModel(ThreeDModel):
+  """
+  A model served as a Replicate prediction. gen() blocks on replicate.run; gen_async() goes
+  through the prediction tracker, which polls or takes webhooks and cancels abandoned jobs.
+  """
+  # "owner/model:version_id"
+  version = None
+
   def __init__(self) -> None:
-    replicate_token = os.getenv("REPLICATE_API_KEY")
-    if not replicate_token:
-      raise RuntimeError("REPLICATE_API_KEY not set; place it in .env or your environment")
-    self.replicate_client = replicate.Client(api_token=replicate_token)
+    self.replicate_client = get_replicate_client()
+
+  def prediction_input(self, image_file):
+    """Replicate input for an encoded image file object (uploaded by the client)."""
+    return {"image": image_file, **self.params}
 
   def gen(self, image: Image.Image):
     buffer = io.BytesIO()
     image.save(buffer, format="PNG")
-    buffer.seek(0)
-    input = {
-      "image": buffer,  # file-like object will be uploaded by the client
-      "remove_background": False
-    }
+    return self.gen_encoded(buffer.getvalue())
 
-    output = self.replicate_client.run(
-      "ndreca/hunyuan3d-2.1:895e514f953d39e8b5bfb859df9313481ad3fa3a8631e5c54c7e5c9c85a6aa9f",
-      input=input
+  def gen_encoded(self, image_bytes: bytes):
+    # The image is already encoded, so it is uploaded as-is
+    name = type(self).__name__
+    logger.info(f"[{name}] Starting 3D model generation...")
+    logger.info(f"[{name}] Calling Replicate API...")
+    # A fresh file object per attempt, since a failed upload may have consumed it
+    output = PROVIDER_GUARDS["replicate"].call(
+      lambda: self.replicate_client.run(self.version, input=self.prediction_input(io.BytesIO(image_bytes)))
     )
+    logger.info(f"[{name}] Replicate returned: type={type(output)}")
+    logger.info(f"[{name}] Replicate output structure: {output}")
     return output
-  
 
-class Trellis(ThreeDModel):
-  def __init__(self):
-    replicate_token = os.getenv("REPLICATE_API_KEY")
-    if not replicate_token:
-      raise RuntimeError("REPLICATE_API_KEY not set; place it in .env or your environment")
-    self.replicate_client = replicate.Client(api_token=replicate_token)
+  async def gen_async(self, image_bytes: bytes):
+    output = await PROVIDER_GUARDS["replicate"].call_async(
+      lambda: prediction_tracker.run(
+        self.replicate_client,
+        self.version,
+        self.prediction_input(io.BytesIO(image_bytes)),
+        model=type(self).__name__.lower(),
+      )
+    )
+    logger.info(f"[{type(self).__name__}] Prediction output structure: {output}")
+    return output
+
+
+class HunYuan3d(ReplicateThreeDModel):
+  '''
+  Doesn't work rn.
+  '''
+  version = "ndreca/hunyuan3d-2.1:895e514f953d39e8b5bfb859df9313481ad3fa3a8631e5c54c7e5c9c85a6aa9f"
+  params = {
+    "remove_background": False,
+  }
+
+
+class Trellis(ReplicateThreeDModel):
+  version = "firtoz/trellis:e8f6c45206993f297372f5436b90350817bd9b4a0d52d2a76df50c1c8afa2b3c"
+  params = {
+    "texture_size": 2048,
+    "mesh_simplify": 0.9,
+    "generate_model": True,
+    "save_gaussian_ply": True,
+    "ss_sampling_steps": 38,
+  }
+
+  def prediction_input(self, image_file):
+    return {"images": [image_file], **self.params}
+
+
+class RoutedOutput:
+  """Provider output tagged with the backend that produced it, for results routed by RoutedThreeDModel."""
+
+  def __init__(self, backend: str, output) -> None:
+    self.backend = backend
+    self.output = output
+
+
+class RoutedThreeDModel(ThreeDModel):
+  """
+  three_d_model="auto": each request goes to the backend in three_d_router.backends with the best
+  expected completion time. If it fails, the next best is tried. On the async path, a backend still
+  running past its hedge threshold gets the next best started alongside it; the first to finish
+  wins and the other is cancelled (which cancels its Replicate prediction).
+  """
+
+  def __init__(self) -> None:
+    # Part of the cache key, so changing the backend set doesn't serve stale routed results
+    self.params = {"backends": list(three_d_router.backends)}
 
   def gen(self, image: Image.Image):
-    logger.info("[Trellis] Starting 3D model generation...")
     buffer = io.BytesIO()
     image.save(buffer, format="PNG")
-    buffer.seek(0)
-    input = {
-      "images": [buffer],  # file-like objects will be uploaded by the client
-      "texture_size": 2048,
-      "mesh_simplify": 0.9,
-      "generate_model": True,
-      "save_gaussian_ply": True,
-      "ss_sampling_steps": 38
-    }
+    return self.gen_encoded(buffer.getvalue())
 
-    logger.info("[Trellis] Calling Replicate API...")
-    output = self.replicate_client.run(
-        "firtoz/trellis:e8f6c45206993f297372f5436b90350817bd9b4a0d52d2a76df50c1c8afa2b3c",
-        input=input
-    )
-    logger.info(f"[Trellis] Replicate returned: type={type(output)}")
-    logger.info(f"[Trellis] Replicate output structure: {output}")
-    return output
+  def gen_encoded(self, image_bytes: bytes):
+    # Blocking provider calls can't be abandoned, so this path falls back but never hedges
+    three_d_router.count("routed")
+    error = None
+    for attempt, name in enumerate(three_d_router.ranked()):
+      if attempt:
+        three_d_router.count("fallbacks")
+        logger.warning(f"[RoutedThreeDModel] Falling back to {name} after: {error}")
+      three_d_router.started(name)
+      start = time.monotonic()
+      try:
+        output = get_three_d_model(name).gen_encoded(image_bytes)
+      except DeadlineExceeded:
+        three_d_router.finished(name, time.monotonic() - start, None)
+        raise
+      except Exception as e:
+        three_d_router.finished(name, time.monotonic() - start, False)
+        error = e
+        continue
+      three_d_router.finished(name, time.monotonic() - start, True)
+      return RoutedOutput(name, output)
+    raise error or RuntimeError("No 3D backends configured for routing")
+
+  async def _attempt(self, name: str, image_bytes: bytes):
+    model = await pipeline_executor.run(get_three_d_model, name)
+    return await model.gen_async(image_bytes)
+
+  async def gen_async(self, image_bytes: bytes):
+    three_d_router.count("routed")
+    candidates = three_d_router.ranked()
+    if not candidates:
+      raise RuntimeError("No 3D backends configured for routing")
+    running = {}
+    error = None
+
+    def launch():
+      name = candidates.pop(0)
+      three_d_router.started(name)
+      running[asyncio.ensure_future(self._attempt(name, image_bytes))] = (name, time.monotonic())
+      logger.info(f"[RoutedThreeDModel] Routing to {name}")
+
+    launch()
+    try:
+      while running:
+        timeout = None
+        if candidates and len(running) == 1:
+          # Hedge the only attempt once it runs past its backend's threshold
+          name, start = next(iter(running.values()))
+          timeout = max(0.0, start + three_d_router.hedge_after(name) - time.monotonic())
+        done, _ = await asyncio.wait(set(running), timeout=timeout, return_when=asyncio.FIRST_COMPLETED)
+        if not done:
+          three_d_router.count("hedged")
+          logger.warning(f"[RoutedThreeDModel] {name} is past {three_d_router.hedge_after(name):.1f}s, hedging")
+          launch()
+          continue
+        for task in done:
+          name, start = running.pop(task)
+          try:
+            output = task.result()
+          except DeadlineExceeded:
+            three_d_router.finished(name, time.monotonic() - start, None)
+            raise
+          except Exception as e:
+            three_d_router.finished(name, time.monotonic() - start, False)
+            error = e
+            if not running and candidates:
+              three_d_router.count("fallbacks")
+              logger.warning(f"[RoutedThreeDModel] {name} failed ({e}), falling back")
+              launch()
+            continue
+          three_d_router.finished(name, time.monotonic() - start, True)
+          if running:
+            three_d_router.count("hedge_wins")
+          return RoutedOutput(name, output)
+      raise error
+    finally:
+      for task, (name, start) in running.items():
+        task.cancel()
+        three_d_router.finished(name, time.monotonic() - start, None)
 
 
 IMAGE_MODELS = {
@@ -284,83 +643,528 @@ IMAGE_MODELS = {
 THREE_D_MODELS = {
   "hunyuan3d": HunYuan3d,
   "trellis": Trellis,
+  "auto": RoutedThreeDModel,
 }
 
+_model_instances = {}
+
+
+def _get_model(registry: dict, kind: str, name: str):
+  """Return the process-wide instance of a registered model, creating it on first use."""
+  key = (kind, name.lower())
+  with _client_lock:
+    model = _model_instances.get(key)
+  if model is not None:
+    return model
+
+  model_cls = registry.get(name.lower())
+  if not model_cls:
+    raise ValueError(f"Unknown {kind} model '{name}'. Options: {list(registry)}")
+  model = model_cls()
+  with _client_lock:
+    # Another thread may have won the race; keep the first instance
+    return _model_instances.setdefault(key, model)
+
+
+def get_image_model(name: str):
+  return _get_model(IMAGE_MODELS, "image", name)
+
 
-def generate_image(prompt: str, image_model_name: str = "nanobanana", ref_image_data: bytes = None):
+def get_three_d_model(name: str):
+  return _get_model(THREE_D_MODELS, "3D", name)
+
+
+# Loaded on first use by the code above; imported ahead of time by prewarm_imports()
+LAZY_IMPORTS = ("requests", "PIL.Image", "numpy", "mesh_inspect", "mesh_postprocess", "mesh_preview", "google.genai", "replicate")
+
+
+def prewarm_imports():
   """
-  Generate an image based on prompt and optional reference image.
-  Returns the path to the saved image file.
+  Import the modules the pipeline otherwise loads on first use, and PIL's format plugins.
+  Run before forking workers (gunicorn preload_app) so they share the loaded code copy-on-write.
+  """
+  for name in LAZY_IMPORTS:
+    importlib.import_module(name)
+  from PIL import Image
+  Image.init()
+
+
+def warm_up_models(image_models=("nanobanana",), three_d_models=("trellis",)):
+  """
+  Build the shared HTTP session and provider clients ahead of the first request.
+  Models that can't be created (e.g. a missing API key) are logged and skipped.
+  """
+  get_http_session()
+  for getter, names in ((get_image_model, image_models), (get_three_d_model, three_d_models)):
+    for name in names:
+      try:
+        getter(name)
+        logger.info(f"[warm_up_models] Warmed up '{name}'")
+      except Exception as e:
+        logger.warning(f"[warm_up_models] Could not warm up '{name}': {e}")
+
+
+def _hold_3d_files(result: dict):
+  """Pin a (possibly shared) 3D result's files to the current lease(s)."""
+  previews = [result[key]["path"] for key in PREVIEW_KEYS if key in result]
+  for relative in [result["path"]] + [lod["path"] for lod in result.get("lods", [])] + previews:
+    output_storage.hold(relative)
+
+
+def _index_model(image_path_str: str, three_d_model_name: str, result: dict):
+  """Attach a 3D result to the prompt-index entry of the image it was made from, if that image has one."""
+  try:
+    model = {key: value for key, value in result.items() if key != "cached"}
+    prompt_index.attach_model(Path(image_path_str).stem, result.get("backend", three_d_model_name), model)
+  except Exception as e:
+    logger.error(f"[generate_3d] Could not index model {result.get('path')}: {e}")
+
+
+def find_similar(prompt: str, image_model_name: str = None, three_d_model_name: str = None, limit: int = 5, min_similarity: float = 0.3):
+  """
+  Earlier generations for prompts similar to `prompt` whose files are still stored, most similar
+  first (see PromptIndex.search). With three_d_model_name, only entries with a model from that
+  backend ("auto": any backend) are returned, and "models" is narrowed to it.
+  """
+  three_d_model_name = three_d_model_name.lower() if three_d_model_name else None
+  found = []
+  for match in prompt_index.search(prompt, image_model_name, limit=limit * 4, min_similarity=min_similarity):
+    image_relative = output_storage.relative_to_root(match["image"]["path"])
+    if image_relative is None or not (OUTPUT_DIR / image_relative).exists():
+      # The image was evicted, so the entry can't be offered again
+      prompt_index.remove(match["id"])
+      continue
+    models = {
+      name: model for name, model in match["models"].items()
+      if (OUTPUT_DIR / model["path"]).exists() and three_d_model_name in (None, "auto", name)
+    }
+    if three_d_model_name and not models:
+      continue
+    found.append({**match, "models": models})
+    if len(found) == limit:
+      break
+  return found
+
+
+def _find_reusable(prompt: str, image_model_name: str, three_d_model_name: str, lods: bool, threshold: float):
+  """
+  The most similar earlier generation at or above `threshold` that can stand in for this request,
+  as (match, 3D result) with its files held by the current lease, or None.
+  """
+  for match in find_similar(prompt, image_model_name, three_d_model_name, min_similarity=threshold):
+    for model in match["models"].values():
+      if lods and not model.get("lods"):
+        continue
+      _hold_3d_files(model)
+      output_storage.hold(output_storage.relative_to_root(match["image"]["path"]))
+      return match, model
+  return None
+
+
+def upload_guard(url: str):
+  """The upload guard for url's host; retried, but not rate limited unless UPLOAD_RATE_LIMIT is set."""
+  host = urlsplit(url).netloc.lower()
+  with _upload_guards_lock:
+    guard = _upload_guards.get(host)
+    if guard is None:
+      guard = ProviderGuard.from_env("upload", is_retryable_provider_error, rate=0, burst=0)
+      guard.name = guard.breaker.name = f"upload:{host}"
+      _upload_guards[host] = guard
+      while len(_upload_guards) > UPLOAD_GUARD_HOSTS:
+        _upload_guards.popitem(last=False)
+    _upload_guards.move_to_end(host)
+    return guard
+
+
+def provider_guards():
+  """Every provider guard by name, the per-host upload guards included."""
+  with _upload_guards_lock:
+    uploads = {guard.name: guard for guard in _upload_guards.values()}
+  return {**PROVIDER_GUARDS, **uploads}
+
+
+def upload_output(url: str, entry: dict, artifact: str, data: bytes = None):
+  """
+  Stream one output to a pre-signed upload URL (e.g. from Convex's generateUploadUrl) and return
+  the storage id it was saved under. `entry` is an image result, a 3D result or one of its
+  previews. Pass data to send bytes that are still being written to disk instead of the file.
+  """
+  import requests
+  relative = entry["url"].removeprefix("/files/") if "url" in entry else entry["path"]
+  path = OUTPUT_DIR / relative
+  content_type = media_type_for(path)
+  guard = upload_guard(url)
+  with timed_stage("upload", artifact):
+    try:
+      if data is not None:
+        return guard.call(upload_bytes, get_http_session(), url, data, content_type)
+      return guard.call(upload_file, get_http_session(), url, path, content_type)
+    except requests.RequestException as e:
+      raise UploadError(f"Uploading the {artifact} failed: {e}") from e
+
+
+async def upload_3d_outputs(result: dict, uploads: dict):
+  """
+  Upload a 3D result's files to {"model" | "thumbnail" | "turntable": url} in parallel and return
+  a copy of the result with a "storage_id" on each uploaded entry. Preview URLs are skipped when
+  that preview wasn't rendered.
+  """
+  entries = {"model": result, **{key: result[key] for key in PREVIEW_KEYS if key in result}}
+  targets = [(artifact, url) for artifact, url in uploads.items() if artifact in entries]
+  storage_ids = await asyncio.gather(*(
+    pipeline_executor.run(upload_output, url, entries[artifact], artifact) for artifact, url in targets
+  ))
+  result = dict(result)
+  for (artifact, _), storage_id in zip(targets, storage_ids):
+    if artifact == "model":
+      result["storage_id"] = storage_id
+    else:
+      result[artifact] = {**result[artifact], "storage_id": storage_id}
+  return result
+
+
+def _persist_image(encoded: EncodedImage, file_id: str, relative: str, path: Path, cache_key: str, image_model_name: str, prompt: str = None):
+  with timed_stage("image_save", image_model_name):
+    tmp_path = path.with_name(f".{path.name}.part")
+    tmp_path.write_bytes(encoded.data)
+    os.replace(tmp_path, path)
+  output_storage.register(relative)
+  result = {"id": file_id, "url": f"/files/{relative}", "path": str(path)}
+  result_cache.put("image", cache_key, result, [relative])
+  if prompt is not None:
+    try:
+      prompt_index.add(prompt, image_model_name, result)
+    except Exception as e:
+      # Suggestions are a convenience; the image itself is fine
+      logger.error(f"[generate_image] Could not index prompt for {relative}: {e}")
+
+
+def _generate_encoded_image(prompt: str, image_model_name: str = "nanobanana", ref_image_data: bytes = None, use_cache: bool = True):
+  """
+  Generate an image and start writing it to disk in the background.
+  Returns (result, encoded bytes or None on a cache hit, Future of the write), so the next
+  stage can use the provider's bytes while they are being persisted. The result's path is
+  only readable once the Future has completed.
   """
   logger.info(f"[generate_image] Starting: prompt='{prompt[:50]}...', model={image_model_name}, has_ref={ref_image_data is not None}")
-  
-  image_model_cls = IMAGE_MODELS.get(image_model_name.lower())
-  if not image_model_cls:
-    raise ValueError(f"Unknown image model '{image_model_name}'. Options: {list(IMAGE_MODELS)}")
 
-  image_model = image_model_cls()
+  cache_key = make_key("image", prompt, KEYCAP_SYSTEM_PROMPT, image_model_name.lower(), hash_bytes(ref_image_data))
+  if not use_cache:
+    return _create_image(prompt, image_model_name, ref_image_data, cache_key)
+
+  cached = result_cache.get("image", cache_key)
+  if cached is not None:
+    logger.info(f"[generate_image] Cache hit: {cached['path']}")
+    written = Future()
+    written.set_result(None)
+    return cached, None, written
+
+  # Identical requests already in flight share one provider call (bypass_cache opts out, like the cache)
+  result, data, written = request_coalescer.do(
+    "image", cache_key, _create_image, prompt, image_model_name, ref_image_data, cache_key
+  )
+  output_storage.hold(output_storage.relative_to_root(result["path"]))
+  return dict(result), data, written
+
+
+def _create_image(prompt: str, image_model_name: str, ref_image_data: bytes, cache_key: str):
+  image_model = get_image_model(image_model_name)
   
   ref_image = None
   if ref_image_data:
+    from PIL import Image
     ref_image = Image.open(io.BytesIO(ref_image_data))
 
-  generated_image = image_model.gen(prompt, ref_image=ref_image)
-  
-  # Save generated image
-  file_id = uuid.uuid4().hex
-  filename = f"{file_id}.png"
-  path = OUTPUT_DIR / filename
-  generated_image.save(path, format="PNG")
+  with pipeline_executor.stage("image"), timed_stage("image_gen", image_model_name):
+    encoded = EncodedImage.from_output(image_model.gen(prompt, ref_image=ref_image))
   
-  return {"id": file_id, "url": f"/files/{filename}", "path": str(path)}
+  # Save generated image off the critical path; the bytes are written exactly as received
+  file_id, relative, path = output_storage.new_file(encoded.suffix)
+  # Only text-only images are indexed by prompt; with a reference image the prompt alone doesn't describe them
+  written = _persist_pool.submit(
+    contextvars.copy_context().run, _persist_image, encoded, file_id, relative, path, cache_key, image_model_name,
+    prompt if ref_image_data is None else None,
+  )
+  result = {"id": file_id, "url": f"/files/{relative}", "path": str(path)}
+  return result, encoded.data, written
+
+
+@output_storage.leased
+def generate_image(prompt: str, image_model_name: str = "nanobanana", ref_image_data: bytes = None, use_cache: bool = True, upload_url: str = None):
+  """
+  Generate an image based on prompt and optional reference image.
+  Returns the path to the saved image file.
+  Identical requests are served from the result cache, or share a call already in flight,
+  unless use_cache is False.
+  With upload_url, the image is also uploaded there and its storage id returned as "storage_id".
+  """
+  result, data, written = _generate_encoded_image(prompt, image_model_name, ref_image_data, use_cache)
+  if upload_url:
+    # Sent from memory while the background write is still going
+    result = {**result, "storage_id": upload_output(upload_url, result, "image", data)}
+  written.result()
+  return result
+
+
+def _load_3d_input(image_path_str: str, three_d_model, three_d_model_name: str, lods: bool, image_bytes: bytes = None):
+  """
+  Resolve and read the input image, unless its bytes were handed over in memory.
+  Returns (image_bytes, cache_key).
+  """
+  if image_bytes is None:
+    # Handle both absolute paths and relative paths within OUTPUT_DIR
+    image_path = Path(image_path_str)
+    if not image_path.exists():
+       # Try relative to OUTPUT_DIR if not absolute or relative to cwd
+       image_path = OUTPUT_DIR / image_path_str
+       
+    if not image_path.exists():
+        raise FileNotFoundError(f"Image file not found: {image_path_str}")
 
+    # Keep the input image from being evicted while this call uses it
+    image_relative = output_storage.relative_to_root(image_path)
+    if image_relative is not None:
+      output_storage.hold(image_relative)
 
-def generate_3d(image_path_str: str, three_d_model_name: str = "trellis"):
+    image_bytes = image_path.read_bytes()
+  cache_key = make_key("3d", hash_bytes(image_bytes), three_d_model_name.lower(), three_d_model.params, lods)
+  return image_bytes, cache_key
+
+
+def _finish_3d(raw_output, three_d_model_name: str, cache_key: str, lods: bool):
+  """Save the provider output, run the optional post-processing and cache the result."""
+  backend = three_d_model_name
+  if isinstance(raw_output, RoutedOutput):
+    backend, raw_output = raw_output.backend, raw_output.output
+  with timed_stage("materialize", backend):
+    result = materialize_model_output(raw_output)
+  # The backend that actually produced the mesh (differs from the requested name for "auto")
+  result["backend"] = backend
+  if MESH_VALIDATION:
+    result = validate_model_output(result, backend)
+
+  model_dir = Path(result["path"]).parent
+  if lods:
+    try:
+      from mesh_postprocess import generate_lods
+      with timed_stage("postprocess", three_d_model_name):
+        result["lods"] = generate_lods(OUTPUT_DIR / result["path"])
+      for lod in result["lods"]:
+        lod["path"] = str(model_dir / lod["path"])
+        output_storage.register(lod["path"])
+    except Exception as e:
+      # LODs are an optimisation; the full model is still usable without them
+      logger.error(f"[generate_3d] LOD generation failed for {result['path']}: {e}")
+      result["lods"] = []
+
+  files = [result["path"]] + [lod["path"] for lod in result.get("lods", [])]
+  if PRECOMPRESS_OUTPUTS:
+    with timed_stage("precompress", three_d_model_name):
+      variants = [str(Path(name).parent / variant) for name in files for variant in precompress(OUTPUT_DIR / name)]
+    for variant in variants:
+      output_storage.register(variant)
+    files += variants
+
+  if MESH_PREVIEWS:
+    try:
+      from mesh_preview import generate_previews
+      with timed_stage("preview", backend):
+        previews = generate_previews(OUTPUT_DIR / result["path"])
+      for key, preview in previews.items():
+        preview["path"] = str(model_dir / preview["path"])
+        preview["url"] = f"/files/{preview['path']}"
+        output_storage.register(preview["path"])
+        files.append(preview["path"])
+        result[key] = preview
+    except Exception as e:
+      # Previews are a convenience for the gallery; the model itself is fine without them
+      logger.error(f"[generate_3d] Preview rendering failed for {result['path']}: {e}")
+  result_cache.put("3d", cache_key, result, files)
+  return result
+
+
+@output_storage.leased
+def generate_3d(image_path_str: str, three_d_model_name: str = "trellis", use_cache: bool = True, lods: bool = False, image_bytes: bytes = None):
   """
   Generate a 3D model from an existing image file path.
+  Identical image/model/parameter combinations are served from the result cache, or share a call
+  already in flight, unless use_cache is False.
+  With lods=True, lighter LOD variants are written next to the model and listed under "lods".
+  Pass image_bytes to use the image's encoded bytes already in memory instead of reading the file.
   """
   logger.info(f"[generate_3d] Starting: image_path={image_path_str}, model={three_d_model_name}")
   
-  three_d_model_cls = THREE_D_MODELS.get(three_d_model_name.lower())
-  if not three_d_model_cls:
-    raise ValueError(f"Unknown 3D model '{three_d_model_name}'. Options: {list(THREE_D_MODELS)}")
+  three_d_model = get_three_d_model(three_d_model_name)
+  image_bytes, cache_key = _load_3d_input(image_path_str, three_d_model, three_d_model_name, lods, image_bytes)
+  if use_cache:
+    cached = result_cache.get("3d", cache_key)
+    if cached is not None:
+      logger.info(f"[generate_3d] Cache hit: {cached['path']}")
+      return cached
 
-  three_d_model = three_d_model_cls()
-  
-  # Load image
-  # Handle both absolute paths and relative paths within OUTPUT_DIR
-  image_path = Path(image_path_str)
-  if not image_path.exists():
-     # Try relative to OUTPUT_DIR if not absolute or relative to cwd
-     image_path = OUTPUT_DIR / image_path_str
-     
-  if not image_path.exists():
-      raise FileNotFoundError(f"Image file not found: {image_path_str}")
-
-  with Image.open(image_path) as img:
-      raw_output = three_d_model.gen(img)
-      
-  result = materialize_model_output(raw_output)
+  if not use_cache:
+    result = _create_3d(three_d_model, three_d_model_name, image_bytes, cache_key, lods)
+  else:
+    # Identical requests already in flight share one provider call
+    result = request_coalescer.do("3d", cache_key, _create_3d, three_d_model, three_d_model_name, image_bytes, cache_key, lods)
+    _hold_3d_files(result)
+    result = dict(result)
+  _index_model(image_path_str, three_d_model_name, result)
   return result
 
 
-def run_pipeline(prompt: str, image_model_name: str = "nanobanana", three_d_model_name: str = "trellis"):
+def _create_3d(three_d_model, three_d_model_name: str, image_bytes: bytes, cache_key: str, lods: bool):
+  with pipeline_executor.stage("three_d"), timed_stage("three_d_gen", three_d_model_name):
+    raw_output = three_d_model.gen_encoded(image_bytes)
+  return _finish_3d(raw_output, three_d_model_name, cache_key, lods)
+
+
+async def _create_3d_async(three_d_model, three_d_model_name: str, image_bytes: bytes, cache_key: str, lods: bool):
+  # Its own lease, since the task may outlive the caller that started it when it is shared
+  with output_storage.lease():
+    with timed_stage("three_d_gen", three_d_model_name):
+      raw_output = await three_d_model.gen_async(image_bytes)
+    return await pipeline_executor.run(_finish_3d, raw_output, three_d_model_name, cache_key, lods)
+
+
+async def generate_3d_async(image_path_str: str, three_d_model_name: str = "trellis", use_cache: bool = True, lods: bool = False, image_bytes: bytes = None, uploads: dict = None):
+  """
+  generate_3d for the event loop. File and cache work runs on the pipeline executor, while the
+  provider call is awaited through ThreeDModel.gen_async, so a Replicate prediction holds no
+  thread while it queues and runs. Cancelling the caller cancels the remote prediction.
+  Pass image_bytes to use an image still being written to image_path_str without reading it back.
+  uploads ({"model": url, "thumbnail": url, ...}) streams the outputs to storage; see upload_3d_outputs.
+  """
+  logger.info(f"[generate_3d_async] Starting: image_path={image_path_str}, model={three_d_model_name}")
+
+  with output_storage.lease():
+    three_d_model = await pipeline_executor.run(get_three_d_model, three_d_model_name)
+    image_bytes, cache_key = await pipeline_executor.run(
+      _load_3d_input, image_path_str, three_d_model, three_d_model_name, lods, image_bytes
+    )
+    result = None
+    if use_cache:
+      result = await pipeline_executor.run(result_cache.get, "3d", cache_key)
+      if result is not None:
+        logger.info(f"[generate_3d_async] Cache hit: {result['path']}")
+        _hold_3d_files(result)
+
+    if result is None and not use_cache:
+      result = await _create_3d_async(three_d_model, three_d_model_name, image_bytes, cache_key, lods)
+    elif result is None:
+      # Identical requests already in flight share one prediction
+      result = await request_coalescer.do_async(
+        "3d", cache_key, _create_3d_async, three_d_model, three_d_model_name, image_bytes, cache_key, lods
+      )
+      _hold_3d_files(result)
+      result = dict(result)
+    if not result.get("cached"):
+      await pipeline_executor.run(_index_model, image_path_str, three_d_model_name, result)
+
+    if uploads:
+      # Inside the lease, so eviction can't remove the files mid-upload
+      result = await upload_3d_outputs(result, uploads)
+    return result
+
+
+@output_storage.leased
+def run_pipeline(prompt: str, image_model_name: str = "nanobanana", three_d_model_name: str = "trellis", on_stage=None, use_cache: bool = True, lods: bool = False):
   '''
   Input the specific models you want and it will run the pipeline with those.
+  on_stage(stage, data) is called after each step ("image_done", "mesh_done") if given.
+  use_cache=False forces a fresh image (and therefore a fresh mesh) for a new variation.
+  lods=True adds the mesh post-processing stage (see generate_3d).
   '''
   logger.info(f"[run_pipeline] Starting pipeline: prompt='{prompt[:50]}...', image_model={image_model_name}, 3d_model={three_d_model_name}")
-  
+
   # Step 1: Generate Image
-  image_result = generate_image(prompt, image_model_name)
+  image_result, image_bytes, image_written = _generate_encoded_image(prompt, image_model_name, use_cache=use_cache)
   image_path = image_result["path"]
-  
+  image_written.result()
+  if on_stage:
+    on_stage("image_done", image_result)
+
   logger.info(f"[run_pipeline] Image generated at {image_path}, generating 3D model...")
-  
-  # Step 2: Generate 3D
-  result = generate_3d(image_path, three_d_model_name)
-  
+
+  # Step 2: Generate 3D, from the bytes already in memory
+  result = generate_3d(image_path, three_d_model_name, use_cache=use_cache, lods=lods, image_bytes=image_bytes)
+  if on_stage:
+    on_stage("mesh_done", dict(result))
+
   # Attach the intermediate image info to the result for completeness
   result["source_image"] = image_result
   
   logger.info(f"[run_pipeline] Pipeline completed: {result}")
   return result
+
+
+async def _reuse_similar(match: dict, model: dict, on_stage=None, uploads: dict = None):
+  """Serve an earlier prompt's image and model as this request's result, uploading them if asked."""
+  uploads = dict(uploads or {})
+  image_result = {key: match["image"][key] for key in ("id", "url", "path")}
+  if on_stage:
+    on_stage("image_done", image_result)
+  result = {**model, "cached": True}
+  if "image" in uploads:
+    image_result["storage_id"] = await pipeline_executor.run(upload_output, uploads.pop("image"), image_result, "image")
+  if uploads:
+    result = await upload_3d_outputs(result, uploads)
+  if on_stage:
+    on_stage("mesh_done", dict(result))
+  result["source_image"] = image_result
+  result["similar_to"] = {"prompt": match["prompt"], "similarity": match["similarity"]}
+  return result
+
+
+async def run_pipeline_async(prompt: str, image_model_name: str = "nanobanana", three_d_model_name: str = "trellis", on_stage=None, use_cache: bool = True, lods: bool = False, uploads: dict = None, reuse_similar: bool = False, similarity_threshold: float = None):
+  '''
+  run_pipeline for the event loop: the image step runs on the pipeline executor and the 3D step
+  through generate_3d_async, so no thread is held while the 3D provider works.
+  uploads maps artifacts in UPLOAD_ARTIFACTS to pre-signed upload URLs; each uploaded output gets
+  a "storage_id" (the image's under "source_image").
+  With reuse_similar (and use_cache), a model already generated for a prompt at least
+  similarity_threshold (default SIMILAR_REUSE_THRESHOLD) similar to this one is returned instead,
+  with "similar_to": {"prompt", "similarity"}.
+  '''
+  logger.info(f"[run_pipeline_async] Starting pipeline: prompt='{prompt[:50]}...', image_model={image_model_name}, 3d_model={three_d_model_name}")
+
+  uploads = dict(uploads or {})
+  with output_storage.lease():
+    if reuse_similar and use_cache:
+      threshold = SIMILAR_REUSE_THRESHOLD if similarity_threshold is None else similarity_threshold
+      reusable = await pipeline_executor.run(_find_reusable, prompt, image_model_name, three_d_model_name, lods, threshold)
+      if reusable is not None:
+        logger.info(f"[run_pipeline_async] Reusing the result for a similar prompt: '{reusable[0]['prompt'][:50]}...' ({reusable[0]['similarity']})")
+        return await _reuse_similar(*reusable, on_stage=on_stage, uploads=uploads)
+
+    image_upload_url = uploads.pop("image", None)
+    image_result, image_bytes, image_written = await pipeline_executor.run(
+      _generate_encoded_image, prompt, image_model_name, use_cache=use_cache
+    )
+    # The 3D stage starts on the provider's bytes while the image is still being written
+    three_d = asyncio.ensure_future(
+      generate_3d_async(image_result["path"], three_d_model_name, use_cache=use_cache, lods=lods, image_bytes=image_bytes, uploads=uploads)
+    )
+    # ...and so does the image's own upload
+    image_upload = None
+    if image_upload_url:
+      image_upload = asyncio.ensure_future(
+        pipeline_executor.run(upload_output, image_upload_url, image_result, "image", image_bytes)
+      )
+    try:
+      await asyncio.wrap_future(image_written)
+      if on_stage:
+        on_stage("image_done", image_result)
+      result = await three_d
+      if image_upload is not None:
+        image_result = {**image_result, "storage_id": await image_upload}
+    finally:
+      three_d.cancel()
+      if image_upload is not None:
+        image_upload.cancel()
+    if on_stage:
+      on_stage("mesh_done", dict(result))
+
+  result["source_image"] = image_result
+  logger.info(f"[run_pipeline_async] Pipeline completed: {result}")
+  return result
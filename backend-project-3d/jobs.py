@@ -0,0 +1,331 @@
+"""
+Background job subsystem for the generation pipeline.
+
+`POST /jobs` hands a pipeline run to a JobManager, which returns a job id
+immediately and executes the pipeline off the request. Job state and stage
+transitions (image_done, mesh_done, ...) are kept in a pluggable JobStore so
+that any worker can answer `GET /jobs/{id}` and stream `/jobs/{id}/events`.
+"""
+
+import asyncio
+import json
+import logging
+import os
+import socket
+import sqlite3
+import threading
+import time
+import uuid
+from abc import ABC, abstractmethod
+from pathlib import Path
+
+logger = logging.getLogger(__name__)
+
+TERMINAL_STATUSES = ("succeeded", "failed")
+EVENT_POLL_INTERVAL = 0.5
+
+
+def _read_boot_id():
+    try:
+        with open("/proc/sys/kernel/random/boot_id") as f:
+            return f.read().strip()
+    except OSError:
+        return socket.gethostname()
+
+
+_BOOT_ID = _read_boot_id()
+
+
+def _process_start(pid: int):
+    """Start time of a running process ("" where /proc isn't available), or None if it isn't running."""
+    try:
+        with open(f"/proc/{pid}/stat") as f:
+            # Fields after the parenthesised command name; starttime is field 22 of the whole line
+            return f.read().rsplit(")", 1)[1].split()[19]
+    except FileNotFoundError:
+        return None
+    except OSError:
+        pass
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return None
+    except PermissionError:
+        pass
+    return ""
+
+
+def process_owner():
+    """This worker's identity: host boot, pid and process start time, so a reused pid never matches."""
+    pid = os.getpid()
+    return f"{_BOOT_ID}:{pid}:{_process_start(pid)}"
+
+
+def owner_alive(owner: str):
+    """Whether the worker that recorded `owner` (see process_owner) is still running."""
+    boot_id, pid, start = owner.rsplit(":", 2)
+    return boot_id == _BOOT_ID and _process_start(int(pid)) == start
+
+
+def _new_job(params: dict):
+    now = time.time()
+    return {
+        "id": uuid.uuid4().hex,
+        "owner": process_owner(),
+        "status": "queued",
+        "params": params,
+        "result": None,
+        "error": None,
+        "events": [{"stage": "queued", "at": now, "data": None}],
+        "created_at": now,
+        "updated_at": now,
+    }
+
+
+class JobStore(ABC):
+    @abstractmethod
+    def create(self, job: dict):
+        pass
+
+    @abstractmethod
+    def get(self, job_id: str):
+        """Return the job dict, or None if it does not exist."""
+        pass
+
+    @abstractmethod
+    def update(self, job_id: str, **fields):
+        pass
+
+    @abstractmethod
+    def add_event(self, job_id: str, stage: str, data: dict = None):
+        pass
+
+    @abstractmethod
+    def list_unfinished(self):
+        pass
+
+
+class InMemoryJobStore(JobStore):
+    """Process-local store. Jobs are lost when the worker restarts."""
+
+    def __init__(self) -> None:
+        self._jobs = {}
+        self._lock = threading.Lock()
+
+    def create(self, job: dict):
+        with self._lock:
+            self._jobs[job["id"]] = job
+
+    def get(self, job_id: str):
+        with self._lock:
+            job = self._jobs.get(job_id)
+            if job is None:
+                return None
+            # Copy so callers never observe a half-applied update
+            return {**job, "events": list(job["events"])}
+
+    def update(self, job_id: str, **fields):
+        with self._lock:
+            job = self._jobs[job_id]
+            job.update(fields)
+            job["updated_at"] = time.time()
+
+    def add_event(self, job_id: str, stage: str, data: dict = None):
+        with self._lock:
+            job = self._jobs[job_id]
+            now = time.time()
+            job["events"].append({"stage": stage, "at": now, "data": data})
+            job["updated_at"] = now
+
+    def list_unfinished(self):
+        with self._lock:
+            return [dict(job) for job in self._jobs.values() if job["status"] not in TERMINAL_STATUSES]
+
+
+class SQLiteJobStore(JobStore):
+    """Durable store backed by a single SQLite file, shared by all workers on the host."""
+
+    _JSON_FIELDS = ("params", "result", "events")
+
+    def __init__(self, path) -> None:
+        self.path = Path(path)
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        self._lock = threading.Lock()
+        self._conn = None
+        self._conn_pid = None
+        self._connection().execute("PRAGMA journal_mode=WAL")
+        self._connection().execute(
+            """
+            CREATE TABLE IF NOT EXISTS jobs (
+                id TEXT PRIMARY KEY,
+                status TEXT NOT NULL,
+                params TEXT,
+                result TEXT,
+                error TEXT,
+                events TEXT NOT NULL,
+                created_at REAL NOT NULL,
+                updated_at REAL NOT NULL,
+                owner TEXT
+            )
+            """
+        )
+        self._connection().execute("CREATE INDEX IF NOT EXISTS jobs_status ON jobs (status)")
+        columns = {row["name"] for row in self._connection().execute("PRAGMA table_info(jobs)")}
+        if "owner" not in columns:
+            try:
+                self._connection().execute("ALTER TABLE jobs ADD COLUMN owner TEXT")
+            except sqlite3.OperationalError:
+                # Another worker added it first
+                pass
+
+    def _connection(self):
+        """This process's connection; one opened before a fork (gunicorn preload_app) is never reused."""
+        if self._conn_pid != os.getpid():
+            self._conn = sqlite3.connect(str(self.path), check_same_thread=False, isolation_level=None)
+            self._conn.row_factory = sqlite3.Row
+            self._conn_pid = os.getpid()
+        return self._conn
+
+    def _row_to_job(self, row):
+        job = dict(row)
+        for field in self._JSON_FIELDS:
+            job[field] = json.loads(job[field]) if job[field] is not None else None
+        return job
+
+    def create(self, job: dict):
+        with self._lock:
+            self._connection().execute(
+                "INSERT INTO jobs (id, status, params, result, error, events, created_at, updated_at, owner) "
+                "VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                (
+                    job["id"], job["status"], json.dumps(job["params"]), json.dumps(job["result"]),
+                    job["error"], json.dumps(job["events"]), job["created_at"], job["updated_at"], job.get("owner"),
+                ),
+            )
+
+    def get(self, job_id: str):
+        with self._lock:
+            row = self._connection().execute("SELECT * FROM jobs WHERE id = ?", (job_id,)).fetchone()
+        return self._row_to_job(row) if row else None
+
+    def update(self, job_id: str, **fields):
+        fields["updated_at"] = time.time()
+        columns = ", ".join(f"{name} = ?" for name in fields)
+        values = [json.dumps(v) if k in self._JSON_FIELDS else v for k, v in fields.items()]
+        with self._lock:
+            self._connection().execute(f"UPDATE jobs SET {columns} WHERE id = ?", (*values, job_id))
+
+    def add_event(self, job_id: str, stage: str, data: dict = None):
+        now = time.time()
+        with self._lock:
+            # Read-modify-write inside one transaction so concurrent workers don't drop events
+            self._connection().execute("BEGIN IMMEDIATE")
+            try:
+                row = self._connection().execute("SELECT events FROM jobs WHERE id = ?", (job_id,)).fetchone()
+                events = json.loads(row["events"])
+                events.append({"stage": stage, "at": now, "data": data})
+                self._connection().execute(
+                    "UPDATE jobs SET events = ?, updated_at = ? WHERE id = ?",
+                    (json.dumps(events), now, job_id),
+                )
+                self._connection().execute("COMMIT")
+            except Exception:
+                self._connection().execute("ROLLBACK")
+                raise
+
+    def list_unfinished(self):
+        placeholders = ", ".join("?" for _ in TERMINAL_STATUSES)
+        with self._lock:
+            rows = self._connection().execute(
+                f"SELECT * FROM jobs WHERE status NOT IN ({placeholders})", TERMINAL_STATUSES
+            ).fetchall()
+        return [self._row_to_job(row) for row in rows]
+
+
+def make_job_store(state_dir: Path):
+    """Build the store selected by JOB_STORE ("sqlite" by default, or "memory")."""
+    kind = os.getenv("JOB_STORE", "sqlite").lower()
+    if kind == "memory":
+        return InMemoryJobStore()
+    if kind == "sqlite":
+        return SQLiteJobStore(os.getenv("JOB_DB_PATH", str(Path(state_dir) / "jobs.sqlite3")))
+    raise ValueError(f"Unknown JOB_STORE '{kind}'. Options: ['memory', 'sqlite']")
+
+
+class JobManager:
+    """
+    Runs pipeline jobs in the background and records their progress in a JobStore.
+    `runner(on_stage=..., **params)` is a coroutine function, admitted through `executor.run_async`.
+    """
+
+    def __init__(self, store: JobStore, runner, executor) -> None:
+        self.store = store
+        self.runner = runner
+        self.executor = executor
+        self._tasks = set()
+
+    def submit(self, params: dict):
+        # Reject up front rather than accepting a job that can't be scheduled
+        self.executor.check_capacity()
+        job = _new_job(params)
+        self.store.create(job)
+        task = asyncio.get_running_loop().create_task(self._run(job["id"], params))
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+        logger.info(f"[JobManager] Queued job {job['id']}")
+        return job
+
+    def get(self, job_id: str):
+        job = self.store.get(job_id)
+        if job is not None:
+            # Which worker runs it is internal
+            job.pop("owner", None)
+        return job
+
+    async def _run(self, job_id: str, params: dict):
+        self.store.update(job_id, status="running")
+        self.store.add_event(job_id, "running")
+
+        def on_stage(stage, data=None):
+            logger.info(f"[JobManager] Job {job_id} reached stage '{stage}'")
+            self.store.add_event(job_id, stage, data)
+
+        try:
+            result = await self.executor.run_async(self.runner, on_stage=on_stage, **params)
+        except Exception as e:
+            logger.error(f"[JobManager] Job {job_id} failed: {e}")
+            self.store.update(job_id, status="failed", error=str(e))
+            self.store.add_event(job_id, "failed", {"error": str(e)})
+            return
+        self.store.update(job_id, status="succeeded", result=result)
+        self.store.add_event(job_id, "succeeded")
+        logger.info(f"[JobManager] Job {job_id} succeeded")
+
+    def recover(self):
+        """
+        Fail jobs left unfinished by a worker that is gone so pollers get a terminal state. Jobs
+        whose worker is still running (another worker, or the old one during a graceful reload)
+        are left alone. Re-running them automatically could pay the providers twice for one request.
+        """
+        for job in self.store.list_unfinished():
+            if job.get("owner") and owner_alive(job["owner"]):
+                continue
+            error = "Job interrupted by a worker restart; please resubmit."
+            self.store.update(job["id"], status="failed", error=error)
+            self.store.add_event(job["id"], "failed", {"error": error})
+            logger.warning(f"[JobManager] Marked interrupted job {job['id']} as failed")
+
+    async def stream_events(self, job_id: str):
+        """Yield Server-Sent Events for every stage transition until the job finishes."""
+        sent = 0
+        while True:
+            job = self.store.get(job_id)
+            if job is None:
+                return
+            for event in job["events"][sent:]:
+                yield f"event: {event['stage']}\ndata: {json.dumps(event)}\n\n"
+            sent = len(job["events"])
+            # Status flips before the final event is appended, so finish on the event itself
+            if job["events"] and job["events"][-1]["stage"] in TERMINAL_STATUSES:
+                return
+            await asyncio.sleep(EVENT_POLL_INTERVAL)
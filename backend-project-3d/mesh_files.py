@@ -0,0 +1,305 @@
+"""
+Readers and writers for the mesh formats Replicate returns (binary glTF and PLY),
+built on NumPy so post-processing can run on a CPU-only box.
+"""
+
+import json
+import struct
+
+import numpy as np
+
+GLB_MAGIC = b"glTF"
+GLB_CHUNK_JSON = 0x4E4F534A
+GLB_CHUNK_BIN = 0x004E4942
+
+# glTF componentType -> NumPy dtype
+COMPONENT_DTYPES = {
+    5120: np.int8,
+    5121: np.uint8,
+    5122: np.int16,
+    5123: np.uint16,
+    5125: np.uint32,
+    5126: np.float32,
+}
+DTYPE_COMPONENTS = {np.dtype(dtype): component for component, dtype in COMPONENT_DTYPES.items()}
+TYPE_SIZES = {"SCALAR": 1, "VEC2": 2, "VEC3": 3, "VEC4": 4, "MAT4": 16}
+
+PLY_DTYPES = {
+    "char": "i1", "int8": "i1",
+    "uchar": "u1", "uint8": "u1",
+    "short": "i2", "int16": "i2",
+    "ushort": "u2", "uint16": "u2",
+    "int": "i4", "int32": "i4",
+    "uint": "u4", "uint32": "u4",
+    "float": "f4", "float32": "f4",
+    "double": "f8", "float64": "f8",
+}
+
+
+class MeshFormatError(ValueError):
+    pass
+
+
+def read_glb(data: bytes):
+    """Split a binary glTF into its JSON document and BIN chunk."""
+    if len(data) < 20 or data[:4] != GLB_MAGIC:
+        raise MeshFormatError("Not a binary glTF file")
+    _, version, length = struct.unpack_from("<4sII", data, 0)
+    if version != 2:
+        raise MeshFormatError(f"Unsupported glTF version {version}")
+    gltf, binary = None, b""
+    offset = 12
+    while offset + 8 <= min(length, len(data)):
+        chunk_length, chunk_type = struct.unpack_from("<II", data, offset)
+        chunk = data[offset + 8:offset + 8 + chunk_length]
+        if chunk_type == GLB_CHUNK_JSON:
+            gltf = json.loads(chunk.decode("utf-8"))
+        elif chunk_type == GLB_CHUNK_BIN:
+            binary = chunk
+        offset += 8 + chunk_length
+    if gltf is None:
+        raise MeshFormatError("GLB has no JSON chunk")
+    return gltf, binary
+
+
+def read_accessor(gltf: dict, binary: bytes, index: int):
+    """Return accessor `index` as a float32 or integer array of shape (count, components)."""
+    accessor = gltf["accessors"][index]
+    if "sparse" in accessor:
+        raise MeshFormatError("Sparse accessors are not supported")
+    dtype = np.dtype(COMPONENT_DTYPES[accessor["componentType"]])
+    components = TYPE_SIZES[accessor["type"]]
+    count = accessor["count"]
+    view = gltf["bufferViews"][accessor["bufferView"]]
+    offset = view.get("byteOffset", 0) + accessor.get("byteOffset", 0)
+    stride = view.get("byteStride") or dtype.itemsize * components
+    array = np.ndarray(
+        shape=(count, components),
+        dtype=dtype,
+        buffer=binary,
+        offset=offset,
+        strides=(stride, dtype.itemsize),
+    ).copy()
+    if accessor.get("normalized"):
+        array = array.astype(np.float32) / np.iinfo(dtype).max
+    return array
+
+
+def read_buffer_view(gltf: dict, binary: bytes, index: int):
+    view = gltf["bufferViews"][index]
+    start = view.get("byteOffset", 0)
+    return binary[start:start + view["byteLength"]]
+
+
+def node_matrix(transform: dict):
+    """4x4 matrix of a glTF node's matrix or translation/rotation/scale."""
+    if "matrix" in transform:
+        return np.array(transform["matrix"], dtype=np.float64).reshape(4, 4).T
+    x, y, z, w = transform.get("rotation", (0, 0, 0, 1))
+    rotation = np.array([
+        [1 - 2 * (y * y + z * z), 2 * (x * y - z * w), 2 * (x * z + y * w)],
+        [2 * (x * y + z * w), 1 - 2 * (x * x + z * z), 2 * (y * z - x * w)],
+        [2 * (x * z - y * w), 2 * (y * z + x * w), 1 - 2 * (x * x + y * y)],
+    ])
+    matrix = np.eye(4)
+    matrix[:3, :3] = rotation * np.array(transform.get("scale", (1, 1, 1)))
+    matrix[:3, 3] = transform.get("translation", (0, 0, 0))
+    return matrix
+
+
+def load_glb_mesh(data: bytes):
+    """
+    Extract the first primitive of the first mesh in a GLB as plain arrays.
+    Returns a dict with positions, faces, uvs (or None), the base-colour texture
+    (bytes, mime type) or None, the PBR factors and the owning node's transform.
+    """
+    gltf, binary = read_glb(data)
+    meshes = gltf.get("meshes") or []
+    if not meshes or not meshes[0].get("primitives"):
+        raise MeshFormatError("GLB contains no mesh primitives")
+    primitive = meshes[0]["primitives"][0]
+    if primitive.get("mode", 4) != 4:
+        raise MeshFormatError("Only triangle primitives are supported")
+    attributes = primitive["attributes"]
+
+    positions = read_accessor(gltf, binary, attributes["POSITION"]).astype(np.float32)
+    if "indices" in primitive:
+        faces = read_accessor(gltf, binary, primitive["indices"]).reshape(-1, 3).astype(np.int64)
+    else:
+        faces = np.arange(len(positions), dtype=np.int64).reshape(-1, 3)
+    uvs = None
+    if "TEXCOORD_0" in attributes:
+        uvs = read_accessor(gltf, binary, attributes["TEXCOORD_0"]).astype(np.float32)
+
+    texture, pbr = None, {}
+    if "material" in primitive:
+        pbr = dict(gltf["materials"][primitive["material"]].get("pbrMetallicRoughness", {}))
+        base_color = pbr.pop("baseColorTexture", None)
+        pbr.pop("metallicRoughnessTexture", None)
+        if base_color is not None:
+            image = gltf["images"][gltf["textures"][base_color["index"]]["source"]]
+            if "bufferView" in image:
+                texture = (read_buffer_view(gltf, binary, image["bufferView"]), image.get("mimeType", "image/png"))
+
+    node = next((n for n in gltf.get("nodes", []) if n.get("mesh") == 0), {})
+    transform = {k: node[k] for k in ("matrix", "rotation", "scale", "translation") if k in node}
+    return {"positions": positions, "faces": faces, "uvs": uvs, "texture": texture, "pbr": pbr, "transform": transform}
+
+
+class _GlbBuilder:
+    def __init__(self) -> None:
+        self.binary = bytearray()
+        self.buffer_views = []
+        self.accessors = []
+
+    def add_view(self, data: bytes, target: int = None):
+        # Every bufferView starts on a 4-byte boundary as the spec requires
+        self.binary.extend(b"\0" * (-len(self.binary) % 4))
+        view = {"buffer": 0, "byteOffset": len(self.binary), "byteLength": len(data)}
+        if target is not None:
+            view["target"] = target
+        self.binary.extend(data)
+        self.buffer_views.append(view)
+        return len(self.buffer_views) - 1
+
+    def add_accessor(self, array: np.ndarray, accessor_type: str, target: int = None, normalized: bool = False, bounds: bool = False):
+        array = np.ascontiguousarray(array)
+        accessor = {
+            "bufferView": self.add_view(array.tobytes(), target),
+            "componentType": DTYPE_COMPONENTS[array.dtype],
+            "count": len(array),
+            "type": accessor_type,
+        }
+        if normalized:
+            accessor["normalized"] = True
+        if bounds:
+            flat = array.reshape(len(array), -1)
+            accessor["min"] = flat.min(axis=0).tolist()
+            accessor["max"] = flat.max(axis=0).tolist()
+        self.accessors.append(accessor)
+        return len(self.accessors) - 1
+
+
+def write_glb_mesh(positions, faces, uvs=None, texture=None, pbr=None, transform=None, quantize=True):
+    """
+    Encode a single textured triangle mesh as GLB bytes.
+    With quantize=True positions are stored as uint16 and UVs as normalized uint16
+    (KHR_mesh_quantization), with the dequantization carried by a child node.
+    """
+    builder = _GlbBuilder()
+    attributes = {}
+    mesh_node = {"mesh": 0}
+    extensions = []
+
+    if quantize and len(positions):
+        lo = positions.min(axis=0)
+        extent = np.maximum(positions.max(axis=0) - lo, 1e-12)
+        quantized = np.round((positions - lo) / extent * 65535).astype(np.uint16)
+        attributes["POSITION"] = builder.add_accessor(quantized, "VEC3", target=34962, bounds=True)
+        mesh_node["translation"] = lo.astype(float).tolist()
+        mesh_node["scale"] = (extent / 65535).astype(float).tolist()
+        extensions.append("KHR_mesh_quantization")
+    else:
+        attributes["POSITION"] = builder.add_accessor(positions.astype(np.float32), "VEC3", target=34962, bounds=True)
+
+    if uvs is not None:
+        if quantize and uvs.size and uvs.min() >= 0 and uvs.max() <= 1:
+            attributes["TEXCOORD_0"] = builder.add_accessor(
+                np.round(uvs * 65535).astype(np.uint16), "VEC2", target=34962, normalized=True
+            )
+        else:
+            attributes["TEXCOORD_0"] = builder.add_accessor(uvs.astype(np.float32), "VEC2", target=34962)
+
+    index_dtype = np.uint16 if len(positions) < 65536 else np.uint32
+    primitive = {
+        "attributes": attributes,
+        "indices": builder.add_accessor(faces.reshape(-1).astype(index_dtype), "SCALAR", target=34963),
+        "mode": 4,
+    }
+
+    gltf = {"asset": {"version": "2.0", "generator": "project-3d mesh_postprocess"}}
+    material = {"pbrMetallicRoughness": dict(pbr or {}), "doubleSided": True}
+    if texture is not None:
+        image_bytes, mime_type = texture
+        gltf["images"] = [{"bufferView": builder.add_view(image_bytes), "mimeType": mime_type}]
+        gltf["samplers"] = [{"magFilter": 9729, "minFilter": 9987}]
+        gltf["textures"] = [{"source": 0, "sampler": 0}]
+        material["pbrMetallicRoughness"]["baseColorTexture"] = {"index": 0}
+    gltf["materials"] = [material]
+    primitive["material"] = 0
+
+    # Parent node keeps the original placement, child node undoes the quantization
+    gltf["nodes"] = [{**(transform or {}), "children": [1]}, mesh_node]
+    gltf["meshes"] = [{"primitives": [primitive]}]
+    gltf["scenes"] = [{"nodes": [0]}]
+    gltf["scene"] = 0
+    gltf["bufferViews"] = builder.buffer_views
+    gltf["accessors"] = builder.accessors
+    gltf["buffers"] = [{"byteLength": len(builder.binary)}]
+    if extensions:
+        gltf["extensionsUsed"] = extensions
+        gltf["extensionsRequired"] = extensions
+
+    json_chunk = json.dumps(gltf, separators=(",", ":")).encode("utf-8")
+    json_chunk += b" " * (-len(json_chunk) % 4)
+    bin_chunk = bytes(builder.binary) + b"\0" * (-len(builder.binary) % 4)
+    length = 12 + 8 + len(json_chunk) + 8 + len(bin_chunk)
+    return b"".join([
+        struct.pack("<4sII", GLB_MAGIC, 2, length),
+        struct.pack("<II", len(json_chunk), GLB_CHUNK_JSON), json_chunk,
+        struct.pack("<II", len(bin_chunk), GLB_CHUNK_BIN), bin_chunk,
+    ])
+
+
+def parse_ply_header(data: bytes):
+    """
+    Parse a PLY header. Returns (format, elements, header_length) where elements is a
+    list of (name, count, [(property, dtype)]) and list properties are rejected.
+    """
+    end = data.find(b"end_header")
+    if not data.startswith(b"ply") or end < 0:
+        raise MeshFormatError("Not a PLY file")
+    header_length = data.index(b"\n", end) + 1
+    fmt, elements = None, []
+    for line in data[:header_length].decode("ascii", errors="replace").splitlines():
+        parts = line.split()
+        if not parts:
+            continue
+        if parts[0] == "format":
+            fmt = parts[1]
+        elif parts[0] == "element":
+            elements.append((parts[1], int(parts[2]), []))
+        elif parts[0] == "property":
+            if parts[1] == "list":
+                raise MeshFormatError("PLY list properties are not supported")
+            if not elements:
+                raise MeshFormatError("PLY property before any element")
+            elements[-1][2].append((parts[2], PLY_DTYPES[parts[1]]))
+    if fmt not in ("binary_little_endian", "binary_big_endian"):
+        raise MeshFormatError(f"Unsupported PLY format '{fmt}'")
+    return fmt, elements, header_length
+
+
+def read_ply_vertices(data: bytes):
+    """Return the PLY vertex element as a NumPy structured array (e.g. Gaussian splats)."""
+    fmt, elements, header_length = parse_ply_header(data)
+    endian = "<" if fmt == "binary_little_endian" else ">"
+    offset = header_length
+    for name, count, properties in elements:
+        dtype = np.dtype([(prop, endian + code) for prop, code in properties])
+        if name == "vertex":
+            return np.frombuffer(data, dtype=dtype, count=count, offset=offset)
+        offset += dtype.itemsize * count
+    raise MeshFormatError("PLY has no vertex element")
+
+
+def write_ply_vertices(vertices: np.ndarray):
+    """Encode a structured vertex array as a binary little-endian PLY."""
+    vertices = vertices.astype(vertices.dtype.newbyteorder("<"))
+    names = {v: k for k, v in PLY_DTYPES.items() if not k[-1].isdigit()}
+    lines = ["ply", "format binary_little_endian 1.0", f"element vertex {len(vertices)}"]
+    for prop in vertices.dtype.names:
+        code = vertices.dtype[prop].str.lstrip("<>|=")
+        lines.append(f"property {names[code]} {prop}")
+    lines.append("end_header")
+    return ("\n".join(lines) + "\n").encode("ascii") + vertices.tobytes()
@@ -0,0 +1,325 @@
+"""
+Validation and summary stats of a generated model, without loading it.
+
+Replicate hands back whatever its model wrote, and an empty, truncated or
+degenerate file would otherwise be cached, uploaded and only fail once a
+browser tries to draw it. `inspect_mesh` memory-maps the saved file and reads
+only its structure: the GLB header, chunk table and JSON document, or the PLY
+header. Vertex positions and indices are NumPy views over the mapping, so the
+bounding box and index checks touch only their own pages and textures are
+never read beyond their image headers.
+
+The stats are attached to the result as "mesh":
+
+    {"format": "glb", "kind": "mesh", "vertices": 41230, "faces": 80012, "splats": 0,
+     "bbox": {"min": [...], "max": [...], "size": [...]},
+     "textures": [{"mime_type": "image/png", "bytes": 2214551, "width": 2048, "height": 2048}]}
+
+`kind` is "mesh", "points" or "gaussian_splat". A file that fails a check
+raises MeshFormatError with the reason.
+"""
+
+import json
+import struct
+from pathlib import Path
+
+import numpy as np
+
+from mesh_files import COMPONENT_DTYPES, GLB_CHUNK_BIN, GLB_CHUNK_JSON, GLB_MAGIC, PLY_DTYPES, TYPE_SIZES, MeshFormatError, node_matrix
+
+# PLY headers are a few hundred bytes; anything without end_header in this much isn't a PLY
+MAX_PLY_HEADER = 64 * 1024
+# Vertex properties Trellis and other 3DGS exporters write for every splat
+SPLAT_PROPERTIES = {"opacity", "scale_0", "rot_0"}
+# glTF primitive mode -> faces for `count` vertices (points and lines have none)
+FACE_COUNTS = {
+    4: lambda count: count // 3,
+    5: lambda count: max(count - 2, 0),
+    6: lambda count: max(count - 2, 0),
+}
+
+
+def sniff_format(path: Path):
+    """"glb" or "ply" from the file's magic bytes, or None."""
+    with open(path, "rb") as f:
+        head = f.read(4)
+    if head == GLB_MAGIC:
+        return "glb"
+    if head[:3] == b"ply":
+        return "ply"
+    return None
+
+
+def image_size(head: bytes):
+    """(width, height) from the first bytes of a PNG or JPEG, or (None, None)."""
+    if head[:8] == b"\x89PNG\r\n\x1a\n" and head[12:16] == b"IHDR":
+        return struct.unpack(">II", head[16:24])
+    if head[:2] == b"\xff\xd8":
+        offset = 2
+        while offset + 9 <= len(head) and head[offset] == 0xFF:
+            marker = head[offset + 1]
+            length = struct.unpack(">H", head[offset + 2:offset + 4])[0]
+            # Start-of-frame markers, other than DHT (C4), JPG (C8) and DAC (CC)
+            if 0xC0 <= marker <= 0xCF and marker not in (0xC4, 0xC8, 0xCC):
+                height, width = struct.unpack(">HH", head[offset + 5:offset + 9])
+                return width, height
+            offset += 2 + length
+    return None, None
+
+
+def _bbox(lo, hi):
+    lo, hi = np.asarray(lo, dtype=np.float64), np.asarray(hi, dtype=np.float64)
+    if not (np.isfinite(lo).all() and np.isfinite(hi).all()):
+        raise MeshFormatError("Vertex positions are not finite")
+    if not (hi - lo).any():
+        raise MeshFormatError("All vertices are at the same point")
+    return {"min": lo.round(6).tolist(), "max": hi.round(6).tolist(), "size": (hi - lo).round(6).tolist()}
+
+
+# -- GLB ----------------------------------------------------------------
+
+def _glb_chunks(data: np.ndarray):
+    """Check the GLB header against the file and return (glTF JSON, (offset, length) of the BIN chunk or None)."""
+    if len(data) < 20:
+        raise MeshFormatError(f"GLB is only {len(data)} bytes")
+    _, version, length = struct.unpack("<4sII", data[:12].tobytes())
+    if version != 2:
+        raise MeshFormatError(f"Unsupported glTF version {version}")
+    if length > len(data):
+        raise MeshFormatError(f"GLB is truncated: header declares {length} bytes, file has {len(data)}")
+    chunks = []
+    offset = 12
+    while offset + 8 <= length:
+        chunk_length, chunk_type = struct.unpack("<II", data[offset:offset + 8].tobytes())
+        if offset + 8 + chunk_length > length:
+            raise MeshFormatError(f"GLB chunk at byte {offset} runs past the end of the file")
+        chunks.append((chunk_type, offset + 8, chunk_length))
+        offset += 8 + chunk_length
+    if not chunks or chunks[0][0] != GLB_CHUNK_JSON:
+        raise MeshFormatError("GLB does not start with a JSON chunk")
+    _, start, chunk_length = chunks[0]
+    try:
+        gltf = json.loads(data[start:start + chunk_length].tobytes().decode("utf-8"))
+    except ValueError as e:
+        raise MeshFormatError(f"GLB JSON chunk is invalid: {e}") from None
+    binary = next(((start, chunk_length) for chunk_type, start, chunk_length in chunks[1:] if chunk_type == GLB_CHUNK_BIN), None)
+    return gltf, binary
+
+
+def _buffer_view(gltf: dict, binary, index: int):
+    """(offset in the file, length) of a bufferView, checked against the BIN chunk."""
+    view = gltf["bufferViews"][index]
+    buffer = gltf["buffers"][view["buffer"]]
+    if view["buffer"] != 0 or "uri" in buffer or binary is None:
+        raise MeshFormatError("GLB references an external buffer")
+    start, length = view.get("byteOffset", 0), view["byteLength"]
+    if start + length > binary[1]:
+        raise MeshFormatError(f"bufferView {index} runs past the end of the BIN chunk")
+    return binary[0] + start, length
+
+
+def _accessor(gltf: dict, data: np.ndarray, binary, index: int):
+    """Accessor `index` as a (count, components) NumPy view into the mapped file; no copy."""
+    accessor = gltf["accessors"][index]
+    if "sparse" in accessor or "bufferView" not in accessor:
+        raise MeshFormatError(f"Accessor {index} has no dense data")
+    dtype = np.dtype(COMPONENT_DTYPES[accessor["componentType"]])
+    components = TYPE_SIZES[accessor["type"]]
+    count = accessor["count"]
+    view_offset, view_length = _buffer_view(gltf, binary, accessor["bufferView"])
+    stride = gltf["bufferViews"][accessor["bufferView"]].get("byteStride") or dtype.itemsize * components
+    offset = accessor.get("byteOffset", 0)
+    if count and offset + stride * (count - 1) + dtype.itemsize * components > view_length:
+        raise MeshFormatError(f"Accessor {index} runs past the end of its bufferView")
+    return np.ndarray(
+        shape=(count, components), dtype=dtype, buffer=data,
+        offset=view_offset + offset, strides=(stride, dtype.itemsize),
+    )
+
+
+def _mesh_transforms(gltf: dict):
+    """World matrix of every node that places a mesh, as (mesh index, 4x4 matrix); meshes in no node get identity."""
+    nodes = gltf.get("nodes") or []
+    children = {child for node in nodes for child in node.get("children", ())}
+    placed = []
+    stack = [(index, np.eye(4)) for index in range(len(nodes)) if index not in children]
+    seen = set()
+    while stack:
+        index, parent = stack.pop()
+        if index in seen:
+            raise MeshFormatError("glTF node hierarchy has a cycle")
+        seen.add(index)
+        world = parent @ node_matrix(nodes[index])
+        if "mesh" in nodes[index]:
+            placed.append((nodes[index]["mesh"], world))
+        stack.extend((child, world) for child in nodes[index].get("children", ()))
+    placed_meshes = {mesh for mesh, _ in placed}
+    return placed + [(mesh, np.eye(4)) for mesh in range(len(gltf.get("meshes") or [])) if mesh not in placed_meshes]
+
+
+def _glb_textures(gltf: dict, data: np.ndarray, binary):
+    textures = []
+    for image in gltf.get("images") or []:
+        entry = {"mime_type": image.get("mimeType"), "bytes": None, "width": None, "height": None}
+        if "bufferView" in image:
+            offset, length = _buffer_view(gltf, binary, image["bufferView"])
+            entry["bytes"] = length
+            entry["width"], entry["height"] = image_size(data[offset:offset + min(length, 64 * 1024)].tobytes())
+        textures.append(entry)
+    return textures
+
+
+def _inspect_glb(data: np.ndarray):
+    gltf, binary = _glb_chunks(data)
+    meshes = gltf.get("meshes") or []
+    if not any(mesh.get("primitives") for mesh in meshes):
+        raise MeshFormatError("GLB contains no mesh primitives")
+
+    vertices = faces = points = 0
+    counted = set()
+    lo, hi = np.full(3, np.inf), np.full(3, -np.inf)
+    for mesh_index, world in _mesh_transforms(gltf):
+        for primitive in meshes[mesh_index].get("primitives", ()):
+            if "POSITION" not in primitive.get("attributes", {}):
+                raise MeshFormatError(f"Mesh {mesh_index} has a primitive without positions")
+            positions = _accessor(gltf, data, binary, primitive["attributes"]["POSITION"])
+            mode = primitive.get("mode", 4)
+            indices = None
+            if "indices" in primitive:
+                indices = _accessor(gltf, data, binary, primitive["indices"])
+                if len(indices) and int(indices.max()) >= len(positions):
+                    raise MeshFormatError(f"Mesh {mesh_index} has indices past its {len(positions)} vertices")
+            # Meshes placed by several nodes (and accessors shared between primitives) count once
+            if (mesh_index, primitive["attributes"]["POSITION"]) not in counted:
+                counted.add((mesh_index, primitive["attributes"]["POSITION"]))
+                vertices += len(positions)
+                count = len(indices) if indices is not None else len(positions)
+                if mode in FACE_COUNTS:
+                    faces += FACE_COUNTS[mode](count)
+                elif mode == 0:
+                    points += count
+            if not len(positions):
+                continue
+            local_lo, local_hi = positions.min(axis=0).astype(np.float64), positions.max(axis=0).astype(np.float64)
+            if gltf["accessors"][primitive["attributes"]["POSITION"]].get("normalized"):
+                scale = np.iinfo(positions.dtype).max
+                local_lo, local_hi = local_lo / scale, local_hi / scale
+            # Place the local box's corners in the scene and take their bounds
+            corners = np.array([[x, y, z, 1.0] for x in (local_lo[0], local_hi[0]) for y in (local_lo[1], local_hi[1]) for z in (local_lo[2], local_hi[2])])
+            placed = corners @ world.T
+            lo, hi = np.minimum(lo, placed[:, :3].min(axis=0)), np.maximum(hi, placed[:, :3].max(axis=0))
+
+    if not vertices:
+        raise MeshFormatError("GLB has no vertices")
+    if not faces and not points:
+        raise MeshFormatError("GLB has no triangles")
+    return {
+        "format": "glb",
+        "kind": "mesh" if faces else "points",
+        "vertices": vertices,
+        "faces": faces,
+        "splats": 0,
+        "bbox": _bbox(lo, hi),
+        "textures": _glb_textures(gltf, data, binary),
+    }
+
+
+# -- PLY ----------------------------------------------------------------
+
+def _ply_header(data: np.ndarray):
+    """Parse a PLY header of any format, list properties included: (format, elements, header length)."""
+    head = data[:MAX_PLY_HEADER].tobytes()
+    end = head.find(b"end_header")
+    if end < 0 or head.find(b"\n", end) < 0:
+        raise MeshFormatError("PLY header is missing end_header")
+    header_length = head.index(b"\n", end) + 1
+    fmt, elements = None, []
+    for line in head[:header_length].decode("ascii", errors="replace").splitlines():
+        parts = line.split()
+        if not parts:
+            continue
+        try:
+            if parts[0] == "format":
+                fmt = parts[1]
+            elif parts[0] == "element":
+                elements.append({"name": parts[1], "count": int(parts[2]), "properties": [], "lists": []})
+            elif parts[0] == "property":
+                if not elements:
+                    raise MeshFormatError("PLY property before any element")
+                if parts[1] == "list":
+                    elements[-1]["lists"].append((parts[4], PLY_DTYPES[parts[2]], PLY_DTYPES[parts[3]]))
+                else:
+                    elements[-1]["properties"].append((parts[2], PLY_DTYPES[parts[1]]))
+        except (IndexError, KeyError, ValueError):
+            raise MeshFormatError(f"Malformed PLY header line: {line.strip()!r}") from None
+    if fmt not in ("ascii", "binary_little_endian", "binary_big_endian"):
+        raise MeshFormatError(f"Unsupported PLY format '{fmt}'")
+    return fmt, elements, header_length
+
+
+def _inspect_ply(data: np.ndarray):
+    fmt, elements, header_length = _ply_header(data)
+    by_name = {element["name"]: element for element in elements}
+    vertex = by_name.get("vertex")
+    if vertex is None or not vertex["count"]:
+        raise MeshFormatError("PLY has no vertices")
+    names = {name for name, _ in vertex["properties"]}
+    if not {"x", "y", "z"} <= names:
+        raise MeshFormatError("PLY vertices have no x/y/z")
+
+    bbox = None
+    if fmt != "ascii":
+        endian = "<" if fmt == "binary_little_endian" else ">"
+        # Each list entry takes at least its count, so this is a lower bound on the payload
+        minimum, offset, vertex_offset = header_length, header_length, None
+        for element in elements:
+            row = np.dtype([(name, endian + code) for name, code in element["properties"]]).itemsize
+            row_minimum = row + sum(np.dtype(count_code).itemsize for _, count_code, _ in element["lists"])
+            if element is vertex and offset is not None:
+                vertex_offset = offset
+            minimum += element["count"] * row_minimum
+            # Elements after one with list properties can't be located without scanning it
+            offset = offset + element["count"] * row if offset is not None and not element["lists"] else None
+        if minimum > len(data):
+            raise MeshFormatError(f"PLY is truncated: its header needs at least {minimum} bytes, file has {len(data)}")
+        if vertex_offset is not None and not vertex["lists"]:
+            dtype = np.dtype([(name, endian + code) for name, code in vertex["properties"]])
+            rows = np.ndarray(shape=(vertex["count"],), dtype=dtype, buffer=data, offset=vertex_offset)
+            bbox = _bbox(
+                [rows[axis].min() for axis in "xyz"],
+                [rows[axis].max() for axis in "xyz"],
+            )
+
+    faces = by_name["face"]["count"] if "face" in by_name else 0
+    if SPLAT_PROPERTIES <= names:
+        kind = "gaussian_splat"
+    else:
+        kind = "mesh" if faces else "points"
+    return {
+        "format": "ply",
+        "kind": kind,
+        "vertices": vertex["count"],
+        "faces": faces,
+        "splats": vertex["count"] if kind == "gaussian_splat" else 0,
+        "bbox": bbox,
+        "textures": [],
+    }
+
+
+def inspect_mesh(path: Path):
+    """Validate the GLB or PLY at `path` and return its stats; raises MeshFormatError if it is unusable."""
+    path = Path(path)
+    size = path.stat().st_size
+    if not size:
+        raise MeshFormatError("Model file is empty")
+    fmt = sniff_format(path)
+    if fmt is None:
+        raise MeshFormatError("Model file is neither a GLB nor a PLY")
+    # The mapping is unmapped once the last view into it is garbage collected
+    data = np.memmap(path, dtype=np.uint8, mode="r")
+    try:
+        stats = _inspect_glb(data) if fmt == "glb" else _inspect_ply(data)
+    except (KeyError, IndexError, TypeError) as e:
+        # Dangling references in the glTF JSON
+        raise MeshFormatError(f"Malformed {fmt.upper()}: {type(e).__name__} {e}") from None
+    return {**stats, "bytes": size}
@@ -0,0 +1,206 @@
+"""
+Optional post-processing stage that writes lighter derivatives of a generated model.
+
+For a GLB this produces level-of-detail variants simplified by quadric-weighted
+vertex clustering, stored with KHR_mesh_quantization and a downscaled texture.
+For a Gaussian-splat PLY it keeps the most opaque splats. Everything is NumPy
+and Pillow, so it runs on a CPU-only box.
+"""
+
+import io
+import logging
+import os
+from pathlib import Path
+
+import numpy as np
+from PIL import Image
+
+from mesh_files import load_glb_mesh, read_ply_vertices, write_glb_mesh, write_ply_vertices
+
+logger = logging.getLogger(__name__)
+
+# (fraction of original faces/splats to keep, max texture edge in pixels)
+DEFAULT_LODS = ((0.5, 1024), (0.2, 512), (0.05, 256))
+
+
+def lod_levels_from_env():
+    """Parse MESH_LODS, e.g. "0.5:1024,0.2:512,0.05:256"."""
+    spec = os.getenv("MESH_LODS")
+    if not spec:
+        return DEFAULT_LODS
+    levels = []
+    for item in spec.split(","):
+        ratio, texture_size = item.split(":")
+        levels.append((float(ratio), int(texture_size)))
+    return tuple(levels)
+
+
+def _cluster(positions, uvs, resolution):
+    """Assign every vertex to a grid cell (split by UV cell too, so texture seams survive)."""
+    lo = positions.min(axis=0)
+    extent = np.maximum(positions.max(axis=0) - lo, 1e-12)
+    cells = np.minimum((positions - lo) / extent.max() * resolution, resolution - 1).astype(np.int64)
+    keys = cells[:, 0] + resolution * (cells[:, 1] + resolution * cells[:, 2])
+    if uvs is not None:
+        span = 3 * resolution + 1
+        uv_cells = np.clip(np.floor(uvs * resolution), -resolution, 2 * resolution).astype(np.int64) + resolution
+        keys = (keys * span + uv_cells[:, 0]) * span + uv_cells[:, 1]
+    _, cluster_ids = np.unique(keys, return_inverse=True)
+    return cluster_ids.reshape(-1)
+
+
+def _remap_faces(faces, cluster_ids, dedupe=True):
+    new_faces = cluster_ids[faces]
+    keep = (new_faces[:, 0] != new_faces[:, 1]) & (new_faces[:, 1] != new_faces[:, 2]) & (new_faces[:, 0] != new_faces[:, 2])
+    new_faces = new_faces[keep]
+    if not dedupe or not len(new_faces):
+        return new_faces
+    # Drop duplicate triangles regardless of winding start
+    canonical = np.sort(new_faces, axis=1)
+    if new_faces.max() < 2 ** 21:
+        packed = (canonical[:, 0] << 42) | (canonical[:, 1] << 21) | canonical[:, 2]
+        _, unique_rows = np.unique(packed, return_index=True)
+    else:
+        _, unique_rows = np.unique(canonical, axis=0, return_index=True)
+    return new_faces[np.sort(unique_rows)]
+
+
+def _quadric_positions(positions, faces, cluster_ids, cluster_count):
+    """
+    Place each cluster's vertex where it minimises the summed squared distance to the
+    planes of the original faces touching it (Lindstrom's out-of-core simplification).
+    A small pull towards the cluster mean keeps flat or degenerate clusters well-posed.
+    """
+    v0, v1, v2 = positions[faces[:, 0]], positions[faces[:, 1]], positions[faces[:, 2]]
+    normals = np.cross(v1 - v0, v2 - v0).astype(np.float64)
+    areas = np.linalg.norm(normals, axis=1)
+    valid = areas > 0
+    normals[valid] /= areas[valid, None]
+    offsets = -np.einsum("ij,ij->i", normals, v0)
+
+    face_a = areas[:, None, None] * normals[:, :, None] * normals[:, None, :]
+    face_b = (areas * offsets)[:, None] * normals
+
+    a = np.zeros((cluster_count, 3, 3))
+    b = np.zeros((cluster_count, 3))
+    for corner in range(3):
+        ids = cluster_ids[faces[:, corner]]
+        np.add.at(a, ids, face_a)
+        np.add.at(b, ids, face_b)
+
+    counts = np.bincount(cluster_ids, minlength=cluster_count)[:, None]
+    means = np.zeros((cluster_count, 3))
+    np.add.at(means, cluster_ids, positions)
+    means /= np.maximum(counts, 1)
+
+    reg = 1e-3 * np.trace(a, axis1=1, axis2=2)[:, None, None] / 3 + 1e-12
+    system = a + reg * np.eye(3)
+    rhs = -b + reg[:, :, 0] * means
+    solved = np.linalg.solve(system, rhs[:, :, None])[:, :, 0]
+    # Fall back to the mean if the optimum drifts away from the cluster
+    spread = np.zeros(cluster_count)
+    np.maximum.at(spread, cluster_ids, np.linalg.norm(positions - means[cluster_ids], axis=1))
+    drift = np.linalg.norm(solved - means, axis=1)
+    return np.where((drift <= 2 * spread + 1e-9)[:, None], solved, means).astype(np.float32)
+
+
+def _cluster_uvs(positions, uvs, cluster_ids, cluster_count, cluster_positions):
+    """Use the UV of the original vertex nearest each cluster's new position."""
+    distance = np.linalg.norm(positions - cluster_positions[cluster_ids], axis=1)
+    order = np.lexsort((distance, cluster_ids))
+    first = np.unique(cluster_ids[order], return_index=True)[1]
+    return uvs[order[first]]
+
+
+def decimate(positions, faces, uvs, target_faces):
+    """Simplify a mesh to roughly `target_faces` triangles by searching the clustering grid resolution."""
+    if target_faces >= len(faces):
+        return positions, faces, uvs
+    # Binary search on grid resolution; degenerate-face counts are cheap and close enough to steer it
+    low, high = 2, 2048
+    best = None
+    while low <= high:
+        resolution = (low + high) // 2
+        cluster_ids = _cluster(positions, uvs, resolution)
+        if len(_remap_faces(faces, cluster_ids, dedupe=False)) > target_faces:
+            high = resolution - 1
+        else:
+            best = cluster_ids
+            low = resolution + 1
+    cluster_ids = best if best is not None else _cluster(positions, uvs, 2)
+    new_faces = _remap_faces(faces, cluster_ids)
+
+    # Compact away clusters no surviving face references
+    cluster_count = int(cluster_ids.max()) + 1
+    cluster_positions = _quadric_positions(positions, faces, cluster_ids, cluster_count)
+    cluster_uvs = _cluster_uvs(positions, uvs, cluster_ids, cluster_count, cluster_positions) if uvs is not None else None
+    used, compact_faces = np.unique(new_faces, return_inverse=True)
+    compact_faces = compact_faces.reshape(-1, 3)
+    return cluster_positions[used], compact_faces, cluster_uvs[used] if cluster_uvs is not None else None
+
+
+def downscale_texture(texture, max_size: int):
+    """Shrink an encoded texture so its longest edge is at most `max_size`, keeping the encoding when possible."""
+    image_bytes, mime_type = texture
+    with Image.open(io.BytesIO(image_bytes)) as image:
+        image.load()
+        if max(image.size) > max_size:
+            image.thumbnail((max_size, max_size), Image.LANCZOS)
+        buffer = io.BytesIO()
+        if image.mode in ("RGBA", "LA", "P") or mime_type == "image/png":
+            image.save(buffer, format="PNG", optimize=True)
+            return buffer.getvalue(), "image/png"
+        image.convert("RGB").save(buffer, format="JPEG", quality=85)
+        return buffer.getvalue(), "image/jpeg"
+
+
+def _glb_lods(data: bytes, levels):
+    mesh = load_glb_mesh(data)
+    original_faces = len(mesh["faces"])
+    for ratio, texture_size in levels:
+        positions, faces, uvs = decimate(mesh["positions"], mesh["faces"], mesh["uvs"], int(original_faces * ratio))
+        texture = downscale_texture(mesh["texture"], texture_size) if mesh["texture"] else None
+        encoded = write_glb_mesh(positions, faces, uvs, texture, mesh["pbr"], mesh["transform"])
+        info = {"faces": int(len(faces)), "vertices": int(len(positions))}
+        if texture is not None:
+            info["texture_size"] = texture_size
+        yield encoded, info
+
+
+def _ply_lods(data: bytes, levels):
+    vertices = read_ply_vertices(data)
+    if "opacity" in vertices.dtype.names:
+        # Most opaque splats first; they carry most of the visible appearance
+        order = np.argsort(-vertices["opacity"], kind="stable")
+    else:
+        order = np.random.default_rng(0).permutation(len(vertices))
+    for ratio, _ in levels:
+        keep = np.sort(order[:max(1, int(len(vertices) * ratio))])
+        yield write_ply_vertices(vertices[keep]), {"vertices": int(len(keep))}
+
+
+def generate_lods(path: Path, levels=None):
+    """
+    Write LOD files next to `path` (<stem>_lod1<suffix>, ...) and return their descriptions,
+    smallest last: [{"level", "path", "bytes", ...}]. Paths are relative to `path`'s directory.
+    """
+    path = Path(path)
+    levels = levels or lod_levels_from_env()
+    data = path.read_bytes()
+    suffix = path.suffix.lower()
+    if suffix == ".glb":
+        variants = _glb_lods(data, levels)
+    elif suffix == ".ply":
+        variants = _ply_lods(data, levels)
+    else:
+        raise ValueError(f"Unsupported mesh format '{suffix}'")
+
+    lods = []
+    for level, (encoded, info) in enumerate(variants, start=1):
+        lod_name = f"{path.stem}_lod{level}{path.suffix}"
+        tmp_path = path.with_name(f".{lod_name}.part")
+        tmp_path.write_bytes(encoded)
+        os.replace(tmp_path, path.with_name(lod_name))
+        lods.append({"level": level, "path": lod_name, "bytes": len(encoded), **info})
+        logger.info(f"[generate_lods] Wrote {lod_name} ({len(encoded)} bytes, {info})")
+    return lods
@@ -0,0 +1,361 @@
+"""
+Software-rendered previews of a generated model, so gallery cards can show an
+image instead of loading the full mesh into WebGL.
+
+For every model this writes a static thumbnail and a turntable sprite sheet
+(frames side by side, rotating about the vertical axis), both transparent PNGs.
+Textured GLBs are rasterized with a vectorized z-buffer: each triangle is
+expanded into the pixels of its bounding box, covered pixels keep the nearest
+fragment, and the survivors are textured and Lambert-shaded. Gaussian-splat
+PLYs are drawn as screen-space Gaussians composited with weighted blended
+order-independent transparency. Everything is NumPy and Pillow, so it runs on
+a CPU-only box. Mesh frames are rendered at 2x and downsampled for
+antialiasing; splats are soft already and are rendered at 1x.
+"""
+
+import io
+import logging
+import math
+import os
+from pathlib import Path
+
+import numpy as np
+from PIL import Image
+
+from mesh_files import load_glb_mesh, node_matrix, read_ply_vertices
+
+logger = logging.getLogger(__name__)
+
+# Camera looks down at the model from this elevation; the thumbnail is a three-quarter view
+CAMERA_PITCH = math.radians(25)
+THUMBNAIL_YAW = math.radians(35)
+# Camera distance in model radii; the model is scaled to fit inside a unit sphere
+CAMERA_DISTANCE = 2.8
+SUPERSAMPLE = 2
+# Fragments generated per rasterization batch, which bounds peak memory
+FRAGMENT_BATCH = 1_000_000
+# Spherical-harmonics DC coefficient, to turn f_dc_* into an RGB colour
+SH_C0 = 0.28209479177387814
+# Splat footprints are clipped to this radius in render pixels, which bounds fragments per splat
+MAX_SPLAT_RADIUS = 3
+SPLATS_PER_PIXEL = 2
+DEFAULT_COLOR = np.array([0.8, 0.8, 0.8, 1.0], dtype=np.float32)
+LIGHT_DIRECTION = np.array([0.4, 0.6, 1.0]) / np.linalg.norm([0.4, 0.6, 1.0])
+
+
+def preview_settings_from_env():
+    """Thumbnail edge, turntable frame edge and frame count, from PREVIEW_* variables."""
+    return {
+        "thumbnail_size": int(os.getenv("PREVIEW_THUMBNAIL_SIZE", 256)),
+        "frame_size": int(os.getenv("PREVIEW_FRAME_SIZE", 128)),
+        "frames": int(os.getenv("PREVIEW_FRAMES", 12)),
+        "max_splats": int(os.getenv("PREVIEW_MAX_SPLATS", 100_000)),
+    }
+
+
+def _rotation(yaw: float, pitch: float):
+    """Turn the model by `yaw` about +Y, then tip it towards the camera by `pitch`."""
+    cy, sy, cp, sp = math.cos(yaw), math.sin(yaw), math.cos(pitch), math.sin(pitch)
+    turn = np.array([[cy, 0, sy], [0, 1, 0], [-sy, 0, cy]])
+    tilt = np.array([[1, 0, 0], [0, cp, -sp], [0, sp, cp]])
+    return tilt @ turn
+
+
+class _Camera:
+    """Perspective camera on +Z looking at the origin, framing the unit sphere."""
+
+    def __init__(self, size: int) -> None:
+        self.size = size
+        # Focal length at which a unit sphere at CAMERA_DISTANCE just fits, with a small margin
+        self.focal = 0.92 / math.tan(math.asin(1 / CAMERA_DISTANCE)) * size / 2
+
+    def project(self, view):
+        """View-space points -> (pixel x, pixel y, depth)."""
+        depth = CAMERA_DISTANCE - view[:, 2]
+        x = self.size / 2 + self.focal * view[:, 0] / depth
+        y = self.size / 2 - self.focal * view[:, 1] / depth
+        return x, y, depth
+
+
+def _fit_unit_sphere(points, robust: bool = False):
+    """Centre and radius that map `points` into the unit sphere (ignoring stray outliers when robust)."""
+    if robust and len(points) > 100:
+        lo, hi = np.percentile(points, [1, 99], axis=0)
+    else:
+        lo, hi = points.min(axis=0), points.max(axis=0)
+    center = (lo + hi) / 2
+    distances = np.linalg.norm(points - center, axis=1)
+    radius = np.percentile(distances, 99) if robust and len(points) > 100 else distances.max()
+    return center, max(float(radius), 1e-9)
+
+
+def _expand_boxes(x0, y0, widths, heights):
+    """Every pixel of every box: (owner index, pixel x, pixel y)."""
+    counts = widths * heights
+    owner = np.repeat(np.arange(len(counts)), counts)
+    local = np.arange(int(counts.sum())) - np.repeat(np.cumsum(counts) - counts, counts)
+    return owner, x0[owner] + local % widths[owner], y0[owner] + local // widths[owner]
+
+
+def _batches(counts, limit: int):
+    """Split items into consecutive slices whose counts sum to at most `limit` (or one item, if larger)."""
+    totals = np.cumsum(counts)
+    start = 0
+    while start < len(counts):
+        base = totals[start - 1] if start else 0
+        end = max(start + 1, int(np.searchsorted(totals, base + limit, side="right")))
+        yield slice(start, end)
+        start = end
+
+
+def _rasterize(x, y, depth, faces, size: int):
+    """
+    Z-buffer the triangles. Returns, for covered pixels, their flat pixel index, the
+    triangle drawn there and its perspective-correct barycentric weights.
+    """
+    # float32 halves the memory traffic of the per-fragment maths, which dominates
+    tx, ty, tz = (values.astype(np.float32)[faces] for values in (x, y, depth))
+    area = (tx[:, 1] - tx[:, 0]) * (ty[:, 2] - ty[:, 0]) - (tx[:, 2] - tx[:, 0]) * (ty[:, 1] - ty[:, 0])
+    x0 = np.clip(np.floor(tx.min(axis=1)), 0, size).astype(np.int64)
+    x1 = np.clip(np.ceil(tx.max(axis=1)), 0, size).astype(np.int64)
+    y0 = np.clip(np.floor(ty.min(axis=1)), 0, size).astype(np.int64)
+    y1 = np.clip(np.ceil(ty.max(axis=1)), 0, size).astype(np.int64)
+    visible = (np.abs(area) > 1e-12) & (x1 > x0) & (y1 > y0) & (tz.min(axis=1) > 0)
+    triangles = np.flatnonzero(visible)
+    widths, heights = (x1 - x0)[triangles], (y1 - y0)[triangles]
+
+    zbuffer = np.full(size * size, np.inf)
+    owner_buffer = np.full(size * size, -1, dtype=np.int64)
+    weight_buffer = np.zeros((size * size, 3))
+    for batch in _batches(widths * heights, FRAGMENT_BATCH):
+        ids = triangles[batch]
+        local, px, py = _expand_boxes(x0[ids], y0[ids], widths[batch], heights[batch])
+        tri = ids[local]
+        sx, sy = px.astype(np.float32) + 0.5, py.astype(np.float32) + 0.5
+        # Edge functions give screen-space barycentrics
+        ax, ay, bx, by, cx, cy = tx[tri, 0], ty[tri, 0], tx[tri, 1], ty[tri, 1], tx[tri, 2], ty[tri, 2]
+        w0 = ((bx - sx) * (cy - sy) - (cx - sx) * (by - sy)) / area[tri]
+        w1 = ((cx - sx) * (ay - sy) - (ax - sx) * (cy - sy)) / area[tri]
+        w2 = 1 - w0 - w1
+        inside = (w0 >= 0) & (w1 >= 0) & (w2 >= 0)
+        tri, w = tri[inside], np.stack([w0[inside], w1[inside], w2[inside]], axis=1)
+        pixel = (py * size + px)[inside]
+        # Perspective-correct weights and depth
+        w = w / tz[tri]
+        inverse_depth = w.sum(axis=1)
+        w /= inverse_depth[:, None]
+        frag_depth = 1 / inverse_depth
+
+        # Nearest fragment per pixel within the batch, then against the buffer
+        order = np.lexsort((frag_depth, pixel))
+        first = order[np.unique(pixel[order], return_index=True)[1]]
+        pixel, tri, w, frag_depth = pixel[first], tri[first], w[first], frag_depth[first]
+        closer = frag_depth < zbuffer[pixel]
+        pixel = pixel[closer]
+        zbuffer[pixel] = frag_depth[closer]
+        owner_buffer[pixel] = tri[closer]
+        weight_buffer[pixel] = w[closer]
+
+    covered = np.flatnonzero(owner_buffer >= 0)
+    return covered, owner_buffer[covered], weight_buffer[covered]
+
+
+def _sample_texture(texture, uv):
+    """Nearest-texel lookup with repeat wrapping; glTF UVs have their origin at the top left."""
+    height, width = texture.shape[:2]
+    u = np.floor((uv[:, 0] % 1.0) * width).astype(np.int64) % width
+    v = np.floor((uv[:, 1] % 1.0) * height).astype(np.int64) % height
+    return texture[v, u]
+
+
+def _render_mesh(mesh, rotation, size: int):
+    camera = _Camera(size)
+    view = mesh["positions"] @ rotation.T
+    x, y, depth = camera.project(view)
+    faces = mesh["faces"]
+    pixel, tri, weights = _rasterize(x, y, depth, faces, size)
+
+    corners = view[faces[tri]]
+    normals = np.cross(corners[:, 1] - corners[:, 0], corners[:, 2] - corners[:, 0])
+    normals /= np.maximum(np.linalg.norm(normals, axis=1, keepdims=True), 1e-12)
+    # Two-sided lighting; generated meshes don't always have consistent winding
+    lambert = np.abs(normals @ LIGHT_DIRECTION)
+    shade = 0.35 + 0.65 * lambert
+
+    color = np.broadcast_to(mesh["base_color"], (len(pixel), 4)).copy()
+    if mesh["texture"] is not None and mesh["uvs"] is not None:
+        uv = np.einsum("ij,ijk->ik", weights, mesh["uvs"][faces[tri]])
+        color *= _sample_texture(mesh["texture"], uv)
+    color[:, :3] *= shade[:, None]
+
+    image = np.zeros((size * size, 4), dtype=np.float32)
+    image[pixel] = color
+    image[pixel, 3] = 1.0
+    return image.reshape(size, size, 4)
+
+
+def _render_splats(splats, rotation, size: int):
+    # A small frame gains nothing from more than a few splats per pixel
+    count = SPLATS_PER_PIXEL * size * size
+    splats = {key: value[:count] for key, value in splats.items()}
+    camera = _Camera(size)
+    view = splats["positions"] @ rotation.T
+    x, y, depth = camera.project(view)
+    sigma = np.maximum(0.5, splats["sigma"] * camera.focal / np.maximum(depth, 1e-6))
+    sigma = np.minimum(sigma, MAX_SPLAT_RADIUS / 2)
+    radius = np.minimum(np.ceil(3 * sigma), MAX_SPLAT_RADIUS).astype(np.int64)
+    x0 = np.floor(x).astype(np.int64) - radius
+    y0 = np.floor(y).astype(np.int64) - radius
+    keep = (depth > 0) & (x0 + 2 * radius >= 0) & (x0 < size) & (y0 + 2 * radius >= 0) & (y0 < size)
+    ids = np.flatnonzero(keep)
+
+    color_sum = np.zeros((size * size, 3))
+    weight_sum = np.zeros(size * size)
+    log_transmittance = np.zeros(size * size)
+    near = depth[ids].min() if len(ids) else 0.0
+    span = 2 * radius[ids] + 1
+    for batch in _batches(span * span, FRAGMENT_BATCH):
+        batch_ids = ids[batch]
+        local, px, py = _expand_boxes(x0[batch_ids], y0[batch_ids], span[batch], span[batch])
+        splat = batch_ids[local]
+        onscreen = (px >= 0) & (px < size) & (py >= 0) & (py < size)
+        splat, px, py = splat[onscreen], px[onscreen], py[onscreen]
+        distance2 = (px + 0.5 - x[splat]) ** 2 + (py + 0.5 - y[splat]) ** 2
+        alpha = np.minimum(0.99, splats["opacity"][splat] * np.exp(-0.5 * distance2 / sigma[splat] ** 2))
+        pixel = py * size + px
+        # Weighted blended OIT: nearer fragments dominate the average colour
+        weight = alpha * np.exp(-8.0 * (depth[splat] - near))
+        weight_sum += np.bincount(pixel, weight, minlength=size * size)
+        for channel in range(3):
+            color_sum[:, channel] += np.bincount(pixel, weight * splats["colors"][splat, channel], minlength=size * size)
+        log_transmittance += np.bincount(pixel, np.log1p(-alpha), minlength=size * size)
+
+    image = np.zeros((size * size, 4), dtype=np.float32)
+    covered = weight_sum > 0
+    image[covered, :3] = color_sum[covered] / weight_sum[covered, None]
+    image[:, 3] = 1 - np.exp(log_transmittance)
+    return image.reshape(size, size, 4)
+
+
+def _load_glb(data: bytes):
+    mesh = load_glb_mesh(data)
+    positions = mesh["positions"].astype(np.float64)
+    if mesh["transform"]:
+        matrix = node_matrix(mesh["transform"])
+        positions = positions @ matrix[:3, :3].T + matrix[:3, 3]
+    center, radius = _fit_unit_sphere(positions)
+    texture = None
+    if mesh["texture"] is not None:
+        with Image.open(io.BytesIO(mesh["texture"][0])) as image:
+            texture = np.asarray(image.convert("RGBA"), dtype=np.float32) / 255
+    base_color = np.array(mesh["pbr"].get("baseColorFactor", DEFAULT_COLOR), dtype=np.float32)
+    return {
+        "positions": (positions - center) / radius,
+        "faces": mesh["faces"],
+        "uvs": mesh["uvs"],
+        "texture": texture,
+        "base_color": base_color,
+    }
+
+
+def _load_splats(data: bytes, max_splats: int):
+    vertices = read_ply_vertices(data)
+    names = vertices.dtype.names
+    if "opacity" in names:
+        # Most opaque first: they carry most of the visible appearance, so frames can take a prefix
+        vertices = vertices[np.argsort(-vertices["opacity"], kind="stable")]
+    vertices = vertices[:max_splats]
+    positions = np.stack([vertices["x"], vertices["y"], vertices["z"]], axis=1).astype(np.float64)
+    center, radius = _fit_unit_sphere(positions, robust=True)
+
+    if "f_dc_0" in names:
+        colors = 0.5 + SH_C0 * np.stack([vertices[f"f_dc_{i}"] for i in range(3)], axis=1)
+    elif "red" in names:
+        colors = np.stack([vertices["red"], vertices["green"], vertices["blue"]], axis=1) / 255
+    else:
+        colors = np.broadcast_to(DEFAULT_COLOR[:3], (len(vertices), 3))
+    # Stored as logits / log-scales, as written by 3D Gaussian Splatting exporters
+    opacity = 1 / (1 + np.exp(-vertices["opacity"].astype(np.float64))) if "opacity" in names else np.ones(len(vertices))
+    if "scale_0" in names:
+        sigma = np.exp(np.max([vertices[f"scale_{i}"] for i in range(3)], axis=0).astype(np.float64)) / radius
+    else:
+        sigma = np.full(len(vertices), 0.005)
+    return {
+        "positions": (positions - center) / radius,
+        "colors": np.clip(colors, 0, 1),
+        "opacity": opacity,
+        "sigma": np.minimum(sigma, 0.1),
+    }
+
+
+def _to_image(pixels, size: int, supersample: int):
+    """Float RGBA at `supersample` x `size` -> antialiased 8-bit image of `size`."""
+    # Downsample premultiplied colour so transparent edges don't bleed black
+    premultiplied = pixels.copy()
+    premultiplied[..., :3] *= premultiplied[..., 3:4]
+    small = premultiplied.reshape(size, supersample, size, supersample, 4).mean(axis=(1, 3))
+    alpha = small[..., 3:4]
+    small[..., :3] = np.where(alpha > 0, small[..., :3] / np.maximum(alpha, 1e-6), 0)
+    return Image.fromarray(np.clip(small * 255 + 0.5, 0, 255).astype(np.uint8), "RGBA")
+
+
+def load_preview_model(path: Path, max_splats: int):
+    """Read a GLB or Gaussian PLY, normalized to the unit sphere. Returns (model, render function)."""
+    data = Path(path).read_bytes()
+    suffix = Path(path).suffix.lower()
+    if suffix == ".glb":
+        return _load_glb(data), _render_mesh
+    if suffix == ".ply":
+        return _load_splats(data, max_splats), _render_splats
+    raise ValueError(f"Unsupported mesh format '{suffix}'")
+
+
+def render_views(model, render, yaws, size: int):
+    """Render a loaded model from the standard elevation at each yaw (radians)."""
+    supersample = SUPERSAMPLE if render is _render_mesh else 1
+    return [
+        _to_image(render(model, _rotation(yaw, CAMERA_PITCH), size * supersample), size, supersample)
+        for yaw in yaws
+    ]
+
+
+def _save_png(image, path: Path):
+    buffer = io.BytesIO()
+    image.save(buffer, format="PNG")
+    tmp_path = path.with_name(f".{path.name}.part")
+    tmp_path.write_bytes(buffer.getvalue())
+    os.replace(tmp_path, path)
+    return buffer.getbuffer().nbytes
+
+
+def generate_previews(path: Path, settings=None):
+    """
+    Write <stem>_thumb.png and <stem>_turntable.png next to `path` and describe them:
+    {"thumbnail": {"path", "bytes", "width", "height"},
+     "turntable": {"path", "bytes", "frames", "frame_width", "frame_height"}}.
+    Paths are relative to `path`'s directory. The turntable is one row of frames, left to right.
+    """
+    path = Path(path)
+    settings = settings or preview_settings_from_env()
+    size, frame_size, frames = settings["thumbnail_size"], settings["frame_size"], settings["frames"]
+    model, render = load_preview_model(path, settings["max_splats"])
+
+    thumbnail = render_views(model, render, [THUMBNAIL_YAW], size)[0]
+    thumb_name = f"{path.stem}_thumb.png"
+    thumb_bytes = _save_png(thumbnail, path.with_name(thumb_name))
+
+    views = render_views(model, render, [THUMBNAIL_YAW + 2 * math.pi * i / frames for i in range(frames)], frame_size)
+    sprite = Image.new("RGBA", (frame_size * frames, frame_size))
+    for i, view in enumerate(views):
+        sprite.paste(view, (i * frame_size, 0))
+    sprite_name = f"{path.stem}_turntable.png"
+    sprite_bytes = _save_png(sprite, path.with_name(sprite_name))
+
+    logger.info(f"[generate_previews] Wrote {thumb_name} ({thumb_bytes} bytes) and {sprite_name} ({sprite_bytes} bytes)")
+    return {
+        "thumbnail": {"path": thumb_name, "bytes": thumb_bytes, "width": size, "height": size},
+        "turntable": {
+            "path": sprite_name, "bytes": sprite_bytes, "frames": frames,
+            "frame_width": frame_size, "frame_height": frame_size,
+        },
+    }
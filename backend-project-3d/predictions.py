@@ -0,0 +1,230 @@
+"""
+Replicate prediction lifecycle without a thread per job.
+
+`replicate.run` blocks a thread until the remote job finishes and can't be
+abandoned. `PredictionTracker.run` instead creates the prediction and awaits
+it on the event loop: each outstanding prediction is a coroutine that polls
+with exponential backoff and is woken early when Replicate calls the webhook
+route. If the awaiting task is cancelled (client disconnect) or the deadline
+passes (the tracker's own timeout or the request deadline, whichever is
+sooner), the remote prediction is cancelled so it stops billing. A failed
+poll is retried on the next interval instead of abandoning a prediction
+that is still running. Queue time
+(created -> started) and run time (started -> completed) are recorded as
+separate stages.
+"""
+
+import asyncio
+import base64
+import hashlib
+import hmac
+import logging
+import os
+import threading
+import time
+from datetime import datetime
+
+from metrics import observe_stage
+from resilience import DeadlineExceeded, time_remaining
+from scheduling import FairSlots
+
+logger = logging.getLogger(__name__)
+
+TERMINAL_STATUSES = {"succeeded", "failed", "canceled"}
+# Reject webhooks whose timestamp is further than this from now (replay protection)
+WEBHOOK_TOLERANCE_SECONDS = 300
+# Give up on (and cancel) a prediction after this many polls in a row fail
+MAX_CONSECUTIVE_POLL_ERRORS = 5
+
+
+class PredictionError(RuntimeError):
+    """The remote prediction failed or was canceled."""
+
+
+class PredictionTimeout(TimeoutError):
+    """The prediction didn't finish before its deadline and was canceled."""
+
+
+def _parse_time(value):
+    if not value:
+        return None
+    return datetime.fromisoformat(value.replace("Z", "+00:00")).timestamp()
+
+
+def verify_webhook(secret: str, headers, body: bytes):
+    """
+    Check a Replicate webhook signature (the Standard Webhooks scheme): HMAC-SHA256 over
+    "<webhook-id>.<webhook-timestamp>.<body>" keyed with the base64 part of "whsec_...".
+    """
+    webhook_id = headers.get("webhook-id")
+    timestamp = headers.get("webhook-timestamp")
+    signatures = headers.get("webhook-signature", "")
+    if not webhook_id or not timestamp:
+        return False
+    try:
+        if abs(time.time() - int(timestamp)) > WEBHOOK_TOLERANCE_SECONDS:
+            return False
+        key = base64.b64decode(secret.removeprefix("whsec_"))
+    except ValueError:
+        return False
+    signed = f"{webhook_id}.{timestamp}.".encode() + body
+    expected = base64.b64encode(hmac.new(key, signed, hashlib.sha256).digest()).decode()
+    # Header is a space-separated list of "v1,<signature>"
+    return any(
+        hmac.compare_digest(candidate.partition(",")[2], expected) for candidate in signatures.split()
+    )
+
+
+class PredictionTracker:
+    def __init__(
+        self,
+        max_outstanding: int,
+        timeout: float,
+        poll_initial: float,
+        poll_max: float,
+        webhook_url: str = None,
+        webhook_secret: str = None,
+    ) -> None:
+        self.max_outstanding = max_outstanding
+        self.timeout = timeout
+        self.poll_initial = poll_initial
+        self.poll_max = poll_max
+        self.webhook_url = webhook_url
+        self.webhook_secret = webhook_secret
+        # Outstanding predictions are shared between users and lanes by fair queuing
+        self._slots = FairSlots.from_env("predictions", max_outstanding)
+        self._wakeups = {}
+        self._lock = threading.Lock()
+        self._counts = {"created": 0, "succeeded": 0, "failed": 0, "canceled": 0, "timed_out": 0, "polls": 0, "poll_errors": 0, "webhooks": 0}
+
+    @classmethod
+    def from_env(cls):
+        return cls(
+            max_outstanding=int(os.getenv("REPLICATE_MAX_PREDICTIONS", 256)),
+            timeout=float(os.getenv("REPLICATE_PREDICTION_TIMEOUT", 900)),
+            poll_initial=float(os.getenv("REPLICATE_POLL_INITIAL", 1.0)),
+            poll_max=float(os.getenv("REPLICATE_POLL_MAX", 15.0)),
+            webhook_url=os.getenv("REPLICATE_WEBHOOK_URL") or None,
+            webhook_secret=os.getenv("REPLICATE_WEBHOOK_SECRET") or None,
+        )
+
+    def _count(self, name: str):
+        with self._lock:
+            self._counts[name] += 1
+
+    def slot(self):
+        """Async context manager holding one outstanding-prediction slot; run() takes its own."""
+        return self._slots.slot_async()
+
+    async def run(self, client, version: str, input: dict, model: str = "", timeout: float = None):
+        """
+        Create a prediction and wait for it without blocking a thread. Returns its output.
+        Cancelling the awaiting task, or exceeding `timeout` or the request deadline,
+        cancels the remote prediction.
+        """
+        timeout = timeout or self.timeout
+        remaining = time_remaining()
+        deadline_bound = remaining is not None and remaining < timeout
+        if deadline_bound:
+            if remaining <= 0:
+                raise DeadlineExceeded("Request budget spent before the prediction was created")
+            timeout = remaining
+        async with self.slot():
+            params = {}
+            if self.webhook_url:
+                params = {"webhook": self.webhook_url, "webhook_events_filter": ["completed"]}
+            prediction = await client.predictions.async_create(version=version.split(":")[-1], input=input, **params)
+            self._count("created")
+            wakeup = asyncio.Event()
+            self._wakeups[prediction.id] = wakeup
+            logger.info(f"[PredictionTracker] Created prediction {prediction.id} for {model or version}")
+            try:
+                prediction = await asyncio.wait_for(self._wait(client, prediction, wakeup), timeout)
+            except asyncio.TimeoutError:
+                self._count("timed_out")
+                await self._cancel(client, prediction.id)
+                if deadline_bound:
+                    raise DeadlineExceeded(f"Prediction {prediction.id} did not finish within the request budget")
+                raise PredictionTimeout(f"Prediction {prediction.id} did not finish within {timeout:.0f}s")
+            except asyncio.CancelledError:
+                logger.info(f"[PredictionTracker] Caller went away, canceling prediction {prediction.id}")
+                await self._cancel(client, prediction.id)
+                raise
+            except Exception:
+                await self._cancel(client, prediction.id)
+                raise
+            finally:
+                self._wakeups.pop(prediction.id, None)
+
+        self._record_times(prediction, model)
+        self._count(prediction.status)
+        if prediction.status != "succeeded":
+            raise PredictionError(f"Prediction {prediction.id} {prediction.status}: {prediction.error}")
+        return prediction.output
+
+    async def _wait(self, client, prediction, wakeup: asyncio.Event):
+        interval = self.poll_initial
+        errors = 0
+        while prediction.status not in TERMINAL_STATUSES:
+            try:
+                # A webhook sets the event; otherwise poll when the interval runs out
+                await asyncio.wait_for(wakeup.wait(), interval)
+            except asyncio.TimeoutError:
+                pass
+            wakeup.clear()
+            interval = min(interval * 1.5, self.poll_max)
+            self._count("polls")
+            try:
+                prediction = await client.predictions.async_get(prediction.id)
+            except Exception as e:
+                self._count("poll_errors")
+                errors += 1
+                if errors >= MAX_CONSECUTIVE_POLL_ERRORS:
+                    raise
+                logger.warning(f"[PredictionTracker] Polling {prediction.id} failed ({e}), retrying in {interval:.1f}s")
+                continue
+            errors = 0
+        return prediction
+
+    async def _cancel(self, client, prediction_id: str):
+        try:
+            # Shielded so the cancel request still goes out while the caller is being cancelled
+            await asyncio.shield(client.predictions.async_cancel(prediction_id))
+            self._count("canceled")
+        except Exception as e:
+            logger.error(f"[PredictionTracker] Failed to cancel prediction {prediction_id}: {e}")
+
+    def _record_times(self, prediction, model: str):
+        created = _parse_time(prediction.created_at)
+        started = _parse_time(prediction.started_at)
+        completed = _parse_time(prediction.completed_at)
+        if created and started:
+            observe_stage("three_d_queue", max(0.0, started - created), model)
+        predict_time = (prediction.metrics or {}).get("predict_time")
+        if predict_time is None and started and completed:
+            predict_time = completed - started
+        if predict_time is not None:
+            observe_stage("three_d_run", predict_time, model)
+
+    def handle_webhook(self, payload: dict):
+        """Wake the waiter for a prediction Replicate reported on. Returns False for unknown ids."""
+        self._count("webhooks")
+        wakeup = self._wakeups.get(payload.get("id"))
+        if wakeup is None:
+            # Not ours (e.g. tracked by another worker, which will pick it up by polling)
+            return False
+        wakeup.set()
+        return True
+
+    def stats(self):
+        with self._lock:
+            return {
+                "outstanding": len(self._wakeups),
+                "max_outstanding": self.max_outstanding,
+                "webhooks_enabled": bool(self.webhook_url),
+                **self._counts,
+                "slots": self._slots.stats(),
+            }
+
+
+prediction_tracker = PredictionTracker.from_env()
@@ -0,0 +1,336 @@
+"""
+Rate limiting, retries and circuit breaking for provider calls.
+
+Every provider (Gemini, Replicate) gets a `ProviderGuard` that applies, in order:
+
+- a circuit breaker: after `failure_threshold` consecutive failures the
+  provider is considered down and calls fail fast with CircuitOpenError for
+  `reset_timeout` seconds, after which one trial call is let through;
+- a token bucket, so bursts are smoothed to the provider's quota instead of
+  being answered with 429s;
+- retries with decorrelated jitter (sleep = min(cap, uniform(base, 3 * last)))
+  for errors the caller's predicate marks as retryable.
+
+A request deadline set with `deadline()` is carried in a context variable
+(into executor threads and tasks too); limiter waits and retry sleeps never
+run past it, and DeadlineExceeded is raised instead.
+"""
+
+import asyncio
+import logging
+import os
+import random
+import threading
+import time
+from contextlib import contextmanager
+from contextvars import ContextVar
+
+logger = logging.getLogger(__name__)
+
+_deadline = ContextVar("request_deadline", default=None)
+
+# HTTP statuses worth retrying: timeouts, throttling and transient server errors
+RETRYABLE_STATUSES = {408, 429, 500, 502, 503, 504}
+
+
+class CircuitOpenError(RuntimeError):
+    """The provider's circuit breaker is open; the call was not attempted."""
+
+    def __init__(self, provider: str, retry_after: float) -> None:
+        super().__init__(f"{provider} is unavailable after repeated failures, please retry later")
+        self.provider = provider
+        self.retry_after = max(1, int(retry_after + 0.5))
+
+
+class DeadlineExceeded(TimeoutError):
+    """The request's time budget ran out before the provider call could be (re)tried."""
+
+
+@contextmanager
+def deadline(seconds: float):
+    """Give the enclosed work at most `seconds`; nested deadlines can only shorten it."""
+    if not seconds:
+        yield
+        return
+    new = time.monotonic() + seconds
+    current = _deadline.get()
+    token = _deadline.set(new if current is None else min(current, new))
+    try:
+        yield
+    finally:
+        _deadline.reset(token)
+
+
+def time_remaining():
+    """Seconds left in the current deadline, or None if there is none."""
+    current = _deadline.get()
+    return None if current is None else current - time.monotonic()
+
+
+def status_of(exc: BaseException):
+    """HTTP status carried by a provider SDK exception, if any."""
+    for attr in ("code", "status", "status_code"):
+        value = getattr(exc, attr, None)
+        if isinstance(value, int):
+            return value
+    response = getattr(exc, "response", None)
+    return getattr(response, "status_code", None)
+
+
+class TokenBucket:
+    def __init__(self, rate: float, burst: int) -> None:
+        self.rate = rate
+        self.burst = burst
+        self._tokens = float(burst)
+        self._updated = time.monotonic()
+        self._lock = threading.Lock()
+        self._waiting = 0
+        self._throttled = 0
+        self._wait_seconds = 0.0
+
+    def _reserve(self):
+        """Take a token; returns how long the caller must wait before using it (0 if none)."""
+        with self._lock:
+            now = time.monotonic()
+            self._tokens = min(self.burst, self._tokens + (now - self._updated) * self.rate)
+            self._updated = now
+            # Going negative queues the caller behind earlier reservations
+            self._tokens -= 1
+            wait = 0.0 if self._tokens >= 0 else -self._tokens / self.rate
+            if wait:
+                self._throttled += 1
+                self._wait_seconds += wait
+            return wait
+
+    def _refund(self):
+        with self._lock:
+            self._tokens = min(self.burst, self._tokens + 1)
+
+    def _check_deadline(self, wait: float):
+        remaining = time_remaining()
+        if remaining is not None and wait > remaining:
+            self._refund()
+            raise DeadlineExceeded(f"Rate limit wait of {wait:.1f}s exceeds the remaining budget")
+
+    def acquire(self):
+        if not self.rate:
+            return
+        wait = self._reserve()
+        if wait:
+            self._check_deadline(wait)
+            with self._lock:
+                self._waiting += 1
+            try:
+                time.sleep(wait)
+            finally:
+                with self._lock:
+                    self._waiting -= 1
+
+    async def acquire_async(self):
+        if not self.rate:
+            return
+        wait = self._reserve()
+        if wait:
+            self._check_deadline(wait)
+            with self._lock:
+                self._waiting += 1
+            try:
+                await asyncio.sleep(wait)
+            finally:
+                with self._lock:
+                    self._waiting -= 1
+
+    def stats(self):
+        with self._lock:
+            tokens = min(self.burst, self._tokens + (time.monotonic() - self._updated) * self.rate)
+            return {
+                "rate": self.rate,
+                "burst": self.burst,
+                "tokens": round(tokens, 2),
+                # 1.0 means every token is spent and callers are queueing
+                "saturation": round(min(1.0, max(0.0, 1 - tokens / self.burst)), 3) if self.burst else 0.0,
+                "waiting": self._waiting,
+                "throttled": self._throttled,
+                "wait_seconds": round(self._wait_seconds, 3),
+            }
+
+
+class CircuitBreaker:
+    CLOSED, OPEN, HALF_OPEN = "closed", "open", "half_open"
+
+    def __init__(self, name: str, failure_threshold: int, reset_timeout: float) -> None:
+        self.name = name
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self._state = self.CLOSED
+        self._failures = 0
+        self._opened_at = 0.0
+        self._trial_in_flight = False
+        self._opened = 0
+        self._rejected = 0
+        self._lock = threading.Lock()
+
+    def before_call(self):
+        with self._lock:
+            if self._state == self.OPEN:
+                elapsed = time.monotonic() - self._opened_at
+                if elapsed < self.reset_timeout:
+                    self._rejected += 1
+                    raise CircuitOpenError(self.name, self.reset_timeout - elapsed)
+                self._state = self.HALF_OPEN
+                self._trial_in_flight = False
+            if self._state == self.HALF_OPEN:
+                if self._trial_in_flight:
+                    self._rejected += 1
+                    raise CircuitOpenError(self.name, 1)
+                self._trial_in_flight = True
+
+    def record_success(self):
+        with self._lock:
+            if self._state != self.CLOSED:
+                logger.info(f"[CircuitBreaker] {self.name} recovered, closing")
+            self._state = self.CLOSED
+            self._failures = 0
+            self._trial_in_flight = False
+
+    def record_failure(self):
+        with self._lock:
+            self._failures += 1
+            self._trial_in_flight = False
+            if self._state == self.HALF_OPEN or self._failures >= self.failure_threshold:
+                if self._state != self.OPEN:
+                    logger.warning(f"[CircuitBreaker] {self.name} opened after {self._failures} failures")
+                    self._opened += 1
+                self._state = self.OPEN
+                self._opened_at = time.monotonic()
+
+    def release_trial(self):
+        """Give up a half-open trial slot without counting a success or failure (e.g. a client error)."""
+        with self._lock:
+            self._trial_in_flight = False
+
+    def stats(self):
+        with self._lock:
+            state = self._state
+            if state == self.OPEN and time.monotonic() - self._opened_at >= self.reset_timeout:
+                state = self.HALF_OPEN
+            return {
+                "state": state,
+                "consecutive_failures": self._failures,
+                "times_opened": self._opened,
+                "rejected": self._rejected,
+            }
+
+
+class ProviderGuard:
+    def __init__(
+        self,
+        name: str,
+        limiter: TokenBucket,
+        breaker: CircuitBreaker,
+        is_retryable,
+        max_attempts: int = 3,
+        base_delay: float = 0.5,
+        max_delay: float = 10.0,
+    ) -> None:
+        self.name = name
+        self.limiter = limiter
+        self.breaker = breaker
+        self.is_retryable = is_retryable
+        self.max_attempts = max_attempts
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self._retries = 0
+        self._lock = threading.Lock()
+
+    @classmethod
+    def from_env(cls, name: str, is_retryable, rate: float, burst: int):
+        """Settings come from <NAME>_RATE_LIMIT, <NAME>_RATE_BURST and shared PROVIDER_* variables."""
+        prefix = name.upper()
+        return cls(
+            name,
+            TokenBucket(float(os.getenv(f"{prefix}_RATE_LIMIT", rate)), int(os.getenv(f"{prefix}_RATE_BURST", burst))),
+            CircuitBreaker(
+                name,
+                failure_threshold=int(os.getenv("PROVIDER_BREAKER_FAILURES", 5)),
+                reset_timeout=float(os.getenv("PROVIDER_BREAKER_RESET", 30)),
+            ),
+            is_retryable,
+            max_attempts=int(os.getenv("PROVIDER_RETRY_ATTEMPTS", 3)),
+            base_delay=float(os.getenv("PROVIDER_RETRY_BASE", 0.5)),
+            max_delay=float(os.getenv("PROVIDER_RETRY_MAX", 10)),
+        )
+
+    def _check_budget(self):
+        remaining = time_remaining()
+        if remaining is not None and remaining <= 0:
+            raise DeadlineExceeded(f"Request budget spent before calling {self.name}")
+
+    def _next_delay(self, previous: float):
+        return min(self.max_delay, random.uniform(self.base_delay, previous * 3))
+
+    def _should_retry(self, exc: BaseException, attempt: int, delay: float):
+        """Record the failed attempt; True if another attempt should be made after `delay`."""
+        retryable = self.is_retryable(exc)
+        if retryable:
+            self.breaker.record_failure()
+        else:
+            # Not the provider's fault (bad input etc.); don't hold the provider against it
+            self.breaker.release_trial()
+        if not retryable or attempt >= self.max_attempts:
+            return False
+        remaining = time_remaining()
+        if remaining is not None and delay >= remaining:
+            logger.warning(f"[ProviderGuard] {self.name}: no budget left to retry after {exc!r}")
+            return False
+        with self._lock:
+            self._retries += 1
+        logger.warning(f"[ProviderGuard] {self.name} attempt {attempt} failed ({exc!r}), retrying in {delay:.2f}s")
+        return True
+
+    def call(self, fn, *args, **kwargs):
+        """Run a blocking provider call under the breaker, limiter and retry policy."""
+        delay = self.base_delay
+        for attempt in range(1, self.max_attempts + 1):
+            self._check_budget()
+            self.breaker.before_call()
+            try:
+                self.limiter.acquire()
+                result = fn(*args, **kwargs)
+            except DeadlineExceeded:
+                self.breaker.release_trial()
+                raise
+            except Exception as e:
+                delay = self._next_delay(delay)
+                if not self._should_retry(e, attempt, delay):
+                    raise
+                time.sleep(delay)
+                continue
+            self.breaker.record_success()
+            return result
+
+    async def call_async(self, coro_fn, *args, **kwargs):
+        """Await a provider coroutine under the breaker, limiter and retry policy."""
+        delay = self.base_delay
+        for attempt in range(1, self.max_attempts + 1):
+            self._check_budget()
+            self.breaker.before_call()
+            try:
+                await self.limiter.acquire_async()
+                result = await coro_fn(*args, **kwargs)
+            except (DeadlineExceeded, asyncio.CancelledError):
+                self.breaker.release_trial()
+                raise
+            except Exception as e:
+                delay = self._next_delay(delay)
+                if not self._should_retry(e, attempt, delay):
+                    raise
+                await asyncio.sleep(delay)
+                continue
+            self.breaker.record_success()
+            return result
+
+    def stats(self):
+        with self._lock:
+            retries = self._retries
+        return {"breaker": self.breaker.stats(), "limiter": self.limiter.stats(), "retries": retries}
@@ -0,0 +1,134 @@
+"""
+Latency- and error-aware choice between interchangeable 3D backends.
+
+`LatencyRouter` keeps an exponentially weighted moving average (EWMA) of each
+backend's completion time and failure rate. A backend's expected completion
+time is its latency divided by its success probability, i.e. the expected cost
+if every failure had to be paid for again. Requests go to the backend with the
+lowest expected time. A backend that failed recently is not written off: its
+error rate decays with a half-life, so it is tried again once it has been
+quiet for a while.
+
+The router only ranks and records; `RoutedThreeDModel` in gen_pipeline.py
+decides when to hedge or fall back using `hedge_after()`.
+"""
+
+import os
+import threading
+import time
+
+
+class BackendStats:
+    def __init__(self, prior_latency: float) -> None:
+        self.latency = prior_latency
+        self.error_rate = 0.0
+        self.updated = time.monotonic()
+        self.in_flight = 0
+        self.samples = 0
+        self.successes = 0
+        self.failures = 0
+
+
+class LatencyRouter:
+    def __init__(
+        self,
+        backends,
+        alpha: float = 0.3,
+        prior_latency: float = 60.0,
+        error_half_life: float = 300.0,
+        hedge_factor: float = 2.0,
+        hedge_min: float = 30.0,
+    ) -> None:
+        self.backends = list(backends)
+        self.alpha = alpha
+        self.prior_latency = prior_latency
+        self.error_half_life = error_half_life
+        self.hedge_factor = hedge_factor
+        self.hedge_min = hedge_min
+        self._stats = {name: BackendStats(prior_latency) for name in self.backends}
+        self._lock = threading.Lock()
+        self._counts = {"routed": 0, "hedged": 0, "hedge_wins": 0, "fallbacks": 0}
+
+    @classmethod
+    def from_env(cls):
+        return cls(
+            # Only backends known to work; opt others (e.g. hunyuan3d) in with ROUTER_BACKENDS
+            backends=[name.strip() for name in os.getenv("ROUTER_BACKENDS", "trellis").split(",") if name.strip()],
+            alpha=float(os.getenv("ROUTER_EWMA_ALPHA", 0.3)),
+            prior_latency=float(os.getenv("ROUTER_PRIOR_LATENCY", 60)),
+            error_half_life=float(os.getenv("ROUTER_ERROR_HALF_LIFE", 300)),
+            hedge_factor=float(os.getenv("ROUTER_HEDGE_FACTOR", 2.0)),
+            hedge_min=float(os.getenv("ROUTER_HEDGE_MIN", 30)),
+        )
+
+    def _error_rate(self, stats: BackendStats, now: float):
+        """Error rate decayed toward zero for the time since the backend was last heard from."""
+        if not self.error_half_life:
+            return stats.error_rate
+        return stats.error_rate * 0.5 ** ((now - stats.updated) / self.error_half_life)
+
+    def _expected_time(self, stats: BackendStats, now: float):
+        success = max(0.05, 1 - self._error_rate(stats, now))
+        return stats.latency / success
+
+    def ranked(self, exclude=()):
+        """Backends ordered by expected completion time, best first; ties keep the configured order."""
+        now = time.monotonic()
+        with self._lock:
+            scored = [
+                (self._expected_time(stats, now), position, name)
+                for position, (name, stats) in enumerate(self._stats.items())
+                if name not in exclude
+            ]
+        return [name for _, _, name in sorted(scored)]
+
+    def hedge_after(self, name: str):
+        """Seconds to wait on `name` before starting a second backend alongside it."""
+        with self._lock:
+            return max(self.hedge_min, self.hedge_factor * self._stats[name].latency)
+
+    def started(self, name: str):
+        with self._lock:
+            self._stats[name].in_flight += 1
+
+    def finished(self, name: str, seconds: float, ok: bool):
+        """
+        Fold one attempt into the model. Failures count toward the error rate only; an attempt
+        abandoned after `seconds` (ok=None) was at least that slow, so it can only raise the latency.
+        """
+        now = time.monotonic()
+        with self._lock:
+            stats = self._stats[name]
+            stats.in_flight -= 1
+            if ok is not None:
+                stats.error_rate = self._error_rate(stats, now)
+                stats.error_rate += self.alpha * ((0.0 if ok else 1.0) - stats.error_rate)
+                stats.updated = now
+                if ok:
+                    stats.successes += 1
+                else:
+                    stats.failures += 1
+            if ok or (ok is None and seconds > stats.latency):
+                stats.latency += self.alpha * (seconds - stats.latency)
+                stats.samples += 1
+
+    def count(self, event: str):
+        with self._lock:
+            self._counts[event] += 1
+
+    def stats(self):
+        now = time.monotonic()
+        with self._lock:
+            backends = {
+                name: {
+                    "latency_seconds": round(stats.latency, 3),
+                    "error_rate": round(self._error_rate(stats, now), 4),
+                    "expected_seconds": round(self._expected_time(stats, now), 3),
+                    "in_flight": stats.in_flight,
+                    "samples": stats.samples,
+                    "successes": stats.successes,
+                    "failures": stats.failures,
+                }
+                for name, stats in self._stats.items()
+            }
+            return {"backends": backends, **self._counts}
@@ -0,0 +1,258 @@
+"""
+Fair sharing of provider capacity between users, with priority lanes.
+
+Each generation runs on behalf of a client: a user id and a lane,
+"interactive" (a person waiting on a single design) or "batch" (background
+variations). The client is carried in a context variable, like the request
+deadline, so it follows the work into executor threads and tasks.
+
+`FairSlots` is a counting semaphore that, when its slots are all taken,
+hands the next free one out by start-time fair queuing (SFQ) instead of
+first come, first served. Waiters are grouped into flows per (user, lane);
+each waiter gets a virtual start tag
+
+    start = max(virtual time, previous finish of its flow)
+    finish = start + 1 / lane weight
+
+and the waiter with the lowest start tag goes next. A user with fifty queued
+calls and a user with one therefore alternate rather than the second waiting
+behind all fifty, and an interactive call (weight 4 by default) gets four
+turns for every batch call without ever starving the batch lane. A per-user
+cap keeps one identified user from holding every slot at once; callers that
+send no user id share the anonymous flow, which is not capped, so they get
+the same capacity they had before users were told apart.
+"""
+
+import asyncio
+import math
+import os
+import threading
+import time
+from collections import deque
+from contextlib import asynccontextmanager, contextmanager
+from contextvars import ContextVar
+from typing import NamedTuple
+
+from resilience import DeadlineExceeded, time_remaining
+
+INTERACTIVE, BATCH = "interactive", "batch"
+LANES = (INTERACTIVE, BATCH)
+ANONYMOUS = "anonymous"
+
+
+class Client(NamedTuple):
+    user: str
+    lane: str
+
+
+_client = ContextVar("scheduling_client", default=Client(ANONYMOUS, INTERACTIVE))
+
+
+def _lane_weights_from_env():
+    """LANE_WEIGHTS="interactive=4,batch=1"; lanes left out keep their default."""
+    weights = {INTERACTIVE: 4.0, BATCH: 1.0}
+    for item in os.getenv("LANE_WEIGHTS", "").split(","):
+        if "=" in item:
+            lane, weight = item.split("=", 1)
+            weights[lane.strip()] = float(weight)
+    return weights
+
+
+LANE_WEIGHTS = _lane_weights_from_env()
+# Fraction of a stage's slots one identified user may hold at once (anonymous callers are exempt)
+USER_MAX_SHARE = float(os.getenv("USER_MAX_SHARE", 0.75))
+
+
+@contextmanager
+def client_context(user_id: str = None, priority: str = INTERACTIVE):
+    """Run the enclosed work on behalf of `user_id` in the `priority` lane."""
+    if priority not in LANES:
+        raise ValueError(f"Unknown priority '{priority}'; expected one of {', '.join(LANES)}")
+    token = _client.set(Client(user_id or ANONYMOUS, priority))
+    try:
+        yield
+    finally:
+        _client.reset(token)
+
+
+def current_client():
+    return _client.get()
+
+
+class _Waiter:
+    __slots__ = ("client", "start", "wake", "granted")
+
+    def __init__(self, client: Client, wake) -> None:
+        self.client = client
+        self.start = 0.0
+        self.wake = wake
+        self.granted = False
+
+
+class _Flow:
+    __slots__ = ("waiters", "finish")
+
+    def __init__(self, finish: float) -> None:
+        self.waiters = deque()
+        self.finish = finish
+
+
+class FairSlots:
+    def __init__(self, name: str, limit: int, user_limit: int = None, lane_weights: dict = None) -> None:
+        self.name = name
+        self.limit = limit
+        self.user_limit = user_limit or limit
+        self.lane_weights = dict(lane_weights or LANE_WEIGHTS)
+        self._lock = threading.Lock()
+        self._flows = {}
+        self._vtime = 0.0
+        self._active = 0
+        self._active_by_user = {}
+        self._waiting = 0
+        self._granted = {lane: 0 for lane in self.lane_weights}
+        self._queued = {lane: 0 for lane in self.lane_weights}
+        self._wait_seconds = {lane: 0.0 for lane in self.lane_weights}
+
+    @classmethod
+    def from_env(cls, name: str, limit: int):
+        """Per-user cap from USER_MAX_SHARE, lane weights from LANE_WEIGHTS."""
+        return cls(name, limit, user_limit=max(1, math.ceil(limit * USER_MAX_SHARE)))
+
+    def _enqueue(self, waiter: _Waiter):
+        flow = self._flows.get(waiter.client)
+        if flow is None:
+            flow = self._flows[waiter.client] = _Flow(self._vtime)
+        waiter.start = max(self._vtime, flow.finish)
+        flow.finish = waiter.start + 1.0 / self.lane_weights.get(waiter.client.lane, 1.0)
+        flow.waiters.append(waiter)
+        self._waiting += 1
+
+    def _dispatch(self):
+        """Grant free slots to the lowest start tags among users under their cap. Holds the lock."""
+        while self._active < self.limit and self._waiting:
+            heads = [
+                (flow.waiters[0].start, key, flow)
+                for key, flow in self._flows.items()
+                if flow.waiters and (key.user == ANONYMOUS or self._active_by_user.get(key.user, 0) < self.user_limit)
+            ]
+            if not heads:
+                break
+            start, key, flow = min(heads, key=lambda head: head[0])
+            waiter = flow.waiters.popleft()
+            self._waiting -= 1
+            self._vtime = max(self._vtime, start)
+            self._take(key)
+            waiter.granted = True
+            waiter.wake()
+        # Forget idle flows that no longer carry credit ahead of the virtual clock
+        for key in [key for key, flow in self._flows.items() if not flow.waiters and flow.finish <= self._vtime]:
+            del self._flows[key]
+
+    def _take(self, client: Client):
+        self._active += 1
+        self._active_by_user[client.user] = self._active_by_user.get(client.user, 0) + 1
+        self._granted[client.lane] = self._granted.get(client.lane, 0) + 1
+
+    def _release(self, client: Client):
+        with self._lock:
+            self._active -= 1
+            held = self._active_by_user[client.user] - 1
+            if held:
+                self._active_by_user[client.user] = held
+            else:
+                del self._active_by_user[client.user]
+            self._dispatch()
+
+    def _abandon(self, waiter: _Waiter):
+        """Drop a waiter that gave up; True if it had been granted meanwhile and must release."""
+        with self._lock:
+            if waiter.granted:
+                return True
+            self._flows[waiter.client].waiters.remove(waiter)
+            self._waiting -= 1
+            self._dispatch()
+            return False
+
+    def _record_wait(self, client: Client, seconds: float):
+        with self._lock:
+            self._queued[client.lane] = self._queued.get(client.lane, 0) + 1
+            self._wait_seconds[client.lane] = self._wait_seconds.get(client.lane, 0.0) + seconds
+
+    @contextmanager
+    def slot(self):
+        """Hold one slot (blocking) for the duration of the block. Waits give up at the request deadline."""
+        client = current_client()
+        event = threading.Event()
+        waiter = _Waiter(client, event.set)
+        with self._lock:
+            self._enqueue(waiter)
+            self._dispatch()
+        if not waiter.granted:
+            started = time.monotonic()
+            if not event.wait(time_remaining()):
+                if not self._abandon(waiter):
+                    raise DeadlineExceeded(f"Request budget spent waiting for a {self.name} slot")
+            self._record_wait(client, time.monotonic() - started)
+        try:
+            yield
+        finally:
+            self._release(client)
+
+    @asynccontextmanager
+    async def slot_async(self):
+        """slot() for coroutines: waiting holds no thread, and a cancelled waiter leaves the queue."""
+        client = current_client()
+        loop = asyncio.get_running_loop()
+        granted = loop.create_future()
+
+        def wake():
+            loop.call_soon_threadsafe(lambda: granted.done() or granted.set_result(None))
+
+        waiter = _Waiter(client, wake)
+        with self._lock:
+            self._enqueue(waiter)
+            self._dispatch()
+        if not waiter.granted:
+            started = time.monotonic()
+            try:
+                await asyncio.wait_for(granted, time_remaining())
+            except (asyncio.CancelledError, asyncio.TimeoutError) as e:
+                if self._abandon(waiter):
+                    self._release(client)
+                if isinstance(e, asyncio.TimeoutError):
+                    raise DeadlineExceeded(f"Request budget spent waiting for a {self.name} slot") from None
+                raise
+            self._record_wait(client, time.monotonic() - started)
+        try:
+            yield
+        finally:
+            self._release(client)
+
+    def stats(self):
+        with self._lock:
+            users = {}
+            for key, flow in self._flows.items():
+                if flow.waiters:
+                    entry = users.setdefault(key.user, {"active": 0, "waiting": {}})
+                    entry["waiting"][key.lane] = len(flow.waiters)
+            for user, active in self._active_by_user.items():
+                users.setdefault(user, {"active": 0, "waiting": {}})["active"] = active
+            waiting = {lane: 0 for lane in self.lane_weights}
+            for key, flow in self._flows.items():
+                waiting[key.lane] = waiting.get(key.lane, 0) + len(flow.waiters)
+            return {
+                "active": self._active,
+                "limit": self.limit,
+                "user_limit": self.user_limit,
+                "waiting": waiting,
+                "lanes": {
+                    lane: {
+                        "weight": weight,
+                        "granted": self._granted.get(lane, 0),
+                        "queued": self._queued.get(lane, 0),
+                        "wait_seconds": round(self._wait_seconds.get(lane, 0.0), 3),
+                    }
+                    for lane, weight in self.lane_weights.items()
+                },
+                "users": users,
+            }
@@ -0,0 +1,305 @@
+"""
+Near-duplicate prompt lookup, so a prompt close to one already generated can
+reuse (or be offered) what that earlier prompt produced.
+
+The result cache only hits on the exact same prompt. `PromptIndex` also finds
+paraphrases that share most of their wording ("cherry blossom keycap with gold
+legends" vs "gold legend cherry-blossom keycaps") without an embedding model:
+
+- Prompts are normalized (lowercased, punctuation and filler words such as
+  "keycap" dropped, optional synonyms applied) and split into character
+  n-grams ("shingles").
+- Their similarity is the Jaccard index of the two shingle sets.
+- Each prompt gets a MinHash signature: for each of bands x rows hash
+  functions, the minimum hash over its shingles. Two signatures agree in any
+  one position with probability equal to the prompts' Jaccard similarity.
+- Signatures are cut into bands (locality-sensitive hashing). Prompts that
+  agree on every position of at least one band share that band's bucket, so
+  a lookup only compares against prompts in the query's buckets. With 32
+  bands of 4 rows, a pair at similarity 0.6 shares a bucket 99% of the time,
+  and a pair at 0.2 does 5% of the time.
+
+The buckets live in SQLite, indexed by bucket hash, so inserts are
+incremental, the index survives restarts and a lookup costs one index probe
+per band however many prompts are stored. Candidates are ranked by their
+exact Jaccard similarity. Character n-grams catch reworded, reordered,
+pluralized and misspelled prompts, but not true synonyms ("sakura" vs
+"cherry blossom"); those can be mapped in a synonyms file.
+"""
+
+import hashlib
+import json
+import logging
+import os
+import random
+import re
+import sqlite3
+import struct
+import threading
+import time
+import zlib
+from pathlib import Path
+
+logger = logging.getLogger(__name__)
+
+# Mersenne prime for the universal hash family h(x) = (a * x + b) mod P
+_PRIME = (1 << 61) - 1
+_MAX_HASH = (1 << 32) - 1
+_WORD = re.compile(r"[a-z0-9]+")
+# Words that say nothing about the design, since every prompt is for a keycap
+STOPWORDS = frozenset({
+    "a", "an", "the", "of", "with", "and", "in", "on", "for", "to", "my", "me", "please",
+    "keycap", "keycaps", "key", "cap", "caps", "keyboard", "mechanical", "design", "style", "styled", "make", "create", "generate",
+})
+# Candidates compared exactly per lookup, most recent first
+MAX_CANDIDATES = 500
+
+
+def load_synonyms(path):
+    """{"sakura": "cherry blossom", ...} from a JSON file, or {} if `path` is unset."""
+    if not path:
+        return {}
+    with open(path) as f:
+        return {str(word).lower(): str(replacement).lower() for word, replacement in json.load(f).items()}
+
+
+class PromptIndex:
+    def __init__(
+        self,
+        path: Path,
+        bands: int = 32,
+        rows: int = 4,
+        shingle_size: int = 3,
+        synonyms: dict = None,
+        enabled: bool = True,
+        seed: int = 1,
+    ) -> None:
+        self.enabled = enabled
+        self.bands = bands
+        self.rows = rows
+        self.shingle_size = shingle_size
+        self.synonyms = dict(synonyms or {})
+        rng = random.Random(seed)
+        self._permutations = [(rng.randrange(1, _PRIME), rng.randrange(0, _PRIME)) for _ in range(bands * rows)]
+        self._lock = threading.Lock()
+        self._stats = {"lookups": 0, "matches": 0, "candidates": 0, "inserts": 0}
+        self._path = str(path)
+        self._conn = None
+        self._conn_pid = None
+        if not enabled:
+            return
+        Path(path).parent.mkdir(parents=True, exist_ok=True)
+        conn = self._connection()
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute(
+            """
+            CREATE TABLE IF NOT EXISTS prompts (
+                id INTEGER PRIMARY KEY,
+                prompt TEXT NOT NULL,
+                normalized TEXT NOT NULL,
+                image_model TEXT NOT NULL,
+                image_id TEXT UNIQUE,
+                image TEXT NOT NULL,
+                models TEXT NOT NULL DEFAULT '{}',
+                created REAL NOT NULL
+            )
+            """
+        )
+        conn.execute(
+            "CREATE TABLE IF NOT EXISTS buckets (bucket INTEGER NOT NULL, prompt_id INTEGER NOT NULL, "
+            "PRIMARY KEY (bucket, prompt_id)) WITHOUT ROWID"
+        )
+        conn.execute("CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT NOT NULL)")
+        self._check_parameters()
+
+    def _connection(self):
+        """This process's connection; one opened before a fork (gunicorn preload_app) is never reused."""
+        if self._conn_pid != os.getpid():
+            self._conn = sqlite3.connect(self._path, check_same_thread=False, isolation_level=None, timeout=30)
+            self._conn_pid = os.getpid()
+        return self._conn
+
+    @classmethod
+    def from_env(cls, state_dir: Path):
+        return cls(
+            os.getenv("SIMILAR_INDEX_PATH", str(Path(state_dir) / "prompts.sqlite3")),
+            bands=int(os.getenv("SIMILAR_BANDS", 32)),
+            rows=int(os.getenv("SIMILAR_ROWS", 4)),
+            shingle_size=int(os.getenv("SIMILAR_SHINGLE_SIZE", 3)),
+            synonyms=load_synonyms(os.getenv("SIMILAR_SYNONYMS_PATH")),
+            enabled=os.getenv("SIMILAR_INDEX_ENABLED", "1") != "0",
+        )
+
+    # -- hashing --------------------------------------------------------
+
+    def normalize(self, prompt: str):
+        words = []
+        for word in _WORD.findall(prompt.lower()):
+            words.extend(self.synonyms.get(word, word).split())
+        return " ".join(word for word in words if word not in STOPWORDS)
+
+    def shingles(self, normalized: str):
+        text = f" {normalized} "
+        size = self.shingle_size
+        return {text[i:i + size] for i in range(max(len(text) - size + 1, 1))}
+
+    def signature(self, shingles):
+        hashes = [zlib.crc32(shingle.encode("utf-8")) for shingle in shingles]
+        return [min((a * h + b) % _PRIME for h in hashes) & _MAX_HASH for a, b in self._permutations]
+
+    def band_keys(self, signature):
+        """One bucket id per band, as signed 64-bit integers for SQLite."""
+        keys = []
+        for band in range(self.bands):
+            values = signature[band * self.rows:(band + 1) * self.rows]
+            digest = hashlib.blake2b(struct.pack(f"<H{self.rows}I", band, *values), digest_size=8).digest()
+            keys.append(int.from_bytes(digest, "little", signed=True))
+        return keys
+
+    @staticmethod
+    def jaccard(a: set, b: set):
+        return len(a & b) / len(a | b) if a or b else 0.0
+
+    def _parameters(self):
+        synonyms = hashlib.sha256(json.dumps(self.synonyms, sort_keys=True).encode()).hexdigest()[:16]
+        return json.dumps({
+            "bands": self.bands, "rows": self.rows, "shingle_size": self.shingle_size,
+            "permutations": hashlib.sha256(repr(self._permutations).encode()).hexdigest()[:16],
+            "stopwords": hashlib.sha256(" ".join(sorted(STOPWORDS)).encode()).hexdigest()[:16],
+            "synonyms": synonyms,
+        }, sort_keys=True)
+
+    def _check_parameters(self):
+        """Rebuild the buckets if the hashing settings changed since they were written."""
+        conn = self._connection()
+        parameters = self._parameters()
+        row = conn.execute("SELECT value FROM meta WHERE key = 'parameters'").fetchone()
+        if row is not None and row[0] == parameters:
+            return
+        rows = conn.execute("SELECT id, prompt FROM prompts").fetchall()
+        if rows:
+            logger.info(f"[PromptIndex] Hashing settings changed, re-indexing {len(rows)} prompts")
+        start = time.perf_counter()
+        with self._lock:
+            conn.execute("BEGIN IMMEDIATE")
+            try:
+                conn.execute("DELETE FROM buckets")
+                for prompt_id, prompt in rows:
+                    normalized = self.normalize(prompt)
+                    conn.execute("UPDATE prompts SET normalized = ? WHERE id = ?", (normalized, prompt_id))
+                    if normalized:
+                        self._insert_buckets(conn, prompt_id, normalized)
+                conn.execute("INSERT OR REPLACE INTO meta (key, value) VALUES ('parameters', ?)", (parameters,))
+                conn.execute("COMMIT")
+            except BaseException:
+                conn.execute("ROLLBACK")
+                raise
+        if rows:
+            logger.info(f"[PromptIndex] Re-indexed in {time.perf_counter() - start:.1f}s")
+
+    def _insert_buckets(self, conn, prompt_id: int, normalized: str):
+        keys = self.band_keys(self.signature(self.shingles(normalized)))
+        conn.executemany("INSERT OR IGNORE INTO buckets (bucket, prompt_id) VALUES (?, ?)", [(key, prompt_id) for key in keys])
+
+    # -- index ----------------------------------------------------------
+
+    def add(self, prompt: str, image_model: str, image: dict):
+        """Index a generated image under its prompt. Prompts with nothing left after normalizing are skipped."""
+        if not self.enabled:
+            return
+        normalized = self.normalize(prompt)
+        if not normalized:
+            return
+        with self._lock:
+            conn = self._connection()
+            conn.execute("BEGIN IMMEDIATE")
+            try:
+                cursor = conn.execute(
+                    "INSERT OR IGNORE INTO prompts (prompt, normalized, image_model, image_id, image, created) VALUES (?, ?, ?, ?, ?, ?)",
+                    (prompt, normalized, image_model.lower(), image.get("id"), json.dumps(image), time.time()),
+                )
+                if cursor.rowcount:
+                    self._insert_buckets(conn, cursor.lastrowid, normalized)
+                conn.execute("COMMIT")
+            except BaseException:
+                conn.execute("ROLLBACK")
+                raise
+            self._stats["inserts"] += 1
+
+    def attach_model(self, image_id: str, three_d_model: str, result: dict):
+        """Record the 3D result generated from an indexed image; a no-op for images not in the index."""
+        if not self.enabled or not image_id:
+            return
+        with self._lock:
+            conn = self._connection()
+            conn.execute("BEGIN IMMEDIATE")
+            try:
+                row = conn.execute("SELECT id, models FROM prompts WHERE image_id = ?", (image_id,)).fetchone()
+                if row is not None:
+                    models = json.loads(row[1])
+                    models[three_d_model.lower()] = result
+                    conn.execute("UPDATE prompts SET models = ? WHERE id = ?", (json.dumps(models), row[0]))
+                conn.execute("COMMIT")
+            except BaseException:
+                conn.execute("ROLLBACK")
+                raise
+
+    def remove(self, prompt_id: int):
+        """Drop an entry whose files are gone."""
+        with self._lock:
+            conn = self._connection()
+            conn.execute("DELETE FROM prompts WHERE id = ?", (prompt_id,))
+            # Dangling bucket rows are skipped on lookup and cost one row each; no scan to find them
+
+    def search(self, prompt: str, image_model: str = None, limit: int = 5, min_similarity: float = 0.3):
+        """
+        Indexed prompts similar to `prompt`, most similar first:
+        [{"id", "prompt", "similarity", "image_model", "image": {...}, "models": {name: result}}].
+        """
+        if not self.enabled:
+            return []
+        normalized = self.normalize(prompt)
+        if not normalized:
+            return []
+        shingles = self.shingles(normalized)
+        keys = self.band_keys(self.signature(shingles))
+        placeholders = ",".join("?" * len(keys))
+        with self._lock:
+            conn = self._connection()
+            ids = [row[0] for row in conn.execute(
+                f"SELECT DISTINCT prompt_id FROM buckets WHERE bucket IN ({placeholders}) ORDER BY prompt_id DESC LIMIT ?",
+                (*keys, MAX_CANDIDATES),
+            )]
+            rows = conn.execute(
+                f"SELECT id, prompt, normalized, image_model, image, models FROM prompts WHERE id IN ({','.join('?' * len(ids))})",
+                ids,
+            ).fetchall() if ids else []
+            self._stats["lookups"] += 1
+            self._stats["candidates"] += len(rows)
+
+        matches = []
+        for prompt_id, original, candidate, candidate_model, image, models in rows:
+            if image_model is not None and candidate_model != image_model.lower():
+                continue
+            similarity = 1.0 if candidate == normalized else self.jaccard(shingles, self.shingles(candidate))
+            if similarity >= min_similarity:
+                matches.append({
+                    "id": prompt_id, "prompt": original, "similarity": round(similarity, 4),
+                    "image_model": candidate_model, "image": json.loads(image), "models": json.loads(models),
+                })
+        matches.sort(key=lambda match: (match["similarity"], match["id"]), reverse=True)
+        if matches:
+            with self._lock:
+                self._stats["matches"] += 1
+        return matches[:limit]
+
+    def size(self):
+        """Number of indexed prompts (a table scan; keep it off hot paths)."""
+        if not self.enabled:
+            return 0
+        with self._lock:
+            return self._connection().execute("SELECT count(*) FROM prompts").fetchone()[0]
+
+    def stats(self):
+        with self._lock:
+            return {"enabled": self.enabled, "bands": self.bands, "rows": self.rows, **self._stats}
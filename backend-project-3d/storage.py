@@ -0,0 +1,316 @@
+"""
+Lifecycle management for OUTPUT_DIR.
+
+New outputs are sharded into two-hex-character subdirectories (outputs/ab/ab12...png)
+so no single directory grows without bound. Every file is recorded in a SQLite
+index with its size, creation and last-access time, and a background thread
+evicts files past their TTL and, least-recently-accessed first, whenever the
+total exceeds the quota. Files created or used by a running pipeline call are
+leased and never evicted until that call finishes.
+"""
+
+import functools
+import logging
+import os
+import re
+import shutil
+import sqlite3
+import threading
+import time
+import uuid
+from contextlib import contextmanager
+from contextvars import ContextVar
+from pathlib import Path
+
+logger = logging.getLogger(__name__)
+
+# Managed outputs are named <32 hex uuid>[_suffix].<ext>[.gz|.br]
+OUTPUT_NAME = re.compile(r"^[0-9a-f]{32}[^/]*$")
+# Skip writes to the index for files touched more recently than this
+ACCESS_RESOLUTION = 60
+
+_leases = ContextVar("storage_leases", default=())
+
+
+def move_legacy_database(old: Path, new: Path):
+    """
+    Move a SQLite database, with its -wal/-shm files, from where an older version kept it (inside
+    the served OUTPUT_DIR) to `new`, unless `new` already exists. Call before either is opened.
+    """
+    old, new = Path(old), Path(new)
+    if not old.exists() or new.exists():
+        return
+    new.parent.mkdir(parents=True, exist_ok=True)
+    for suffix in ("-wal", "-shm", ""):
+        source = old.with_name(old.name + suffix)
+        if source.exists():
+            shutil.move(str(source), str(new.with_name(new.name + suffix)))
+    logger.info(f"[OutputStorage] Moved {old} to {new}")
+
+
+class _Lease(list):
+    """Files pinned by one lease() block; closed once the block exits so late pins are refused."""
+    closed = False
+
+
+class OutputStorage:
+    def __init__(self, root: Path, quota_bytes: int, ttl_seconds: int, index_path: Path = None) -> None:
+        self.root = Path(root)
+        self.root.mkdir(parents=True, exist_ok=True)
+        self.quota_bytes = quota_bytes
+        self.ttl_seconds = ttl_seconds
+        self._lock = threading.Lock()
+        self._pins = {}
+        self._evictions = 0
+        self._stop = threading.Event()
+        self._thread = None
+        self._index_path = str(index_path or self.root / "storage.sqlite3")
+        Path(self._index_path).parent.mkdir(parents=True, exist_ok=True)
+        self._conn = None
+        self._conn_pid = None
+        self._connection().execute("PRAGMA journal_mode=WAL")
+        self._connection().execute(
+            """
+            CREATE TABLE IF NOT EXISTS files (
+                path TEXT PRIMARY KEY,
+                size INTEGER NOT NULL,
+                created REAL NOT NULL,
+                accessed REAL NOT NULL
+            )
+            """
+        )
+        self._connection().execute("CREATE INDEX IF NOT EXISTS files_accessed ON files (accessed)")
+
+    def _connection(self):
+        """This process's index connection; one opened before a fork (gunicorn preload_app) is never reused."""
+        if self._conn_pid != os.getpid():
+            self._conn = sqlite3.connect(self._index_path, check_same_thread=False, isolation_level=None)
+            self._conn_pid = os.getpid()
+        return self._conn
+
+    @classmethod
+    def from_env(cls, root: Path, state_dir: Path):
+        return cls(
+            root,
+            quota_bytes=int(os.getenv("STORAGE_QUOTA_BYTES", 20 * 1024 ** 3)),
+            ttl_seconds=int(os.getenv("STORAGE_TTL_SECONDS", 7 * 24 * 3600)),
+            index_path=Path(state_dir) / "storage.sqlite3",
+        )
+
+    # -- layout ---------------------------------------------------------
+
+    def relative_path(self, filename: str):
+        """Sharded location of `filename`, relative to the root."""
+        return f"{filename[:2]}/{filename}"
+
+    def new_file(self, suffix: str):
+        """
+        Reserve a new output name. Returns (file_id, relative path, absolute path); the shard
+        directory exists and the file is leased to the current pipeline call.
+        """
+        file_id = uuid.uuid4().hex
+        relative = self.relative_path(f"{file_id}{suffix}")
+        path = self.root / relative
+        path.parent.mkdir(parents=True, exist_ok=True)
+        self._pin_to_leases(relative)
+        return file_id, relative, path
+
+    def register(self, relative: str):
+        """Add a finished file to the index (and to the current lease) so it is subject to eviction."""
+        relative = str(relative)
+        size = (self.root / relative).stat().st_size
+        now = time.time()
+        self._pin_to_leases(relative)
+        with self._lock:
+            self._connection().execute(
+                "INSERT OR REPLACE INTO files (path, size, created, accessed) VALUES (?, ?, ?, ?)",
+                (relative, size, now, now),
+            )
+
+    def relative_to_root(self, path):
+        """Path relative to the root for an absolute or cwd-relative path, or None if outside it."""
+        try:
+            return str(Path(path).resolve().relative_to(self.root.resolve()))
+        except ValueError:
+            return None
+
+    def resolve(self, relative: str):
+        """
+        Absolute path of a stored output, or None if it is missing or isn't a managed output
+        (a partial write, or anything else that ended up under the root). Raises PermissionError
+        for paths outside the root. Counts as an access for LRU eviction.
+        """
+        path = (self.root / relative).resolve()
+        relative = self.relative_to_root(path)
+        if relative is None:
+            raise PermissionError(f"{path} is outside {self.root}")
+        if not self.is_output(relative) or not path.is_file():
+            return None
+        self.touch(relative)
+        return path
+
+    def is_output(self, relative: str):
+        """Whether `relative` names a finished output recorded in the index."""
+        name = Path(relative).name
+        if not OUTPUT_NAME.match(name) or name.endswith(".part"):
+            return False
+        with self._lock:
+            row = self._connection().execute("SELECT 1 FROM files WHERE path = ?", (str(relative),)).fetchone()
+        return row is not None
+
+    def touch(self, relative: str):
+        now = time.time()
+        with self._lock:
+            self._connection().execute(
+                "UPDATE files SET accessed = ? WHERE path = ? AND accessed < ?",
+                (now, str(relative), now - ACCESS_RESOLUTION),
+            )
+
+    def delete(self, relative: str):
+        with self._lock:
+            self._connection().execute("DELETE FROM files WHERE path = ?", (str(relative),))
+        (self.root / relative).unlink(missing_ok=True)
+
+    def delete_unpinned(self, relative: str):
+        """
+        Delete a file unless a lease holds it; returns whether it was deleted. The pin is checked
+        under the same lock hold() takes, so a file is either held first and kept, or gone before
+        the hold (callers re-check that held files exist).
+        """
+        relative = str(relative)
+        with self._lock:
+            if relative in self._pins:
+                return False
+            self._connection().execute("DELETE FROM files WHERE path = ?", (relative,))
+            (self.root / relative).unlink(missing_ok=True)
+        return True
+
+    def is_pinned(self, relative: str):
+        with self._lock:
+            return str(relative) in self._pins
+
+    # -- leases ---------------------------------------------------------
+
+    @contextmanager
+    def lease(self, *relatives):
+        """
+        Protect files from eviction for the duration of a pipeline call. Files passed in, and
+        any created through new_file/register inside the block (including in executor threads
+        that inherit the context), are pinned until the block exits.
+        """
+        held = _Lease()
+        token = _leases.set(_leases.get() + (held,))
+        try:
+            for relative in relatives:
+                self._pin(held, str(relative))
+            yield
+        finally:
+            _leases.reset(token)
+            with self._lock:
+                # Work that outlives the block (e.g. a task shared with other callers) may still
+                # see this lease in its context; it must not pin files that would never be released
+                held.closed = True
+                for relative in held:
+                    self._pins[relative] -= 1
+                    if not self._pins[relative]:
+                        del self._pins[relative]
+
+    def leased(self, fn):
+        """Decorator running `fn` inside its own lease()."""
+        @functools.wraps(fn)
+        def wrapper(*args, **kwargs):
+            with self.lease():
+                return fn(*args, **kwargs)
+        return wrapper
+
+    def hold(self, relative: str):
+        """Pin an existing file to the current lease(s), e.g. an input image being read."""
+        self._pin_to_leases(str(relative))
+
+    def _pin(self, held, relative):
+        with self._lock:
+            if held.closed:
+                return
+            self._pins[relative] = self._pins.get(relative, 0) + 1
+            held.append(relative)
+
+    def _pin_to_leases(self, relative):
+        for held in _leases.get():
+            if relative not in held:
+                self._pin(held, relative)
+
+    # -- eviction -------------------------------------------------------
+
+    def scan(self):
+        """Index managed files already on disk (e.g. from before sharding) that the index doesn't know."""
+        with self._lock:
+            known = {row[0] for row in self._connection().execute("SELECT path FROM files")}
+        added = 0
+        for path in self.root.rglob("*"):
+            relative = str(path.relative_to(self.root))
+            if relative in known or not path.is_file() or not OUTPUT_NAME.match(path.name) or path.name.endswith(".part"):
+                continue
+            stat = path.stat()
+            with self._lock:
+                self._connection().execute(
+                    "INSERT OR IGNORE INTO files (path, size, created, accessed) VALUES (?, ?, ?, ?)",
+                    (relative, stat.st_size, stat.st_mtime, stat.st_atime),
+                )
+            added += 1
+        if added:
+            logger.info(f"[OutputStorage] Indexed {added} existing files")
+        return added
+
+    def evict(self):
+        """Remove expired files, then least-recently-accessed files until under quota. Leased files are skipped."""
+        now = time.time()
+        with self._lock:
+            rows = self._connection().execute("SELECT path, size, accessed FROM files ORDER BY accessed").fetchall()
+        total = sum(size for _, size, _ in rows)
+        removed = []
+        for relative, size, accessed in rows:
+            expired = self.ttl_seconds and accessed < now - self.ttl_seconds
+            if not expired and total <= self.quota_bytes:
+                continue
+            # Leases taken since the listing above count too
+            if not self.delete_unpinned(relative):
+                continue
+            total -= size
+            removed.append(relative)
+        if removed:
+            with self._lock:
+                self._evictions += len(removed)
+            logger.info(f"[OutputStorage] Evicted {len(removed)} files, {total} bytes remain")
+        return removed
+
+    def start_background_eviction(self, interval: float = None):
+        if self._thread is not None:
+            return
+        interval = interval or float(os.getenv("STORAGE_EVICT_INTERVAL", 300))
+
+        def loop():
+            self.scan()
+            while not self._stop.is_set():
+                try:
+                    self.evict()
+                except Exception as e:
+                    logger.error(f"[OutputStorage] Eviction failed: {e}")
+                self._stop.wait(interval)
+
+        self._thread = threading.Thread(target=loop, name="output-eviction", daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+
+    def stats(self):
+        with self._lock:
+            files, total = self._connection().execute("SELECT COUNT(*), COALESCE(SUM(size), 0) FROM files").fetchone()
+            return {
+                "files": files,
+                "bytes": total,
+                "quota_bytes": self.quota_bytes,
+                "ttl_seconds": self.ttl_seconds,
+                "pinned": len(self._pins),
+                "evictions": self._evictions,
+            }
@@ -0,0 +1,50 @@
+"""
+Streaming uploads of generated files to pre-signed storage URLs.
+
+Convex storage (like most object stores) hands out upload URLs that take the
+file as the body of a POST and answer with the id it was stored under, e.g.
+{"storageId": "kg2..."}. Sending outputs there straight from the pipeline
+saves callers from downloading them from /files only to upload them again.
+
+Files are streamed from disk in chunks with a known Content-Length, so memory
+use doesn't grow with the asset; bytes already in memory are sent as they are.
+"""
+
+import os
+from pathlib import Path
+
+UPLOAD_TIMEOUT = float(os.getenv("UPLOAD_TIMEOUT", 120))
+
+
+class UploadError(RuntimeError):
+    """The storage endpoint answered without a storage id."""
+
+
+def _storage_id(response):
+    response.raise_for_status()
+    try:
+        body = response.json()
+    except ValueError:
+        body = None
+    if not isinstance(body, dict):
+        body = {}
+    storage_id = body.get("storageId") or body.get("storage_id")
+    if not storage_id:
+        raise UploadError(f"Upload endpoint returned no storage id (HTTP {response.status_code})")
+    return storage_id
+
+
+def upload_file(session, url: str, path: Path, content_type: str, timeout: float = UPLOAD_TIMEOUT):
+    """POST the file at `path` to `url`, streaming it from disk, and return the storage id."""
+    with open(path, "rb") as f:
+        # requests streams file objects in blocks and sets Content-Length from the file size
+        response = session.post(url, data=f, headers={"Content-Type": content_type}, timeout=timeout)
+    with response:
+        return _storage_id(response)
+
+
+def upload_bytes(session, url: str, data: bytes, content_type: str, timeout: float = UPLOAD_TIMEOUT):
+    """POST `data` to `url` and return the storage id."""
+    response = session.post(url, data=data, headers={"Content-Type": content_type}, timeout=timeout)
+    with response:
+        return _storage_id(response)
@@ -161,6 +161,7 @@ export function DesignWorkspace({
         keyType,
         technique,
         referenceStorageId: refStorageId,
+        userId: user.id,
       });
 
       setGeneratedImage({
@@ -8,6 +8,16 @@ import { Id } from "../_generated/dataModel";
 // Number of variations to generate (reduced from 4 to 2 for faster testing)
 const NUM_VARIATIONS = 2;
 
+// Whether the pipeline renders thumbnails (MESH_PREVIEWS=1); off by default, and unknown counts as off
+async function pipelineRendersPreviews(pipelineUrl: string): Promise<boolean> {
+  try {
+    const response = await fetch(`${pipelineUrl}/health`);
+    return response.ok && (await response.json()).previews === true;
+  } catch {
+    return false;
+  }
+}
+
 // Batch generate variations in parallel
 export const startBatch = action({
   args: {
@@ -34,6 +44,7 @@ export const startBatch = action({
     for (let i = 0; i < NUM_VARIATIONS; i++) {
       await ctx.scheduler.runAfter(0, internal.actions.batchGenerate.generateSingle, {
         generationId: generationIds[i],
+        userId: args.userId,
         prompt: args.prompt,
         variationIndex: i,
       });
@@ -47,6 +58,7 @@ export const startBatch = action({
 export const generateSingle = internalAction({
   args: {
     generationId: v.id("generations"),
+    userId: v.string(),
     prompt: v.string(),
     variationIndex: v.number(),
   },
@@ -74,7 +86,14 @@ export const generateSingle = internalAction({
       
       console.log(`[generateSingle] Calling pipeline at: ${generateUrl}`);
       console.log(`[generateSingle] PIPELINE_URL env var: ${process.env.PIPELINE_URL || "NOT SET (using default)"}`);
-      
+
+      // The pipeline streams the mesh (and its thumbnail, if it renders one) straight to Convex storage
+      const modelUploadUrl = await ctx.runMutation(api.generations.generateUploadUrl, {});
+      const uploadUrls: Record<string, string> = { model: modelUploadUrl };
+      if (await pipelineRendersPreviews(pipelineUrl)) {
+        uploadUrls.thumbnail = await ctx.runMutation(api.generations.generateUploadUrl, {});
+      }
+
       let response: Response;
       try {
         response = await fetch(generateUrl, {
@@ -84,6 +103,10 @@ export const generateSingle = internalAction({
             prompt: enhancedPrompt,
             image_model: "nanobanana",
             three_d_model: "trellis",
+            upload_urls: uploadUrls,
+            // Background variations yield to interactive designs and are shared fairly per user
+            user_id: args.userId,
+            priority: "batch",
           }),
         });
       } catch (fetchError) {
@@ -102,49 +125,13 @@ export const generateSingle = internalAction({
       }
 
       const result = await response.json();
-      // Result: { id, format, location, path }
-
-      // Read the PLY file and upload to Convex storage
-      const filesUrl = `${pipelineUrl}/files/${result.path}`;
-      console.log(`[generateSingle] Fetching PLY file from: ${filesUrl}`);
-      
-      let plyResponse: Response;
-      try {
-        plyResponse = await fetch(filesUrl);
-      } catch (fetchError) {
-        const errorMessage = fetchError instanceof Error
-          ? `Failed to fetch PLY file: ${fetchError.message}. URL: ${filesUrl}`
-          : `Failed to fetch PLY file: Unknown error. URL: ${filesUrl}`;
-        console.error(`[generateSingle] ${errorMessage}`, fetchError);
-        throw new Error(errorMessage);
-      }
-      
-      if (!plyResponse.ok) {
-        const errorText = await plyResponse.text().catch(() => plyResponse.statusText);
-        const errorMessage = `Failed to fetch PLY file (${plyResponse.status}): ${errorText}`;
-        console.error(`[generateSingle] ${errorMessage}`);
-        throw new Error(errorMessage);
-      }
-      const plyBlob = await plyResponse.blob();
-
-      // Get upload URL and upload PLY
-      const uploadUrl = await ctx.runMutation(api.generations.generateUploadUrl, {});
-      const uploadResponse = await fetch(uploadUrl, {
-        method: "POST",
-        headers: { "Content-Type": "application/octet-stream" },
-        body: plyBlob,
-      });
-
-      if (!uploadResponse.ok) {
-        throw new Error("Failed to upload PLY to storage");
-      }
-
-      const { storageId } = await uploadResponse.json();
+      // Result: { id, format, location, path, storage_id, thumbnail?: { storage_id, ... } }
 
       // Update generation with the output
       await ctx.runMutation(api.generations.updateOutput, {
         id: args.generationId,
-        outputStorageId: storageId,
+        outputStorageId: result.storage_id,
+        thumbnailStorageId: result.thumbnail?.storage_id,
       });
 
     } catch (error) {
@@ -48,6 +48,7 @@ export const generateImage = action({
     keyType: v.optional(v.string()),
     technique: v.optional(v.string()),
     referenceStorageId: v.optional(v.id("_storage")),
+    userId: v.optional(v.string()),
   },
   handler: async (ctx, args): Promise<{ storageId: Id<"_storage">; backendPath: string }> => {
     // 1. Construct "Smart Prompt"
@@ -61,9 +62,14 @@ export const generateImage = action({
 
     const finalPrompt = `${systemContext} Design Description: ${args.prompt}`;
 
+    // The pipeline uploads the image straight to Convex storage
+    const uploadUrl = await ctx.runMutation(api.generations.generateUploadUrl, {});
+
     const formData = new FormData();
     formData.append("prompt", finalPrompt);
     formData.append("image_model", "nanobanana");
+    formData.append("upload_url", uploadUrl);
+    if (args.userId) formData.append("user_id", args.userId);
 
     if (args.referenceStorageId) {
       const imageUrl = await ctx.storage.getUrl(args.referenceStorageId);
@@ -88,28 +94,10 @@ export const generateImage = action({
       throw new Error(`Image generation failed: ${errorText}`);
     }
 
-    const result = await response.json();
-    // Result: { id, url, path }
-
-    // Download the generated image to store in Convex for display
-    const imageUrl = `${PIPELINE_URL}${result.url}`;
-    const imageFetch = await fetch(imageUrl);
-    if (!imageFetch.ok) throw new Error("Failed to download generated image");
-    
-    const imageBlob = await imageFetch.blob();
-    const uploadUrl = await ctx.runMutation(api.generations.generateUploadUrl, {});
-    
-    const uploadResponse = await fetch(uploadUrl, {
-      method: "POST",
-      headers: { "Content-Type": imageBlob.type },
-      body: imageBlob,
-    });
-
-    if (!uploadResponse.ok) throw new Error("Failed to upload image to storage");
-    const { storageId } = (await uploadResponse.json()) as { storageId: Id<"_storage"> };
+    const result = (await response.json()) as { id: string; url: string; path: string; storage_id: Id<"_storage"> };
 
     return {
-      storageId,
+      storageId: result.storage_id,
       backendPath: result.path,
     };
   },
@@ -138,13 +126,16 @@ export const generateModel = action({
     });
 
     try {
-        // 2. Call backend
+        // 2. Call backend; it streams the model straight to Convex storage
+        const uploadUrl = await ctx.runMutation(api.generations.generateUploadUrl, {});
         const response = await fetch(`${PIPELINE_URL}/generate/3d`, {
             method: "POST",
             headers: { "Content-Type": "application/json" },
             body: JSON.stringify({
                 image_path: args.imagePath,
                 three_d_model: "trellis",
+                upload_url: uploadUrl,
+                user_id: args.userId,
             }),
         });
 
@@ -153,30 +144,13 @@ export const generateModel = action({
             throw new Error(`3D generation failed: ${text}`);
         }
 
-        const result = await response.json();
-        // Result: { id, format, location, path }
-
-        // 3. Download PLY and store
-        const filesUrl = `${PIPELINE_URL}/files/${result.path}`;
-        const plyResponse = await fetch(filesUrl);
-        if (!plyResponse.ok) throw new Error("Failed to download PLY file");
-        
-        const plyBlob = await plyResponse.blob();
-        const uploadUrl = await ctx.runMutation(api.generations.generateUploadUrl, {});
-        
-        const uploadResponse = await fetch(uploadUrl, {
-            method: "POST",
-            headers: { "Content-Type": "application/octet-stream" },
-            body: plyBlob,
-        });
-
-        if (!uploadResponse.ok) throw new Error("Failed to upload PLY");
-        const { storageId } = (await uploadResponse.json()) as { storageId: Id<"_storage"> };
+        const result = (await response.json()) as { path: string; storage_id: Id<"_storage"> };
+        // Result: { id, format, location, path, storage_id }
 
-        // 4. Update generation record
+        // 3. Update generation record
         await ctx.runMutation(api.generations.updateOutput, {
             id: generationId,
-            outputStorageId: storageId,
+            outputStorageId: result.storage_id,
             thumbnailStorageId: args.thumbnailStorageId,
         });
 